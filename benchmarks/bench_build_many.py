@@ -0,0 +1,246 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python benchmarks/bench_build_many.py               # 4 builds, 2 at once
+python benchmarks/bench_build_many.py --builds 8 --jobs 4 --install-seconds 3
+
+Note:
+Script works with python 2.6+ and python 3
+Runs 'vbkick build-many' end-to-end against a stub VBoxManage (a shell
+script keeping VMs, NAT rules and states in a temp dir) and an sshd
+stand-in: 'startvm' starts a process which fetches ks.cfg from the
+shared kickstart webserver, sleeps --install-seconds and then answers
+with the SSH banner on the forwarded ssh_host_port, as sshd of the
+installed guest would.
+
+Times the builds one at a time (--jobs 1) and --jobs at once. The run
+fails (exit code 1) when a build fails, two VMs got the same
+ssh_host_port or the parallel run is not faster.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, sys, time, shutil, tempfile, optparse, subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+VBKICK = os.path.join(REPO_DIR, 'vbkick')
+HELPERS = ['convert_2_scancode.py', 'send_scancodes.py', 'serve_kickstart.py',
+           'download_media.py', 'vm_state.py', 'wait_vm.py', 'export_box.py',
+           'build_trace.py', 'build_many.py']
+
+DEFAULT_BUILDS = 4
+DEFAULT_JOBS = 2
+DEFAULT_INSTALL_SECONDS = 2.0
+
+STUB = r'''#!/bin/bash
+D="%(dir)s/vms"
+case "$1" in
+    --version) echo 4.3.10r93012 ;;
+    list)
+        case "$2" in
+            systemproperties) echo "Default machine folder:          %(dir)s/machines" ;;
+            vms|runningvms)
+                for vm in "$D"/*; do
+                    [[ -d "$vm" ]] || continue
+                    [[ "$2" == vms ]] || [[ "$(cat "$vm/state")" == running ]] || continue
+                    echo "\"${vm##*/}\" {4bd1fb7e-0a33-4f58-b5ce-$(cksum <<< "${vm##*/}" | cut -c1-12)}"
+                done ;;
+            -l)
+                for vm in "$D"/*; do
+                    [[ -d "$vm" ]] || continue
+                    printf 'Name:            %%s\nState:           %%s (since 2014)\n\n' "${vm##*/}" \
+                        "$(sed 's/poweroff/powered off/' "$vm/state")"
+                done ;;
+        esac ;;
+    createvm) mkdir -p "$D/$3"; echo poweroff > "$D/$3/state"; touch "$D/$3/rules" ;;
+    unregistervm) rm -rf "$D/$2" ;;
+    showvminfo)
+        vm="${@: -1}"
+        [[ -d "$D/$vm" ]] || exit 1
+        echo "VMState=\"$(cat "$D/$vm/state")\""
+        i=0
+        while read -r rule; do echo "Forwarding($i)=\"$rule\""; i=$((i+1)); done < "$D/$vm/rules" ;;
+    modifyvm)
+        vm="$2"; shift 2
+        while [[ $# -gt 0 ]]; do
+            if [[ "$1" == --natpf1 ]] && [[ "$2" != delete ]]; then echo "$2" >> "$D/$vm/rules"; fi
+            shift
+        done ;;
+    controlvm)
+        case "$3" in
+            natpf1) [[ "$4" == delete ]] || echo "$4" >> "$D/$2/rules" ;;
+            poweroff|acpipowerbutton)
+                [[ -f "$D/$2/sshd.pid" ]] && kill "$(cat "$D/$2/sshd.pid")" 2>/dev/null
+                echo poweroff > "$D/$2/state" ;;
+        esac ;;
+    startvm)
+        vm="${@: -1}"
+        port=$(grep '^vbkickSSH,' "$D/$vm/rules" | tail -n 1 | cut -d, -f4)
+        echo running > "$D/$vm/state"
+        "%(python)s" "%(dir)s/sshd.py" "$port" "${VBKICK_KICKSTART_PORT:-7122}" %(install_seconds)s \
+            "$D/$vm/sshd.pid" >> "$D/$vm/sshd.log" 2>&1 & ;;
+    guestproperty) exit 1 ;;
+esac
+exit 0
+'''
+
+# sshd of the installed guest - fetches the kickstart file first, as the installer would
+SSHD = r'''
+import os, sys, time, socket
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+port, ks_port, seconds, pid_file = sys.argv[1:]
+open(pid_file, 'w').write('%d' % os.getpid())
+urlopen('http://127.0.0.1:%s/ks.cfg' % ks_port).read()
+time.sleep(float(seconds))
+server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server.bind(('', int(port)))
+server.listen(5)
+while True:
+    conn = server.accept()[0]
+    conn.sendall(b'SSH-2.0-OpenSSH_6.6 stand-in\r\n')
+    conn.close()
+'''
+
+DEFINITION = '''os_type_id="RedHat_64"
+boot_file="iso/boot.iso"
+boot_file_src="boot.iso"
+boot_wait=0
+guest_additions_attach=0
+shared_folders=("")
+ssh_keys_enabled=0
+kickstart_timeout=60
+media_cache_path=""
+boot_plan_cache_path=""
+wait_metrics_file=""
+build_snapshot=0
+'''
+
+def make_env(directory, install_seconds):
+    """Writes the stub VBoxManage, helper wrappers, the sshd stand-in
+    and the definition into /directory/. Returns environment to run vbkick.
+    """
+    bin_dir = os.path.join(directory, 'bin')
+    for path in ('bin', 'vms', 'machines', 'work/iso'):
+        os.makedirs(os.path.join(directory, path))
+    scripts = {'VBoxManage': STUB % {'dir': directory, 'python': sys.executable,
+                                     'install_seconds': install_seconds}}
+    for helper in HELPERS:
+        scripts[helper] = '#!/bin/sh\nexec "%s" "%s" "$@"\n' % (
+            sys.executable, os.path.join(REPO_DIR, helper))
+    # not used by the builds, vbkick only checks they exist
+    for tool in ('ssh', 'scp', 'curl', 'python'):
+        scripts.setdefault(tool, '#!/bin/sh\nexit 1\n')
+    for name, content in scripts.items():
+        path = os.path.join(bin_dir, name)
+        script = open(path, 'w')
+        script.write(content)
+        script.close()
+        os.chmod(path, 0o755)
+    files = {'sshd.py': SSHD, 'work/definition.cfg': DEFINITION,
+             'work/iso/boot.iso': 'boot media', 'work/ks.cfg': 'install\n'}
+    for name, content in files.items():
+        data = open(os.path.join(directory, name), 'w')
+        data.write(content)
+        data.close()
+    env = dict(os.environ)
+    env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+    return env
+
+def stop_vms(directory):
+    """Kills sshd stand-ins and forgets the VMs of the last run."""
+    vms = os.path.join(directory, 'vms')
+    for vm in os.listdir(vms):
+        pid_file = os.path.join(vms, vm, 'sshd.pid')
+        if os.path.exists(pid_file):
+            try:
+                os.kill(int(open(pid_file).read()), 15)
+            except (OSError, ValueError):
+                pass
+        shutil.rmtree(os.path.join(vms, vm))
+
+def run_builds(directory, env, names, jobs):
+    """Returns (seconds, exit code, output lines, ssh host ports)."""
+    cmd = ['bash', VBKICK, 'build-many', '-j', '%d' % jobs,
+           '--lock-dir', os.path.join(directory, 'ports'),
+           '--ssh-ports', '22220-22299', '--kickstart-ports', '27120-27199'] + names
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            cwd=os.path.join(directory, 'work'), env=env)
+    out = proc.communicate()[0]
+    seconds = time.time() - start
+    ports = []
+    for name in names:
+        rules = open(os.path.join(directory, 'vms', name, 'rules'))
+        ports.extend(line.split(',')[3] for line in rules if line.startswith('vbkickSSH,'))
+        rules.close()
+    stop_vms(directory)
+    return seconds, proc.returncode, out.decode('utf-8').splitlines(), ports
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Runs vbkick build-many against a stub VBoxManage.')
+    parser.add_option('-n', '--builds', type='int', default=DEFAULT_BUILDS,
+        help='number of VMs to build [default: %default]')
+    parser.add_option('-j', '--jobs', type='int', default=DEFAULT_JOBS,
+        help='builds running at once [default: %default]')
+    parser.add_option('--install-seconds', type='float', default=DEFAULT_INSTALL_SECONDS,
+        help='time until the sshd stand-in answers [default: %default]')
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+        help='print the build-many output')
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+    if options.builds < 1 or options.jobs < 1:
+        parser.error('--builds and --jobs must be positive')
+    return options
+
+def main(argv):
+    options = parse_args(argv)
+    directory = tempfile.mkdtemp()
+    failed = False
+    try:
+        env = make_env(directory, options.install_seconds)
+        names = ['vm-%02d' % i for i in range(options.builds)]
+        print('[INFO] %d builds, %.1f sec install each, python %s'
+              % (options.builds, options.install_seconds, sys.version.split()[0]))
+        seconds = {}
+        for jobs in (1, options.jobs):
+            seconds[jobs], status, lines, ports = run_builds(directory, env, names, jobs)
+            print('-j %-3d %8.3f sec  exit code %d' % (jobs, seconds[jobs], status))
+            if options.verbose or status != 0:
+                print('\n'.join(lines))
+            if status != 0:
+                failed = True
+            if len(ports) != len(names):
+                print('[ERROR] %d ssh rules for %d VMs' % (len(ports), len(names)))
+                failed = True
+            # built VMs keep running, so each one holds its own port
+            if len(set(ports)) != len(ports):
+                print('[ERROR] VMs share ssh_host_port: %s' % ports)
+                failed = True
+        if options.jobs > 1:
+            speedup = seconds[1] / max(seconds[options.jobs], 1e-6)
+            print('[INFO] -j %d is %.1fx faster' % (options.jobs, speedup))
+            if speedup <= 1:
+                print('[ERROR] parallel builds are not faster')
+                failed = True
+    finally:
+        shutil.rmtree(directory)
+    return failed and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
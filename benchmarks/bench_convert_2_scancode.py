@@ -0,0 +1,283 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python benchmarks/bench_convert_2_scancode.py            # compare with baseline
+python benchmarks/bench_convert_2_scancode.py --quick    # inputs up to 100K chars
+python benchmarks/bench_convert_2_scancode.py --save-baseline
+
+Note:
+Script works with python 2.6+ and python 3 (peak memory needs python 3.4+)
+Times translate_chars(), translate_meta(), translate_sleeps() and
+process_multiply() from convert_2_scancode.py on generated inputs
+of growing size and different shape, and prints throughput and peak memory
+per input size (the scaling curve).
+
+Throughput is stored relative to a small pure python calibration loop,
+so a baseline taken on one machine is usable on another. The loop is timed
+right before each of --repeat runs of a case and the median of their
+ratios is kept - the speed of a shared or throttled machine drifts too much
+between a single calibration and the end of the benchmark.
+The run fails (exit code 1) when a case is slower or uses more memory
+per input character than its baseline allows (see --tolerance).
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, sys, gc, json, time, optparse
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import convert_2_scancode
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_SIZES = [10, 1000, 100000, 1000000, 4000000]
+QUICK_MAX_SIZE = 100000
+DEFAULT_TOLERANCE = 0.5
+DEFAULT_REPEAT = 5
+# min. time of each run of a case - small inputs are repeated to reach it
+MIN_CASE_TIME = 0.05
+# characters of the calibration loop - a few milliseconds
+CALIBRATION_SIZE = 100000
+# peak memory below this many bytes is noise (caches, frames, etc.)
+MEMORY_SLACK = 64 * 1024
+# tracing allocations is slow - peak memory of bigger inputs is not measured
+MEMORY_MAX_SIZE = 1000000
+
+# one unit of each input shape, repeated and cut to the wanted size
+SHAPES = {
+    'plain': 'ks=http://10.0.2.2:7122/ks.cfg;Hello,World!',
+    'meta': '<CtrlShiftAltWinx><Altt>x<CtrlAltDelete><Win>',
+    # white-spaces replaced as in translate_command()
+    'spacebar': convert_2_scancode._spacebar('ls -la /tmp && echo ok '),
+    'multiply': '<Multiply(ab<Enter>,3)>x<Multiply(<Wait>,2)>y',
+}
+
+FUNCTIONS = {
+    'translate_chars': convert_2_scancode.translate_chars,
+    'translate_meta': convert_2_scancode.translate_meta,
+    'translate_sleeps': convert_2_scancode.translate_sleeps,
+    'process_multiply': convert_2_scancode.process_multiply,
+}
+
+def make_input(shape, size):
+    """Returns /size/ characters built from the unit of the given shape."""
+    unit = SHAPES[shape]
+    return (unit * (size // len(unit) + 1))[:size]
+
+CALIBRATION_TABLE = dict((chr(i), '%02x' % i) for i in range(128))
+CALIBRATION_TEXT = ''.join(chr(32 + i % 90) for i in range(CALIBRATION_SIZE))
+
+def calibration_loop(text):
+    out = []
+    table = CALIBRATION_TABLE
+    for char in text:
+        out.append(table[char])
+    return out
+
+def calibrate():
+    """Returns the speed (loops per second) of a small pure python loop
+    which does dict lookups and list appends, as the translators do.
+    """
+    return CALIBRATION_SIZE / time_case(calibration_loop, CALIBRATION_TEXT)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def measure(func, text, repeat=DEFAULT_REPEAT):
+    """Returns (seconds, relative) of func(text) - the median of /repeat/
+    runs, each of them against the calibration loop timed just before it.
+    """
+    seconds = []
+    relative = []
+    for _ in range(repeat):
+        calibration = calibrate()
+        elapsed = time_case(func, text)
+        seconds.append(elapsed)
+        relative.append(len(text) / elapsed / calibration)
+    return median(seconds), median(relative)
+
+def time_case(func, text):
+    """Returns the best time (seconds) of a single func(text) call.
+    Small inputs are timed in loops of many calls, as timeit does.
+    """
+    number = 1
+    best = None
+    spent = 0.0
+    gc.collect()
+    gc.disable()
+    try:
+        while spent < MIN_CASE_TIME or best is None:
+            start = time.time()
+            for _ in range(number):
+                func(text)
+            elapsed = time.time() - start
+            spent += elapsed
+            if elapsed < MIN_CASE_TIME / 10:
+                number *= 10
+                continue
+            if best is None or elapsed / number < best:
+                best = elapsed / number
+    finally:
+        gc.enable()
+    return best
+
+def peak_memory(func, text):
+    """Returns peak memory (bytes) allocated by func(text),
+    or None when tracemalloc is not available or text is too big.
+    """
+    if tracemalloc is None or len(text) > MEMORY_MAX_SIZE:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(text)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run(sizes, functions, shapes, repeat=DEFAULT_REPEAT, out=sys.stdout):
+    """Runs every function/shape/size case and returns
+    {'func/shape/size': {...}} with the measured results.
+    """
+    results = {}
+    for func_name in functions:
+        for shape in shapes:
+            out.write('\n%s, %s input\n' % (func_name, shape))
+            out.write('%10s %10s %10s %10s %12s\n'
+                      % ('chars', 'sec', 'MB/s', 'relative', 'peak KB'))
+            for size in sizes:
+                text = make_input(shape, size)
+                func = FUNCTIONS[func_name]
+                seconds, relative = measure(func, text, repeat)
+                peak = peak_memory(func, text)
+                chars_per_sec = size / seconds
+                results['%s/%s/%d' % (func_name, shape, size)] = {
+                    'seconds': seconds,
+                    'chars_per_sec': chars_per_sec,
+                    'relative': relative,
+                    'peak_bytes': peak,
+                }
+                out.write('%10d %10.4f %10.2f %10.3f %12s\n' % (
+                    size, seconds, chars_per_sec / 1e6, relative,
+                    peak is None and 'n/a' or '%.1f' % (peak / 1024.0)))
+                out.flush()
+    return results
+
+def compare(results, baseline, tolerance):
+    """Returns the list of regressions of /results/ against /baseline/."""
+    regressions = []
+    for case in sorted(results):
+        if case not in baseline:
+            continue
+        now, then = results[case], baseline[case]
+        if now['relative'] < then['relative'] * (1 - tolerance):
+            regressions.append('%s: %.3f relative throughput, baseline %.3f'
+                               % (case, now['relative'], then['relative']))
+        if now['peak_bytes'] is not None and then['peak_bytes'] is not None:
+            allowed = then['peak_bytes'] * (1 + tolerance) + MEMORY_SLACK
+            if now['peak_bytes'] > allowed:
+                regressions.append('%s: %d bytes peak memory, baseline %d'
+                                   % (case, now['peak_bytes'], then['peak_bytes']))
+    return regressions
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    baseline_file = open(path)
+    try:
+        return json.load(baseline_file)['cases']
+    finally:
+        baseline_file.close()
+
+def save_baseline(path, results, calibration):
+    baseline_file = open(path, 'w')
+    try:
+        json.dump({'python': sys.version.split()[0],
+                   'calibration': calibration,
+                   'cases': results},
+                  baseline_file, indent=1, sort_keys=True)
+        baseline_file.write('\n')
+    finally:
+        baseline_file.close()
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Benchmarks convert_2_scancode.py translators.')
+    parser.add_option('--quick', action='store_true', default=False,
+        help='only use inputs up to %d chars' % QUICK_MAX_SIZE)
+    parser.add_option('--sizes', default=None,
+        help='comma separated input sizes [default: %s]'
+             % ','.join(str(s) for s in DEFAULT_SIZES))
+    parser.add_option('-f', '--function', action='append', default=None,
+        choices=sorted(FUNCTIONS), help='function to benchmark [default: all]')
+    parser.add_option('-s', '--shape', action='append', default=None,
+        choices=sorted(SHAPES), help='input shape to use [default: all]')
+    parser.add_option('-b', '--baseline', default=DEFAULT_BASELINE,
+        help='baseline file [default: %default]')
+    parser.add_option('--save-baseline', action='store_true', default=False,
+        help='store results as the new baseline instead of comparing')
+    parser.add_option('-r', '--repeat', type='int', default=DEFAULT_REPEAT,
+        help='runs of each case, the median is kept [default: %default]')
+    parser.add_option('-t', '--tolerance', type='float', default=DEFAULT_TOLERANCE,
+        help='allowed slowdown/memory growth as a fraction [default: %default]')
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+    if options.sizes:
+        try:
+            options.sizes = [int(s) for s in options.sizes.split(',')]
+        except ValueError:
+            parser.error('--sizes must be comma separated integers')
+    else:
+        options.sizes = DEFAULT_SIZES
+    if options.quick:
+        options.sizes = [s for s in options.sizes if s <= QUICK_MAX_SIZE]
+    if not options.sizes or min(options.sizes) < 1:
+        parser.error('--sizes must be positive')
+    if options.repeat < 1:
+        parser.error('--repeat must be positive')
+    return options
+
+def main(argv):
+    options = parse_args(argv)
+    calibration = median([calibrate() for _ in range(options.repeat)])
+    print('[INFO] calibration: %.0f loops/sec, python %s'
+          % (calibration, sys.version.split()[0]))
+    if tracemalloc is None:
+        print('[WARNING] tracemalloc not available - peak memory not measured')
+    results = run(options.sizes, options.function or sorted(FUNCTIONS),
+                  options.shape or sorted(SHAPES), options.repeat)
+    print('')
+    if options.save_baseline:
+        save_baseline(options.baseline, results, calibration)
+        print('[INFO] baseline saved to %s' % options.baseline)
+        return 0
+    baseline = load_baseline(options.baseline)
+    if baseline is None:
+        print('[WARNING] no baseline in %s - use --save-baseline' % options.baseline)
+        return 0
+    regressions = compare(results, baseline, options.tolerance)
+    if regressions:
+        for regression in regressions:
+            print('[ERROR] regression - %s' % regression)
+        return 1
+    print('[INFO] no regressions against %s' % options.baseline)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python benchmarks/bench_list_vms.py               # 1000 fake VMs
+python benchmarks/bench_list_vms.py --vms 100 --skip-old
+
+Note:
+Script works with python 2.6+ and python 3
+Times 'vbkick list' on a host with many VMs against a stub VBoxManage
+(a shell script serving generated 'list vms', 'list -l vms' and
+'showvminfo' output), and counts VBoxManage calls:
+
+old - 'list vms' and then showvminfo | grep | cut | sed for every VM
+new - vm_state.py --list, one 'list -l vms' call for all VMs
+
+Both must print the same "vm name:state" lines. The run fails (exit
+code 1) when the new listing takes longer than --max-seconds.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, sys, time, shutil, tempfile, optparse, subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+VM_STATE = os.path.join(os.path.dirname(BENCH_DIR), 'vm_state.py')
+
+DEFAULT_VMS = 1000
+DEFAULT_MAX_SECONDS = 2.0
+STATES = ['powered off', 'running', 'saved', 'paused', 'aborted']
+
+STUB = '''#!/bin/sh
+echo "$*" >> "%(dir)s/calls"
+case "$1 $2 $3" in
+    "list vms "*) cat "%(dir)s/vms" ;;
+    "list -l vms") cat "%(dir)s/vms_long" ;;
+    "showvminfo "*) cat "%(dir)s/info/$2" ;;
+    *) exit 1 ;;
+esac
+'''
+
+# _list_all_vms before vm_state.py --list
+OLD_LIST = r'''
+VBoxManage list vms | cut -f 1 -d'{' | sed 's/\s*$//g' | while read -r __lc_vm; do
+    __lc_vm="${__lc_vm//\"/}"
+    __lc_state=$(VBoxManage showvminfo "${__lc_vm}" | grep State: | cut -d' ' -f 2- | cut -d'(' -f 1 | sed 's/\s*$//g;s/^\s*//g')
+    printf "${__lc_vm}:${__lc_state}\n"
+done
+'''
+
+def _vm_info(name, uuid, state):
+    return ('Name:            %s\n'
+            'Groups:          /\n'
+            'Guest OS:        Red Hat (64 bit)\n'
+            'UUID:            %s\n'
+            'Config file:     /home/vbkick/VirtualBox VMs/%s/%s.vbox\n'
+            'Memory size:     512MB\n'
+            'State:           %s (since 2014-05-20T09:12:51.184000000)\n'
+            'NIC 1:           MAC: 0800272E6A8C, Attachment: NAT, Type: 82540EM\n'
+            '\n'
+            'Shared folders:  \n'
+            '\n'
+            "Name: 'vbkick', Host path: '/home/vbkick/%s' (machine mapping), writable\n"
+            '\n' % (name, uuid, name, name, state, name))
+
+def make_stub(directory, count):
+    """Writes a stub VBoxManage with /count/ fake VMs into /directory/.
+    Returns the expected "vm name:state" lines.
+    """
+    os.makedirs(os.path.join(directory, 'info'))
+    expected = []
+    vms = open(os.path.join(directory, 'vms'), 'w')
+    vms_long = open(os.path.join(directory, 'vms_long'), 'w')
+    try:
+        for i in range(count):
+            # some names with a space, as VirtualBox allows
+            name = i % 10 and 'vm-%04d' % i or 'web %04d' % i
+            uuid = '4bd1fb7e-0a33-4f58-b5ce-%012d' % i
+            state = STATES[i % len(STATES)]
+            info = _vm_info(name, uuid, state)
+            vms.write('"%s" {%s}\n' % (name, uuid))
+            vms_long.write(info)
+            info_file = open(os.path.join(directory, 'info', name), 'w')
+            info_file.write(info)
+            info_file.close()
+            expected.append('%s:%s' % (name, state))
+    finally:
+        vms.close()
+        vms_long.close()
+    stub = os.path.join(directory, 'VBoxManage')
+    stub_file = open(stub, 'w')
+    stub_file.write(STUB % {'dir': directory})
+    stub_file.close()
+    os.chmod(stub, 0o755)
+    return expected
+
+def time_listing(directory, cmd):
+    """Returns (seconds, output lines, VBoxManage calls) of /cmd/."""
+    calls = os.path.join(directory, 'calls')
+    if os.path.exists(calls):
+        os.remove(calls)
+    env = dict(os.environ)
+    env['PATH'] = directory + os.pathsep + env.get('PATH', '')
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=env)
+    out = proc.communicate()[0]
+    seconds = time.time() - start
+    if proc.returncode != 0:
+        raise Exception('%s failed with exit code %d' % (cmd, proc.returncode))
+    calls_file = open(calls)
+    calls_nr = len(calls_file.readlines())
+    calls_file.close()
+    return seconds, out.decode('utf-8').splitlines(), calls_nr
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Benchmarks vbkick list against a stub VBoxManage.')
+    parser.add_option('-n', '--vms', type='int', default=DEFAULT_VMS,
+        help='number of fake VMs [default: %default]')
+    parser.add_option('--skip-old', action='store_true', default=False,
+        help='do not time the old showvminfo per VM listing')
+    parser.add_option('--max-seconds', type='float', default=DEFAULT_MAX_SECONDS,
+        help='fail when the new listing takes longer [default: %default]')
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+    if options.vms < 1:
+        parser.error('--vms must be positive')
+    return options
+
+def main(argv):
+    options = parse_args(argv)
+    directory = tempfile.mkdtemp()
+    failed = False
+    try:
+        expected = make_stub(directory, options.vms)
+        cases = [
+            ('new', [sys.executable, VM_STATE, '--list']),
+            ('new --json', [sys.executable, VM_STATE, '--list', '--json']),
+            ('new --state running', [sys.executable, VM_STATE, '--list',
+                                     '--state', 'running']),
+        ]
+        if not options.skip_old:
+            cases.append(('old', ['bash', '-c', OLD_LIST]))
+        print('[INFO] %d fake VMs, python %s'
+              % (options.vms, sys.version.split()[0]))
+        seconds = {}
+        for name, cmd in cases:
+            seconds[name], lines, calls = time_listing(directory, cmd)
+            print('%-20s %8.3f sec %6d VBoxManage calls'
+                  % (name, seconds[name], calls))
+            if name in ('new', 'old') and lines != expected:
+                print('[ERROR] %s listing differs from the expected one' % name)
+                failed = True
+        if 'old' in seconds:
+            print('[INFO] new listing is %.1fx faster'
+                  % (seconds['old'] / max(seconds['new'], 1e-6)))
+        if seconds['new'] > options.max_seconds:
+            print('[ERROR] new listing took %.3f sec, more than %.3f sec'
+                  % (seconds['new'], options.max_seconds))
+            failed = True
+    finally:
+        shutil.rmtree(directory)
+    return failed and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
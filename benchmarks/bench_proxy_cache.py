@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python benchmarks/bench_proxy_cache.py                 # 20 packages of 1 MB
+python benchmarks/bench_proxy_cache.py --packages 50 --size-kb 512 --rate-kb 2048
+
+Note:
+Script works with python 2.6+ and python 3
+Fetches packages and repo metadata through the caching proxy of
+serve_kickstart.py twice - the first build (empty cache) and a rebuild
+of the same definition. Upstream is a local stand-in which adds
+--latency-ms to each request and sends bodies at --rate-kb per second,
+like a mirror on the internet.
+
+The run fails (exit code 1) when a fetched body differs from upstream,
+the rebuild is not --min-speedup times faster, or packages of the
+rebuild are not all served from the cache.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, sys, time, shutil, tempfile, optparse, threading
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from http.client import HTTPConnection
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from httplib import HTTPConnection
+    from SocketServer import ThreadingMixIn
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import serve_kickstart
+
+DEFAULT_PACKAGES = 20
+DEFAULT_SIZE_KB = 1024
+DEFAULT_RATE_KB = 8192
+DEFAULT_LATENCY_MS = 50
+DEFAULT_MIN_SPEEDUP = 5.0
+
+class Mirror(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    """Slow upstream: packages, and repomd.xml with an ETag."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.path.endswith('repomd.xml') and self.headers.get('If-None-Match') == '"1"':
+            self.send_response(304)
+            self.send_header('ETag', '"1"')
+            self.end_headers()
+            return
+        body = self.server.bodies.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if self.path.endswith('repomd.xml'):
+            self.send_header('ETag', '"1"')
+        self.end_headers()
+        chunk = max(1, int(self.server.rate / 20))
+        for offset in range(0, len(body), chunk):
+            self.wfile.write(body[offset:offset + chunk])
+            time.sleep(len(body[offset:offset + chunk]) / self.server.rate)
+
+def start(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+def fetch_all(proxy_port, mirror_url, paths, bodies):
+    """Fetches /paths/ through the proxy on one keep-alive connection
+    (as yum does). Returns (seconds, number of bad bodies).
+    """
+    conn = HTTPConnection('127.0.0.1', proxy_port)
+    bad = 0
+    start = time.time()
+    for path in paths:
+        conn.request('GET', mirror_url + path)
+        response = conn.getresponse()
+        if response.read() != bodies[path]:
+            bad += 1
+    seconds = time.time() - start
+    conn.close()
+    return seconds, bad
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Times a build and a rebuild through the caching proxy.')
+    parser.add_option('-n', '--packages', type='int', default=DEFAULT_PACKAGES,
+        help='packages fetched by a build [default: %default]')
+    parser.add_option('--size-kb', type='int', default=DEFAULT_SIZE_KB,
+        help='size of a package [default: %default]')
+    parser.add_option('--rate-kb', type='int', default=DEFAULT_RATE_KB,
+        help='upstream bandwidth in KB/s [default: %default]')
+    parser.add_option('--latency-ms', type='int', default=DEFAULT_LATENCY_MS,
+        help='upstream latency of a request [default: %default]')
+    parser.add_option('--min-speedup', type='float', default=DEFAULT_MIN_SPEEDUP,
+        help='required rebuild speedup [default: %default]')
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+    if options.packages < 1 or options.size_kb < 1 or options.rate_kb < 1:
+        parser.error('--packages, --size-kb and --rate-kb must be positive')
+    return options
+
+def main(argv):
+    options = parse_args(argv)
+    directory = tempfile.mkdtemp()
+    failed = False
+    try:
+        mirror = Mirror(('127.0.0.1', 0), MirrorHandler)
+        mirror.latency = options.latency_ms / 1000
+        mirror.rate = options.rate_kb * 1024
+        mirror.bodies = {'/os/repodata/repomd.xml': b'<repomd/>' * 100}
+        for i in range(options.packages):
+            mirror.bodies['/os/Packages/pkg-%03d.rpm' % i] = os.urandom(options.size_kb * 1024)
+        paths = sorted(mirror.bodies, reverse=True)
+        start(mirror)
+        mirror_url = 'http://127.0.0.1:%d' % mirror.server_address[1]
+        proxy = serve_kickstart.KickstartServer(
+            ('127.0.0.1', 0), log=open(os.devnull, 'w'),
+            proxy_cache=serve_kickstart.ProxyCache(os.path.join(directory, 'cache')))
+        start(proxy)
+        print('[INFO] %d packages of %d KB, upstream %d KB/s and %d ms per request, python %s'
+              % (options.packages, options.size_kb, options.rate_kb, options.latency_ms,
+                 sys.version.split()[0]))
+        seconds = []
+        for name in ('build', 'rebuild'):
+            took, bad = fetch_all(proxy.server_address[1], mirror_url, paths, mirror.bodies)
+            seconds.append(took)
+            # the last request is logged (counted) just after its body is sent
+            time.sleep(0.2)
+            print('%-8s %8.3f sec  %s' % (name, took, proxy.proxy_report()))
+            if bad:
+                print('[ERROR] %d bodies differ from upstream' % bad)
+                failed = True
+        proxy.shutdown()
+        proxy.server_close()
+        mirror.shutdown()
+        mirror.server_close()
+        speedup = seconds[0] / max(seconds[1], 1e-6)
+        print('[INFO] rebuild is %.1fx faster' % speedup)
+        if speedup < options.min_speedup:
+            print('[ERROR] rebuild is not %.1fx faster' % options.min_speedup)
+            failed = True
+        if proxy.proxy_stats.get('hit', 0) != options.packages:
+            print('[ERROR] %d of %d packages served from the cache'
+                  % (proxy.proxy_stats.get('hit', 0), options.packages))
+            failed = True
+    finally:
+        shutil.rmtree(directory)
+    return failed and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python benchmarks/bench_startup.py
+python benchmarks/bench_startup.py --runs 50 --max-overhead-ms 40 --max-import-ms 15
+
+Note:
+Script works with python 2.6+ and python 3
+Checks the cold start of convert_2_scancode.py - vbkick runs it for
+every build (and send_scancodes.py users for every command):
+- wall-clock: the median time of --runs invocations translating one
+  boot command, minus the median start of the bare interpreter
+  (python -c pass), must stay under --max-overhead-ms,
+- imports (python 3.7+, -X importtime): the time of modules imported
+  by the script and not by the bare interpreter must stay under
+  --max-import-ms; the slowest of them are printed.
+
+The run fails (exit code 1) when a budget is exceeded or the script
+gives wrong scancodes.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, sys, time, optparse, subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(BENCH_DIR), 'convert_2_scancode.py')
+
+COMMAND = b'<Tab> text ks=http://10.0.2.2:7122/ks.cfg<Enter>'
+EXPECTED_START = '0f 8f 39 b9 14 94 12 92 2d ad 14 94'
+
+DEFAULT_RUNS = 20
+DEFAULT_MAX_OVERHEAD_MS = 40.0
+DEFAULT_MAX_IMPORT_MS = 20.0
+
+def run(args, stdin=b''):
+    """Returns (seconds, stdout, stderr) of one run of python /args/."""
+    start = time.time()
+    proc = subprocess.Popen([sys.executable] + args, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(stdin)
+    return time.time() - start, out.decode('utf-8'), err.decode('utf-8')
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def import_times(args):
+    """Returns {module: self microseconds} from -X importtime of python /args/."""
+    times = {}
+    err = run(['-X', 'importtime'] + args, COMMAND)[2]
+    for line in err.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        times[fields[2].strip()] = int(fields[0])
+    return times
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Checks the cold start of convert_2_scancode.py.')
+    parser.add_option('-n', '--runs', type='int', default=DEFAULT_RUNS,
+        help='invocations to time [default: %default]')
+    parser.add_option('--max-overhead-ms', type='float', default=DEFAULT_MAX_OVERHEAD_MS,
+        help='wall-clock budget over the bare interpreter [default: %default]')
+    parser.add_option('--max-import-ms', type='float', default=DEFAULT_MAX_IMPORT_MS,
+        help='budget of imports over the bare interpreter [default: %default]')
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+    if options.runs < 1:
+        parser.error('--runs must be positive')
+    return options
+
+def main(argv):
+    options = parse_args(argv)
+    failed = False
+    print('[INFO] %d runs, python %s' % (options.runs, sys.version.split()[0]))
+    bare, script = [], []
+    for i in range(options.runs):
+        bare.append(run(['-c', 'pass'])[0])
+        seconds, out, err = run([SCRIPT], COMMAND)
+        script.append(seconds)
+        if not out.startswith(EXPECTED_START):
+            print('[ERROR] bad scancodes: %r %r' % (out, err))
+            return 1
+    overhead = (median(script) - median(bare)) * 1000
+    print('interpreter      %8.1f ms' % (median(bare) * 1000))
+    print('convert_2_scancode.py %3.1f ms  (%.1f ms over the interpreter, budget %.1f ms)'
+          % (median(script) * 1000, overhead, options.max_overhead_ms))
+    if overhead > options.max_overhead_ms:
+        print('[ERROR] cold start is over the budget')
+        failed = True
+    if sys.version_info[:2] < (3, 7):
+        print('[INFO] -X importtime needs python 3.7+, imports not checked')
+        return failed and 1 or 0
+    # the fastest of a few runs - the least disturbed by other processes
+    base = import_times(['-c', 'pass'])
+    own = {}
+    for i in range(3):
+        for module, usec in import_times([SCRIPT]).items():
+            if module not in base:
+                own[module] = min(own.get(module, usec), usec)
+    total = sum(own.values()) / 1000
+    print('imports          %8.1f ms  (%d modules, budget %.1f ms)'
+          % (total, len(own), options.max_import_ms))
+    for module in sorted(own, key=own.get, reverse=True)[:5]:
+        print('  %-22s %6.1f ms' % (module, own[module] / 1000))
+    if total > options.max_import_ms:
+        print('[ERROR] imports are over the budget')
+        failed = True
+    return failed and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,607 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python build_many.py -j 3 centos65:definition-6.5-x86_64.cfg centos7:definition-7.0-x86_64.cfg
+python build_many.py --ssh-ports 2300-2399 --no-webserver sl65
+python build_many.py --proxy-cache ~/.vbkick/proxy sl65 centos65
+
+Note:
+Script works with python 2.6+ and python 3
+Runs 'vbkick build VM_NAME DEFINITION' for many definitions from the
+current directory, at most --jobs at once:
+
+ports - each build gets a free ssh_host_port from --ssh-ports. A lock
+file PORT in --lock-dir (created under flock of the directory lock)
+holds the port from the allocation until the build ends, so parallel
+build_many.py runs never hand out the same port; locks of dead
+processes are taken over.
+webserver - one serve_kickstart.py on a free port from --kickstart-ports
+serves the current directory to all guests (%PORT% in
+boot_cmd_sequence), builds run with webserver_disabled=1. With
+--proxy-cache it is the caching proxy (%PROXY%) of all guests too, so
+packages fetched by one build are served to the others from the cache.
+
+vbkick reads the allocated ports from VBKICK_SSH_HOST_PORT,
+VBKICK_KICKSTART_PORT and VBKICK_WEBSERVER_DISABLED, and whether the
+shared webserver is a proxy from VBKICK_PROXY_CACHE_PATH (empty - no
+proxy, %PROXY% is dropped). Output of the builds is interleaved line
+by line with a [VM_NAME] prefix.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, sys, time, errno, fcntl, select, signal, socket, optparse
+import threading, subprocess
+
+DEFAULT_JOBS = 2
+DEFAULT_SSH_PORTS = '2222-2321'
+DEFAULT_KICKSTART_PORTS = '7122-7221'
+DEFAULT_LOCK_DIR = '~/.vbkick/ports'
+DEFAULT_DEFINITION = 'definition.cfg'
+SERVER_READY_TIMEOUT = 10
+
+class PortError(Exception):
+    pass
+
+def parse_range(text):
+    """'2222-2321' or '2222' -> (first, last)"""
+    first, _, last = text.partition('-')
+    first = int(first)
+    last = last and int(last) or first
+    if not 0 < first <= last < 65536:
+        raise ValueError('bad port range: %s' % text)
+    return first, last
+
+def parse_target(text):
+    """'VM_NAME[:DEFINITION]' -> (name, definition)"""
+    name, _, definition = text.partition(':')
+    if not name:
+        raise ValueError('empty VM name: %s' % text)
+    return name, definition or DEFAULT_DEFINITION
+
+def port_is_free(port):
+    """True when nothing is bound to /port/ - VirtualBox NAT binds all
+    interfaces when the host ip of the rule is empty.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('', port))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class PortAllocator(object):
+    """Hands out free ports, lock file /lock_dir//PORT (with the owner
+    pid) holds a port until it is released.
+    """
+
+    def __init__(self, lock_dir, is_free=port_is_free, alive=pid_alive,
+                 pid=None):
+        self.lock_dir = lock_dir
+        self.is_free = is_free
+        self.alive = alive
+        self.pid = pid or os.getpid()
+        self.held = set()
+        self.mutex = threading.Lock()
+        if not os.path.isdir(lock_dir):
+            os.makedirs(lock_dir)
+
+    def allocate(self, first, last):
+        with self.mutex:
+            # the directory lock makes the stale lock takeover atomic
+            dir_lock = open(os.path.join(self.lock_dir, '.lock'), 'a')
+            try:
+                fcntl.flock(dir_lock, fcntl.LOCK_EX)
+                for port in range(first, last + 1):
+                    if port in self.held or not self._lock(port):
+                        continue
+                    if self.is_free(port):
+                        self.held.add(port)
+                        return port
+                    os.remove(self._path(port))
+            finally:
+                dir_lock.close()
+        raise PortError('no free port in %d-%d' % (first, last))
+
+    def release(self, port):
+        with self.mutex:
+            if port in self.held:
+                self.held.remove(port)
+                try:
+                    os.remove(self._path(port))
+                except OSError:
+                    pass
+
+    def release_all(self):
+        for port in list(self.held):
+            self.release(port)
+
+    def _path(self, port):
+        return os.path.join(self.lock_dir, '%d' % port)
+
+    def _lock(self, port):
+        path = self._path(port)
+        if os.path.exists(path):
+            if not self._stale(path):
+                return False
+            os.remove(path)
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        os.write(fd, ('%d\n' % self.pid).encode('ascii'))
+        os.close(fd)
+        return True
+
+    def _stale(self, path):
+        try:
+            lock_file = open(path)
+            try:
+                pid = int(lock_file.read().strip())
+            finally:
+                lock_file.close()
+        except (IOError, ValueError):
+            return True
+        return not self.alive(pid)
+
+class PrefixedOutput(object):
+    """Writes lines of many processes to one stream, each line whole and
+    with the [NAME] prefix of its process.
+    """
+
+    def __init__(self, stream, width=0):
+        self.stream = getattr(stream, 'buffer', stream)
+        self.width = width
+        self.mutex = threading.Lock()
+
+    def line(self, name, line):
+        prefix = ('[%s]' % name).ljust(self.width + 2) + ' '
+        if not line.endswith(b'\n'):
+            line += b'\n'
+        with self.mutex:
+            self.stream.write(prefix.encode('utf-8') + line)
+            self.stream.flush()
+
+    def pump(self, name, pipe):
+        for line in iter(pipe.readline, b''):
+            self.line(name, line)
+        pipe.close()
+
+def start_server(port, output, command=('serve_kickstart.py',)):
+    """Starts the shared webserver, returns its process once it listens."""
+    ready_r, ready_w = os.pipe()
+    kwargs = {}
+    if sys.version_info[0] >= 3:
+        kwargs['pass_fds'] = (ready_w,)
+    else:
+        kwargs['close_fds'] = False
+    proc = subprocess.Popen(
+        list(command) + ['--port', '%d' % port, '--ready-fd', '%d' % ready_w],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    os.close(ready_w)
+    try:
+        ready = ''
+        if select.select([ready_r], [], [], SERVER_READY_TIMEOUT)[0]:
+            ready = os.read(ready_r, 64).decode('ascii').strip()
+    finally:
+        os.close(ready_r)
+    thread = threading.Thread(target=output.pump, args=('kickstart', proc.stdout))
+    thread.daemon = True
+    thread.start()
+    if ready != '%d' % port:
+        stop_process(proc)
+        raise PortError('webserver was not started on port %d' % port)
+    return proc
+
+def stop_process(proc):
+    if proc.poll() is None:
+        try:
+            proc.terminate()
+        except OSError:
+            pass
+    proc.wait()
+
+class Build(object):
+
+    def __init__(self, name, definition):
+        self.name = name
+        self.definition = definition
+        self.ssh_port = None
+        self.status = None
+        self.seconds = 0.0
+        self.proc = None
+
+class BuildMany(object):
+    """Runs the builds, at most /jobs/ at once."""
+
+    def __init__(self, builds, jobs, allocator, ssh_ports, output,
+                 vbkick=('vbkick',), kickstart_port=None, proxy_cache=None,
+                 clock=time.time):
+        self.builds = builds
+        self.jobs = jobs
+        self.allocator = allocator
+        self.ssh_ports = ssh_ports
+        self.output = output
+        self.vbkick = vbkick
+        self.kickstart_port = kickstart_port
+        self.proxy_cache = proxy_cache
+        self.clock = clock
+        self.pending = list(builds)
+        self.mutex = threading.Lock()
+        self.stopping = False
+
+    def run(self):
+        workers = []
+        for _ in range(min(self.jobs, len(self.builds))):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        try:
+            # join with timeout - Ctrl-C is delivered to the main thread
+            while [w for w in workers if w.is_alive()]:
+                for worker in workers:
+                    worker.join(0.2)
+        except KeyboardInterrupt:
+            self.stop()
+            raise
+        return all(build.status == 0 for build in self.builds)
+
+    def stop(self):
+        """Stops running builds - vbkick cleans up in its signal handler."""
+        with self.mutex:
+            self.stopping = True
+            self.pending = []
+        for build in self.builds:
+            if build.proc is not None and build.proc.poll() is None:
+                build.proc.send_signal(signal.SIGTERM)
+        for build in self.builds:
+            if build.proc is not None:
+                build.proc.wait()
+
+    def _worker(self):
+        while True:
+            with self.mutex:
+                if not self.pending or self.stopping:
+                    return
+                build = self.pending.pop(0)
+            self._build(build)
+
+    def _env(self, build):
+        env = dict(os.environ)
+        env['VBKICK_SSH_HOST_PORT'] = '%d' % build.ssh_port
+        if self.kickstart_port is not None:
+            env['VBKICK_KICKSTART_PORT'] = '%d' % self.kickstart_port
+            env['VBKICK_WEBSERVER_DISABLED'] = '1'
+            # %PROXY% of the builds is the shared webserver, if it is a proxy
+            env['VBKICK_PROXY_CACHE_PATH'] = self.proxy_cache or ''
+        return env
+
+    def _build(self, build):
+        start = self.clock()
+        try:
+            build.ssh_port = self.allocator.allocate(*self.ssh_ports)
+        except PortError as e:
+            self.output.line(build.name, ('[ERROR] %s' % e).encode('utf-8'))
+            build.status = 1
+            return
+        try:
+            self.output.line(build.name, ('[INFO] build %s with ssh_host_port=%d'
+                             % (build.definition, build.ssh_port)).encode('utf-8'))
+            devnull = open(os.devnull)
+            try:
+                with self.mutex:
+                    if self.stopping:
+                        return
+                    build.proc = subprocess.Popen(
+                        list(self.vbkick) + ['build', build.name, build.definition],
+                        stdin=devnull, stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT, env=self._env(build))
+            finally:
+                devnull.close()
+            self.output.pump(build.name, build.proc.stdout)
+            build.status = build.proc.wait()
+        finally:
+            build.seconds = self.clock() - start
+            self.allocator.release(build.ssh_port)
+
+def summary(builds, seconds):
+    failed = [b for b in builds if b.status != 0]
+    lines = ['[INFO] %d built, %d failed in %.1f sec'
+             % (len(builds) - len(failed), len(failed), seconds)]
+    width = max(len(b.name) for b in builds)
+    for build in builds:
+        if build.status == 0:
+            status = 'ok'
+        elif build.status is None:
+            status = 'not run'
+        else:
+            status = 'failed (%d)' % build.status
+        lines.append('  %s  %-11s ssh_host_port=%-5s %8.1f sec'
+                     % (build.name.ljust(width), status,
+                        build.ssh_port or '-', build.seconds))
+    return '\n'.join(lines)
+
+def test_parse():
+    failed_tests = []
+    cases = [
+        (parse_range, '2222-2321', (2222, 2321)),
+        (parse_range, '7122', (7122, 7122)),
+        (parse_target, 'centos65', ('centos65', 'definition.cfg')),
+        (parse_target, 'sl65:definition-6.5.cfg', ('sl65', 'definition-6.5.cfg')),
+    ]
+    for func, arg, expected in cases:
+        result = func(arg)
+        if result != expected:
+            failed_tests.append([arg, result, expected])
+    for func, arg in [(parse_range, '2321-2222'), (parse_range, '0'),
+                      (parse_target, ':definition.cfg')]:
+        try:
+            func(arg)
+            failed_tests.append([arg, 'no ValueError'])
+        except ValueError:
+            pass
+    if failed_tests:
+        raise Exception(
+                 "parse_range(), parse_target()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_port_allocator():
+    import shutil, tempfile
+    lock_dir = tempfile.mkdtemp()
+    failed_tests = []
+    try:
+        used = set([2223])
+        dead = set([4242])
+        alive = lambda pid: pid not in dead
+        first = PortAllocator(lock_dir, is_free=lambda p: p not in used,
+                              alive=alive, pid=100)
+        second = PortAllocator(lock_dir, is_free=lambda p: p not in used,
+                               alive=alive, pid=200)
+        # port in use by other process is skipped
+        ports = [first.allocate(2222, 2225), first.allocate(2222, 2225)]
+        if ports != [2222, 2224]:
+            failed_tests.append(['first', ports])
+        # locks of other live process are respected
+        port = second.allocate(2222, 2225)
+        if port != 2225:
+            failed_tests.append(['second', port])
+        try:
+            second.allocate(2222, 2225)
+            failed_tests.append(['exhausted', 'no PortError'])
+        except PortError:
+            pass
+        # released port is free again, lock of a dead process is taken over
+        first.release(2224)
+        lock_file = open(os.path.join(lock_dir, '2222'), 'w')
+        lock_file.write('4242\n')
+        lock_file.close()
+        ports = [second.allocate(2222, 2225), second.allocate(2222, 2225)]
+        if ports != [2222, 2224]:
+            failed_tests.append(['takeover', ports])
+        second.release_all()
+        if sorted(os.listdir(lock_dir)) != ['.lock']:
+            failed_tests.append(['release_all', os.listdir(lock_dir)])
+    finally:
+        shutil.rmtree(lock_dir)
+    if failed_tests:
+        raise Exception(
+                 "PortAllocator()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+# fake vbkick - logs start/end of the build to check the concurrency
+FAKE_VBKICK = '''
+echo "start" >> "%(dir)s/events"
+echo "$2 port=$VBKICK_SSH_HOST_PORT ks=${VBKICK_KICKSTART_PORT:-} web=${VBKICK_WEBSERVER_DISABLED:-} proxy=${VBKICK_PROXY_CACHE_PATH-unset}"
+sleep 0.3
+echo "$2 done"
+echo "end" >> "%(dir)s/events"
+[ "$2" != "bad" ]
+'''
+
+class _Bytes(object):
+    """Stream which keeps written bytes, as sys.stdout.buffer."""
+
+    def __init__(self):
+        self.buffer = self
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    def flush(self):
+        pass
+
+def test_build_many():
+    import shutil, tempfile
+    directory = tempfile.mkdtemp()
+    failed_tests = []
+    try:
+        script = os.path.join(directory, 'vbkick')
+        script_file = open(script, 'w')
+        script_file.write(FAKE_VBKICK % {'dir': directory})
+        script_file.close()
+        allocator = PortAllocator(os.path.join(directory, 'ports'),
+                                  is_free=lambda p: True)
+        stream = _Bytes()
+        output = PrefixedOutput(stream, width=3)
+        builds = [Build(name, DEFAULT_DEFINITION)
+                  for name in ('a', 'b', 'bad', 'c')]
+        runner = BuildMany(builds, 2, allocator, (2222, 2321), output,
+                           vbkick=('sh', script), kickstart_port=7122,
+                           proxy_cache='/cache')
+        ok = runner.run()
+        if ok:
+            failed_tests.append(['ok', ok])
+        statuses = [b.status for b in builds]
+        if statuses != [0, 0, 1, 0]:
+            failed_tests.append(['statuses', statuses])
+        # each build has its own port while it runs, two at once
+        ports = [b.ssh_port for b in builds]
+        if len(set(ports[:2])) != 2 or set(ports) - set([2222, 2223]):
+            failed_tests.append(['ports', ports])
+        running = peak = 0
+        events_file = open(os.path.join(directory, 'events'))
+        for event in events_file.read().split():
+            running += event == 'start' and 1 or -1
+            peak = max(peak, running)
+        events_file.close()
+        if peak != 2:
+            failed_tests.append(['concurrency', peak])
+        lines = stream.data.decode('utf-8').splitlines()
+        expected = '[bad] bad port=%d ks=7122 web=1 proxy=/cache' % builds[2].ssh_port
+        if expected not in lines or '[c]   c done' not in lines:
+            failed_tests.append(['output', lines])
+        if os.listdir(allocator.lock_dir) != ['.lock']:
+            failed_tests.append(['locks', os.listdir(allocator.lock_dir)])
+    finally:
+        shutil.rmtree(directory)
+    if failed_tests:
+        raise Exception(
+                 "BuildMany()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_start_server():
+    import shutil, tempfile
+    server_cmd = (sys.executable, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'serve_kickstart.py'))
+    if not os.path.exists(server_cmd[1]):
+        return
+    lock_dir = tempfile.mkdtemp()
+    failed_tests = []
+    try:
+        allocator = PortAllocator(lock_dir)
+        port = allocator.allocate(17122, 17221)
+        stream = _Bytes()
+        proc = start_server(port, PrefixedOutput(stream), server_cmd)
+        try:
+            if port_is_free(port):
+                failed_tests.append(['not listening', port])
+        finally:
+            stop_process(proc)
+        allocator.release(port)
+    finally:
+        shutil.rmtree(lock_dir)
+    if failed_tests:
+        raise Exception(
+                 "start_server()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def self_test():
+    """Tests the port allocation, runs fake builds in parallel and
+    starts the shared webserver.
+    """
+    test_parse()
+    test_port_allocator()
+    test_build_many()
+    test_start_server()
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] VM_NAME[:DEFINITION] ...',
+        description='Builds many VMs in parallel, each with its own ports.')
+    parser.add_option('-j', '--jobs', type='int', default=DEFAULT_JOBS,
+        help='builds running at once [default: %default]')
+    parser.add_option('--ssh-ports', default=DEFAULT_SSH_PORTS, metavar='FIRST-LAST',
+        help='ssh_host_port range [default: %default]')
+    parser.add_option('--kickstart-ports', default=DEFAULT_KICKSTART_PORTS,
+        metavar='FIRST-LAST', help='port range of the shared webserver [default: %default]')
+    parser.add_option('--no-webserver', action='store_true', default=False,
+        help='do not start the shared webserver (kickstart files are served remotely)')
+    parser.add_option('--proxy-cache', default=None, metavar='DIR',
+        help='the shared webserver is a caching HTTP proxy too, responses are kept in DIR')
+    parser.add_option('--proxy-cache-max-size', type='int', default=0, metavar='MB',
+        help='evict least recently used responses over this size, 0 - no limit'
+             ' [default: %default]')
+    parser.add_option('--lock-dir', default=DEFAULT_LOCK_DIR,
+        help='where allocated ports are locked [default: %default]')
+    parser.add_option('--vbkick', default='vbkick',
+        help='vbkick command [default: %default]')
+    parser.add_option('--self-test', action='store_true', default=False,
+        help='run self test and exit')
+    options, args = parser.parse_args(argv)
+    if options.self_test:
+        return options, []
+    if not args:
+        parser.error('at least one VM_NAME is required')
+    if options.jobs < 1:
+        parser.error('--jobs must be positive')
+    try:
+        options.ssh_ports = parse_range(options.ssh_ports)
+        options.kickstart_ports = parse_range(options.kickstart_ports)
+        targets = [parse_target(arg) for arg in args]
+    except ValueError as e:
+        parser.error(str(e))
+    names = [name for name, _ in targets]
+    if len(set(names)) != len(names):
+        parser.error('VM names must be unique')
+    for _, definition in targets:
+        if not os.path.isfile(definition):
+            parser.error('%s does not exist in %s' % (definition, os.getcwd()))
+    return options, targets
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt()
+
+def main(argv):
+    options, targets = parse_args(argv)
+    if options.self_test:
+        self_test()
+        return 0
+    signal.signal(signal.SIGTERM, _terminate)
+    allocator = PortAllocator(os.path.expanduser(options.lock_dir))
+    output = PrefixedOutput(sys.stdout, max(len(name) for name, _ in targets))
+    builds = [Build(name, definition) for name, definition in targets]
+    start = time.time()
+    server = None
+    try:
+        kickstart_port = None
+        proxy_cache = None
+        if not options.no_webserver:
+            kickstart_port = allocator.allocate(*options.kickstart_ports)
+            command = ['serve_kickstart.py']
+            if options.proxy_cache:
+                proxy_cache = os.path.expanduser(options.proxy_cache)
+                command += ['--proxy-cache', proxy_cache,
+                            '--proxy-cache-max-size', '%d' % options.proxy_cache_max_size]
+            server = start_server(kickstart_port, output, command)
+            output.line('kickstart', ('[INFO] webserver has been started on port %d (pid %d)'
+                        % (kickstart_port, server.pid)).encode('utf-8'))
+        runner = BuildMany(builds, options.jobs, allocator, options.ssh_ports,
+                           output, vbkick=(options.vbkick,),
+                           kickstart_port=kickstart_port, proxy_cache=proxy_cache)
+        ok = runner.run()
+    except PortError as e:
+        print('[ERROR] %s' % e)
+        ok = False
+    except KeyboardInterrupt:
+        ok = False
+    finally:
+        if server is not None:
+            stop_process(server)
+        allocator.release_all()
+    print(summary(builds, time.time() - start))
+    if not ok:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
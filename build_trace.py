@@ -0,0 +1,355 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python build_trace.py ~/.vbkick/traces/centos65-build-20140520-091251.jsonl
+python build_trace.py ~/.vbkick/traces/centos65-build-*.jsonl       # compare builds
+python build_trace.py --chrome centos65-build-20140520-091251.jsonl  # writes .json
+
+Note:
+Script works with python 2.6+ and python 3
+Reads build traces written by vbkick when trace_path is set - one
+Chrome trace_event per line:
+
+B/E - begin and end of a phase (download_boot_media, create_box, boot,
+      kickstart_monitoring, transport, exec, export_ovf, ...), end
+      events may carry "bytes" and "status" args
+X   - a spawned tool (VBoxManage, ssh, scp, ...) with its run time,
+      args.phase is the phase it was spawned in
+
+Without options the phases of each trace are summarized - count, seconds,
+spawned tools and MB per phase - and with more traces compared side by
+side. --chrome writes the trace as Chrome trace JSON (chrome://tracing,
+https://ui.perfetto.dev).
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, sys, json, optparse
+
+MB = 1000 * 1000
+
+def read_events(lines):
+    """Returns trace events from JSON /lines/; lines which are not JSON
+    objects (e.g. cut by a killed build) are skipped.
+    """
+    events = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(event, dict) and 'ph' in event and 'ts' in event:
+            events.append(event)
+    return events
+
+def load(path):
+    trace_file = open(path)
+    try:
+        return read_events(trace_file)
+    finally:
+        trace_file.close()
+
+class Phase(object):
+    """One run of a phase, /path/ are names from the action down."""
+
+    def __init__(self, path, start, args):
+        self.path = path
+        self.start = start
+        self.end = None
+        self.args = dict(args)
+        self.spawns = 0
+
+def phases(events):
+    """Returns Phase objects of B/E /events/ (in begin order) with
+    spawned tools (X events) counted in the phase they were spawned in.
+    Phases without an end event end with the last event of the trace.
+    """
+    result = []
+    stack = []
+    last = 0
+    for event in sorted(events, key=lambda event: event['ts']):
+        last = max(last, event['ts'] + event.get('dur', 0))
+        if event['ph'] == 'B':
+            path = tuple(phase.path[-1] for phase in stack) + (event['name'],)
+            phase = Phase(path, event['ts'], event.get('args', {}))
+            result.append(phase)
+            stack.append(phase)
+        elif event['ph'] == 'E' and stack:
+            phase = stack.pop()
+            phase.end = event['ts']
+            phase.args.update(event.get('args', {}))
+        elif event['ph'] == 'X':
+            owner = _spawn_owner(stack, event.get('args', {}).get('phase'))
+            if owner is not None:
+                owner.spawns += 1
+    for phase in result:
+        if phase.end is None:
+            phase.end = last
+    return result
+
+def _spawn_owner(stack, name):
+    # the innermost open phase of that name - tools spawned in pipelines
+    # are written by subshells which know only the phase name
+    for phase in reversed(stack):
+        if phase.path[-1] == name:
+            return phase
+    return stack and stack[-1] or None
+
+def summarize(events):
+    """Returns {path: {'count', 'seconds', 'spawns', 'bytes'}} and the
+    paths in the order they first appeared.
+    """
+    summary = {}
+    order = []
+    for phase in phases(events):
+        if phase.path not in summary:
+            summary[phase.path] = {'count': 0, 'seconds': 0.0, 'spawns': 0, 'bytes': 0}
+            order.append(phase.path)
+        entry = summary[phase.path]
+        entry['count'] += 1
+        entry['seconds'] += (phase.end - phase.start) / 1e6
+        entry['spawns'] += phase.spawns
+        entry['bytes'] += int(phase.args.get('bytes', 0) or 0)
+    # spawns of a phase include spawns of its sub-steps
+    for path in order:
+        for other in order:
+            if len(other) > len(path) and other[:len(path)] == path:
+                summary[path].setdefault('all_spawns', summary[path]['spawns'])
+                summary[path]['all_spawns'] += summary[other]['spawns']
+        summary[path].setdefault('all_spawns', summary[path]['spawns'])
+    return summary, order
+
+def merge_order(orders):
+    """Paths of all traces, each new path after its predecessor."""
+    merged = []
+    for order in orders:
+        previous = None
+        for path in order:
+            if path not in merged:
+                if previous is None:
+                    merged.append(path)
+                else:
+                    position = merged.index(previous) + 1
+                    while (position < len(merged) and len(merged[position]) > len(path)
+                           and merged[position][:len(path) - 1] == path[:-1]):
+                        position += 1
+                    merged.insert(position, path)
+            previous = path
+    return merged
+
+def format_summary(names, summaries, orders):
+    """Text table - one row per phase, one column group per trace;
+    more traces get the time difference between the last and the first.
+    """
+    paths = merge_order(orders)
+    width = max([len('phase')] + [2 * (len(path) - 1) + len(path[-1]) for path in paths]) + 2
+    lines = []
+    if len(summaries) == 1:
+        lines.append('%-*s %5s %10s %7s %10s' % (width, 'phase', 'count', 'sec', 'spawns', 'MB'))
+        summary = summaries[0]
+        for path in paths:
+            entry = summary[path]
+            lines.append('%-*s %5d %10.2f %7d %10.1f' % (
+                width, '  ' * (len(path) - 1) + path[-1], entry['count'],
+                entry['seconds'], entry['all_spawns'], entry['bytes'] / MB))
+        return lines
+    for nr, name in enumerate(names):
+        lines.append('[%d] %s' % (nr + 1, name))
+    header = '%-*s' % (width, 'phase')
+    for nr in range(len(names)):
+        header += ' %10s %7s' % ('[%d] sec' % (nr + 1), 'spawns')
+    lines.append(header + ' %10s %7s' % ('diff sec', 'diff'))
+    for path in paths:
+        row = '%-*s' % (width, '  ' * (len(path) - 1) + path[-1])
+        for summary in summaries:
+            if path in summary:
+                row += ' %10.2f %7d' % (summary[path]['seconds'], summary[path]['all_spawns'])
+            else:
+                row += ' %10s %7s' % ('-', '-')
+        first, last = summaries[0].get(path), summaries[-1].get(path)
+        if first and last:
+            diff = last['seconds'] - first['seconds']
+            if first['seconds']:
+                row += ' %+10.2f %+6d%%' % (diff, diff * 100 / first['seconds'])
+            else:
+                row += ' %+10.2f %7s' % (diff, '-')
+        lines.append(row)
+    return lines
+
+def chrome_trace(events, source=None):
+    """Chrome trace JSON object of the trace /events/ - processes are
+    named after the action (begin event of the outermost phase).
+    """
+    trace_events = list(events)
+    named = set()
+    for event in events:
+        if event['ph'] == 'B' and event['pid'] not in named:
+            named.add(event['pid'])
+            title = 'vbkick %s %s' % (event['name'], event.get('args', {}).get('vm', ''))
+            trace_events.append({'name': 'process_name', 'ph': 'M', 'pid': event['pid'],
+                                 'tid': event['tid'], 'args': {'name': title.strip()}})
+    trace = {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+    if source:
+        trace['otherData'] = {'source': source}
+    return trace
+
+FIXTURE = '''\
+{"name":"build","cat":"phase","ph":"B","ts":1000000,"pid":42,"tid":42,"args":{"vm":"centos65"}}
+{"name":"VBoxManage","cat":"spawn","ph":"X","ts":1000100,"dur":50000,"pid":42,"tid":42,"args":{"phase":"build","status":0}}
+{"name":"download_boot_media","cat":"phase","ph":"B","ts":1100000,"pid":42,"tid":42,"args":{}}
+{"name":"download_media","cat":"phase","ph":"B","ts":1100000,"pid":42,"tid":42,"args":{"url":"http://example.com/boot.iso"}}
+{"name":"download_media.py","cat":"spawn","ph":"X","ts":1100100,"dur":10000000,"pid":42,"tid":42,"args":{"phase":"download_media","status":0}}
+{"name":"download_media","cat":"phase","ph":"E","ts":11100000,"pid":42,"tid":42,"args":{"bytes":417333248}}
+{"name":"download_boot_media","cat":"phase","ph":"E","ts":11200000,"pid":42,"tid":42,"args":{}}
+{"name":"exec","cat":"phase","ph":"B","ts":12000000,"pid":42,"tid":42,"args":{"cmd":"echo 1"}}
+{"name":"ssh","cat":"spawn","ph":"X","ts":12000100,"dur":900000,"pid":42,"tid":43,"args":{"phase":"exec","status":0}}
+{"name":"exec","cat":"phase","ph":"E","ts":13000000,"pid":42,"tid":42,"args":{}}
+{"name":"exec","cat":"phase","ph":"B","ts":13000000,"pid":42,"tid":42,"args":{"cmd":"echo 2"}}
+{"name":"ssh","cat":"spawn","ph":"X","ts":13000100,"dur":400000,"pid":42,"tid":42,"args":{"phase":"exec","status":0}}
+{"name":"exec","cat":"phase","ph":"E","ts":13500000,"pid":42,"tid":42,"args":{}}
+{"name":"kickstart_monitoring","cat":"phase","ph":"B","ts":14000000,"pid":42,"tid":42,"args":{}}
+{"name":"wait_vm.py","cat":"spawn","ph":"X","ts":140
+'''
+
+def test_summary():
+    failed_tests = []
+    events = read_events(FIXTURE.splitlines())
+    # the cut last line is skipped
+    if len(events) != 14:
+        failed_tests.append(['events', len(events)])
+    summary, order = summarize(events)
+    expected_order = [('build',), ('build', 'download_boot_media'),
+                      ('build', 'download_boot_media', 'download_media'),
+                      ('build', 'exec'), ('build', 'kickstart_monitoring')]
+    if order != expected_order:
+        failed_tests.append(['order', order])
+    build = summary.get(('build',), {})
+    # not ended phases end with the last event
+    if (build.get('spawns') != 1 or build.get('all_spawns') != 4
+            or abs(build.get('seconds', 0) - 13.0) > 1e-6):
+        failed_tests.append(['build', build])
+    download = summary.get(('build', 'download_boot_media', 'download_media'), {})
+    if download.get('bytes') != 417333248 or download.get('spawns') != 1:
+        failed_tests.append(['download', download])
+    execs = summary.get(('build', 'exec'), {})
+    # the ssh from a pipeline subshell (tid 43) counts in its phase too
+    if (execs.get('count') != 2 or execs.get('spawns') != 2
+            or abs(execs.get('seconds', 0) - 1.5) > 1e-6):
+        failed_tests.append(['exec', execs])
+    lines = format_summary(['a'], [summary], [order])
+    if len(lines) != 6 or not lines[3].startswith('    download_media '):
+        failed_tests.append(['format', lines])
+    # a second build without the download, with a new phase
+    other = [event for event in events if 'download' not in event['name']]
+    other.append({'name': 'postinstall', 'ph': 'B', 'ts': 13600000, 'pid': 42, 'tid': 42})
+    other.append({'name': 'postinstall', 'ph': 'E', 'ts': 13700000, 'pid': 42, 'tid': 42})
+    other_summary, other_order = summarize(other)
+    lines = format_summary(['a', 'b'], [summary, other_summary], [order, other_order])
+    rows = [line.split()[0] for line in lines[3:]]
+    if rows != ['build', 'download_boot_media', 'download_media', 'exec',
+                'postinstall', 'kickstart_monitoring']:
+        failed_tests.append(['compare rows', rows])
+    if '-' not in lines[4].split() or not lines[3].split()[-1].endswith('%'):
+        failed_tests.append(['compare', lines])
+    if failed_tests:
+        raise Exception(
+                 "summarize()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_chrome_trace():
+    events = read_events(FIXTURE.splitlines())
+    trace = chrome_trace(events, 'x.jsonl')
+    failed_tests = []
+    meta = [event for event in trace['traceEvents'] if event['ph'] == 'M']
+    if len(meta) != 1 or meta[0]['args']['name'] != 'vbkick build centos65':
+        failed_tests.append(['process name', meta])
+    if len(trace['traceEvents']) != len(events) + 1:
+        failed_tests.append(['events', len(trace['traceEvents'])])
+    # must survive a JSON round trip
+    if json.loads(json.dumps(trace)) != trace:
+        failed_tests.append(['json'])
+    if failed_tests:
+        raise Exception(
+                 "chrome_trace()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def self_test():
+    """Tests phase summary, builds comparison and Chrome trace of
+    a recorded build trace.
+    """
+    test_summary()
+    test_chrome_trace()
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] TRACE.jsonl [TRACE.jsonl ...]',
+        description='Summarizes and compares vbkick build traces '
+                    'or converts one to Chrome trace JSON.')
+    parser.add_option('--chrome', action='store_true', default=False,
+        help='write Chrome trace JSON of TRACE instead of the summary')
+    parser.add_option('-o', '--output', default=None, metavar='FILE',
+        help='Chrome trace file [default: TRACE with .json extension]')
+    parser.add_option('-j', '--json', action='store_true', default=False,
+        help='print the summary as JSON')
+    parser.add_option('--self-test', action='store_true', default=False,
+        help='run self test and exit')
+    options, args = parser.parse_args(argv)
+    if options.self_test:
+        return options, args
+    if not args:
+        parser.error('at least one TRACE is required')
+    if options.chrome and len(args) != 1:
+        parser.error('--chrome converts one TRACE')
+    return options, args
+
+def main(argv):
+    options, paths = parse_args(argv)
+    if options.self_test:
+        self_test()
+        return 0
+    try:
+        traces = [load(path) for path in paths]
+    except (IOError, OSError):
+        error = sys.exc_info()[1]
+        print('[ERROR] %s' % error, file=sys.stderr)
+        return 1
+    if options.chrome:
+        output = options.output or os.path.splitext(paths[0])[0] + '.json'
+        chrome_file = open(output, 'w')
+        try:
+            json.dump(chrome_trace(traces[0], os.path.basename(paths[0])), chrome_file)
+        finally:
+            chrome_file.close()
+        return 0
+    summaries, orders = [], []
+    for events in traces:
+        summary, order = summarize(events)
+        summaries.append(summary)
+        orders.append(order)
+    if options.json:
+        print(json.dumps([{'trace': path,
+                           'phases': [dict(summary[phase], phase='/'.join(phase))
+                                      for phase in order]}
+                          for path, summary, order in zip(paths, summaries, orders)],
+                         indent=2, sort_keys=True))
+        return 0
+    for line in format_summary([os.path.basename(path) for path in paths],
+                               summaries, orders):
+        print(line)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
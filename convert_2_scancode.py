@@ -4,12 +4,18 @@
 
 Example usage:
 echo 'Hello World!' | python convert_2_scancode.py
+python convert_2_scancode.py --self-test
 
 Note:
 Script works with python 2.6+ and python 3
 When scancode doesn't exist for given char
 then script exit with code 1 and an error is written to stderr.
 
+The script runs for every boot command typed into a VM, so its start
+is kept short: the self test runs only with --self-test and modules
+needed only by the boot plan cache and JSON records are imported when
+used (see benchmarks/bench_startup.py).
+
 Helpful links - scancodes:
 - basic: http://humbledown.org/files/scancodes.l (http://www.win.tue.nl/~aeb/linux/kbd/scancodes-1.html)
 - make and break codes (c+0x80): http://www.win.tue.nl/~aeb/linux/kbd/scancodes-10.html
@@ -34,13 +40,14 @@ from __future__ import (
     absolute_import, division, print_function, unicode_literals
 )
 
-import sys, re
+import os, sys, re, io, codecs, optparse
 
 DEBUG = 0
 
-# How many metakeys can be in a metakey expression?
-# e.g. '<ShiftAltCtrl5>' has three metakeys.
-MetaKeysInMetaExpression_Max = 4
+# Version of the scancode tables and translation rules.
+# It is a part of the boot plan cache key (see plan_key()),
+# so bump it whenever they change the output for any input.
+SCANCODE_TABLE_VERSION = 2
 
 def _make_scancodes(key_map, str_pattern):
     scancodes = {}
@@ -112,20 +119,101 @@ def get_multi_char_codes():
         scancodes['<%s>' % k] = v
     return scancodes
 
+MULTIPLY_START = '<Multiply('
+# ',times)>' which closes the innermost open '<Multiply('
+multiply_end_regexpr = re.compile(r',[ ]*(\d+)[ ]*\)>')
+
+def parse_multiply(input, final=True):
+    """Parses <Multiply(what,times)> expressions in one left-to-right pass.
+    Returns (parts, length): /parts/ is a list of plain strings
+    and (parts, times) tuples for Multiply expressions,
+    /length/ says how much of /input/ the parts cover.
+    /what/ may hold other Multiply expressions - the first ',times)>'
+    after a non-empty /what/ closes the innermost open expression.
+    An expression still open at a newline or at the end of input
+    is plain text.
+
+    If not /final/, /input/ is only the beginning of the input and
+    parsing stops before the outermost expression which is still open
+    (or before a possible beginning of '<Multiply(' at the very end).
+    """
+    stack = [([], -1)]
+    pos = seg_start = 0
+    end = len(input)
+    while pos < end:
+        c = input[pos]
+        if c == '<' and input.startswith(MULTIPLY_START, pos):
+            _add_text(stack[-1][0], input[seg_start:pos])
+            stack.append(([], pos))
+            pos = seg_start = pos + len(MULTIPLY_START)
+            continue
+        if c == ',' and len(stack) > 1:
+            match = multiply_end_regexpr.match(input, pos)
+            if match and (pos > seg_start or stack[-1][0]):
+                _add_text(stack[-1][0], input[seg_start:pos])
+                parts, _ = stack.pop()
+                stack[-1][0].append((parts, int(match.group(1))))
+                pos = seg_start = match.end()
+                continue
+        if c == '\n' and len(stack) > 1:
+            _add_text(stack[-1][0], input[seg_start:pos])
+            seg_start = pos
+            _unwind_multiply(stack)
+        pos += 1
+    if not final:
+        if len(stack) > 1:
+            # wait for the end of the outermost open expression
+            return stack[0][0], stack[1][1]
+        for keep in range(len(MULTIPLY_START) - 1, 0, -1):
+            if input.endswith(MULTIPLY_START[:keep]):
+                end = max(seg_start, end - keep)
+                break
+    _add_text(stack[-1][0], input[seg_start:end])
+    _unwind_multiply(stack)
+    return stack[0][0], end
+
+def _add_text(parts, text):
+    if text:
+        parts.append(text)
+
+def _unwind_multiply(stack):
+    """Turns all open Multiply expressions on the /stack/ into plain text.
+    """
+    while len(stack) > 1:
+        parts, _ = stack.pop()
+        parent = stack[-1][0]
+        parent.append(MULTIPLY_START)
+        parent.extend(parts)
+
+def _map_text(parts, func):
+    """Returns a copy of /parts/ with func() applied to every plain string.
+    """
+    mapped = []
+    for part in parts:
+        if isinstance(part, tuple):
+            mapped.append((_map_text(part[0], func), part[1]))
+        else:
+            mapped.append(func(part))
+    return mapped
+
+def render_multiply(parts):
+    """Expands parsed Multiply expressions (see parse_multiply())
+    back into plain text; time is linear in the length of the result.
+    """
+    text = []
+    for part in parts:
+        if isinstance(part, tuple):
+            text.append(render_multiply(part[0]) * part[1])
+        else:
+            text.append(part)
+    return ''.join(text)
+
 def process_multiply(input):
     """process <Multiply(what,times)>
     example usage: <Multiply(<Wait>,4)> --> <Wait><Wait><Wait><Wait>
-    key thing about multiply_regexpr: match is non-greedy
-    """
-    multiply_regexpr = '<Multiply\((.+?),[ ]*([\d]+)[ ]*\)>'
-    for match in re.finditer(r'%s' % multiply_regexpr, input):
-        what = match.group(1)
-        times = int(match.group(2))
-        # repeating a string given number of times
-        replacement = what * times
-        # replace Multiply(what,times)> with already created replacement
-        input = input.replace(match.group(0), replacement)
-    return input
+    nested: <Multiply(<Multiply(a,2)>b,2)> --> aabaab
+    """
+    return render_multiply(parse_multiply(input)[0])
 
 def get_metakey_codes():
     """The press and release scancodes for each meta key 
@@ -160,92 +248,232 @@ def de_duplicate(mylist, omit_false=True):
         output.append(x)
     return output
 
-def name_of_ith_meta_group(i):
-    """for constructing the metakey combination regular expression.
+def _make_trie(words):
+    """Builds a character trie (nested dicts) over /words/.
+    The None key of a node holds the word which ends at that node.
     """
-    return 'meta' + str(i)
-
-def create_meta_regex():
-    """Returns a string specifying our regular expression to match
-    a 'meta expression' that specifies a keypress combination
-    including 1 or more meta keys.
-      'meta expression' examples: '<AltTab>', '<CtrlAltDelete>', '<Ctrlc>'
+    trie = {}
+    for word in words:
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[None] = word
+    return trie
+
+def _trie_words_at(trie, text, pos):
+    """Yields (word, end) for every word from /trie/
+    which appears in /text/ starting at /pos/, shortest first.
+    """
+    node = trie
+    end = pos
+    length = len(text)
+    while end < length:
+        node = node.get(text[end])
+        if node is None:
+            return
+        end += 1
+        if None in node:
+            yield node[None], end
+
+# Longest '<...>' expression recognized across chunk boundaries
+# by the streaming translation (see KeyTokenizer.tokens()).
+MAX_TOKEN_LENGTH = 4096
+
+# How many characters translate_iter() reads at once.
+CHUNK_SIZE = 65536
+
+class KeyTokenizer(object):
+    """Splits a string into key tokens and their scancodes
+    in a single left-to-right pass.
+
+    Every scancode table is built once, when the tokenizer is created,
+    and key names are looked up in tries rather than regular expressions,
+    so one tokenizer can be reused for any number of strings.
+    Use get_tokenizer() to get the shared per-process instance.
+
+    Token kinds:
+    - 'sleep' - "<NUMBER>" millisecond expression (only when enabled)
+    - 'meta'  - meta key expression e.g. "<CtrlShiftt>", "<Win>"
+    - 'multi' - multi-character code e.g. "<Enter>"
+    - 'char'  - single character e.g. "n"; its code is None
+                when there is no scancode for that character.
     """
 
-    def escape_key(x):
-        """Return x, 
-        escaped if that is necessary to put it in a re character class.
-        """
-        if x in '<>-[]\?*+,()':
-            return '\\' + x
-        return x
+    def __init__(self):
+        self.onechar_scancodes = get_one_char_codes()
+        self.naked_spc_scancodes = get_naked_multi_char_codes()
+        self.metakey_codes = get_metakey_codes()
+        self._meta_trie = _make_trie(self.metakey_codes)
+        self._naked_trie = _make_trie(self.naked_spc_scancodes)
 
-    def named_meta_group(group_name):
-        """Returns a *named* regular expression 
-        that matches any meta key's name.
+    def _match_naked_name(self, text, pos):
+        """Returns the multi-character code name which starts at /pos/
+        and is directly followed by '>', or None.
+        """
+        for name, end in _trie_words_at(self._naked_trie, text, pos):
+            if text[end:end+1] == '>':
+                return name
+        return None
+
+    def _match_sleep(self, text, pos):
+        """Matches '<NUMBER>' (at least 3 digits) at /pos/."""
+        end = pos + 1
+        length = len(text)
+        while end < length and text[end].isdigit():
+            end += 1
+        if end - pos - 1 < 3 or text[end:end+1] != '>':
+            return None
+        return 'sleep', end + 1, 'sleep:%s' % text[pos+1:end]
+
+    def _match_meta(self, text, pos):
+        """Matches a meta key expression at /pos/.
+        Any number of meta key names may be chained before
+        the optional final non-meta key.
+        """
+        components = []
+        end = pos + 1
+        while True:
+            name = None
+            for name, name_end in _trie_words_at(self._meta_trie, text, end):
+                break
+            if name is None:
+                break
+            components.append(name)
+            end = name_end
+        if not components:
+            return None
+        normal = self._match_naked_name(text, end)
+        if normal is not None:
+            end += len(normal)
+        elif (text[end:end+1] in self.onechar_scancodes
+                and text[end+1:end+2] == '>'):
+            normal = text[end]
+            end += 1
+        if text[end:end+1] != '>':
+            return None
+        components.append(normal)
+        return ('meta', end + 1,
+                self.components_to_scancodes_str(de_duplicate(components)))
+
+    def _match_multi(self, text, pos):
+        """Matches a multi-character code e.g. '<Enter>' at /pos/."""
+        name = self._match_naked_name(text, pos + 1)
+        if name is None:
+            return None
+        return 'multi', pos + len(name) + 2, self.naked_spc_scancodes[name]
+
+    def components_to_scancodes_str(self, components):
+        """Given a list of meta-key keypress components,
+        such as 'Ctrl', 'Shift', etc...
+        possibly ending in a non-meta key such as 'Return' or 't',
+        returns the corresponding scancodes.
+        e.g.
+           ['t'] --> "14 94"
+           ['Ctrl', 'Shift' 't'] --> "1d 2a 14 94 aa 9d"
         """
-        metakey_re = '|'.join([('(%s)' % x) for x in metakey_code_keys]) 
-        return '(?P<%s>%s)' % (group_name, metakey_re)
+        pre, post, center = [], [], []
+        for i, x in enumerate(components):
+            if x in self.metakey_codes:
+                press, release = self.metakey_codes[x]
+                pre.append(press)
+                post.insert(0, release)
+            elif x in self.naked_spc_scancodes:
+                center = [self.naked_spc_scancodes[x]]
+            elif x in self.onechar_scancodes:
+                center = [self.onechar_scancodes[x]]
+            if center and (i+1 < len(components)):
+                # We have leftover components after reaching
+                # what should be the final component
+                # that the other meta keys modify.
+                # It indicates a bug in the code itself.
+                raise Exception(
+                    "Bad metakey press instruction, or software bug: %s" %
+                    ' '.join(components)
+                )
+        return ' '.join(pre + center + post)
+
+    def tokens(self, text, support_millisecond_expressions=False, final=True):
+        """Yields (kind, start, end, code) for each key token in /text/,
+        where text[start:end] is the token.
 
-    def named_meta_groups(count):
-        """Returns a regular expression that matches 1 to /count/
-        metakey names.  
-        Each meta group is named using name_of_ith_meta_group().
+        If not /final/, /text/ is only the beginning of the input and
+        tokens are yielded only while their meaning can not change
+        with more input: a '<' is held (and nothing after it is yielded)
+        until the first '>' after it is followed by one more character.
+        Matching never looks further than that.
+        A '<' with no '>' within MAX_TOKEN_LENGTH characters is not held.
         """
+        pos = 0
+        length = len(text)
+        while pos < length:
+            c = text[pos]
+            if c == '<':
+                if not final:
+                    gt = text.find('>', pos, pos + MAX_TOKEN_LENGTH)
+                    if gt + 1 >= length or (
+                            gt == -1 and length - pos < MAX_TOKEN_LENGTH):
+                        return
+                token = ((support_millisecond_expressions
+                          and self._match_sleep(text, pos))
+                         or self._match_meta(text, pos)
+                         or self._match_multi(text, pos))
+                if token:
+                    kind, end, code = token
+                    yield kind, pos, end, code
+                    pos = end
+                    continue
+            yield 'char', pos, pos + 1, self.onechar_scancodes.get(c)
+            pos += 1
+
+    def is_closed(self, text, support_millisecond_expressions=False):
+        """Tells whether /text/ is tokenized the same whatever follows it,
+        so a Multiply boundary after it can't split a key expression.
+        Only a '<' looks ahead, never further than one character after
+        the first '>' after it - that character matters only for a meta
+        key expression which may end with '>' (e.g. "<Alt>>"), so the
+        last '<...>' is checked once more with '>' appended.
+        """
+        length = len(text)
+        for kind, start, end, code in self.tokens(
+                text, support_millisecond_expressions):
+            if text[start] != '<':
+                continue
+            gt = text.find('>', start + 1)
+            if gt == -1:
+                return False
+            if gt + 1 < length:
+                continue
+            for kind, s, e, code in self.tokens(
+                    text[start:] + '>', support_millisecond_expressions):
+                if e != end - start:
+                    return False
+                break
+        return True
+
+_tokenizer = None
+
+def get_tokenizer():
+    """Returns the KeyTokenizer shared within the process,
+    creating it on first use.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = KeyTokenizer()
+    return _tokenizer
 
-        # first meta group is mandatory.
-        groups = [named_meta_group(name_of_ith_meta_group(0))]
-          
-        # additional meta groups are optional.
-        for i in range(1, count):
-            groups.append(named_meta_group(name_of_ith_meta_group(i)) 
-                          + '?'  # each additional meta_group is optional.
-                         )
-        return ''.join([group for group in groups])
-
-    metakey_codes = get_metakey_codes()
-    metakey_code_keys = list(metakey_codes.keys())
-    metakey_code_keys.sort(reverse=True)
-      # ^ place longer strings before their beginnings,
-      #     e.g. 'Shift' before 'Sh'
-      #     So we can add alternate names (short vs. long) for keys.
-
-    onechar_scancodes = get_one_char_codes()
-    onechar_scancode_keys_escaped = [
-           escape_key(x) for x in onechar_scancodes.keys()]
-
-    naked_spc_scancodes = get_naked_multi_char_codes()
-    naked_spc_scancodes_keys = list(naked_spc_scancodes.keys())
-    naked_spc_scancodes_keys.sort(reverse=True) 
-      # ^ longer strings before their beginnings,
-      #   e.g. 'Spacebar' before 'Sp'
-
-    all_non_meta_scancode_keys = (
-           list(onechar_scancodes.keys()) 
-         + list(naked_spc_scancodes.keys()) 
-        )
-    all_non_meta_scancode_keys_escaped = [
-           escape_key(x) for x in all_non_meta_scancode_keys]
-    pattern = (   r'\<' 
-                + named_meta_groups(MetaKeysInMetaExpression_Max)
-                + '(?P<normal>%s)?' %   # optional non-meta key.
-                  (
-                     '|'.join(  ['(%s)' % x 
-                                 for x in naked_spc_scancodes_keys 
-                                ]
-                                # Some implementations of re 
-                                # don't like >100 groups.  
-                                # So we shove single characters 
-                                # into one set of characters.
-                              + ["[%s]" % 
-                                 ''.join(onechar_scancode_keys_escaped) 
-                                ]
-                             )
-                  )
-
-                + r'\>'
-              )
-    return pattern
+def _mark_tokens(input, keys_array, kind, support_millisecond_expressions):
+    """Marks in keys_array every token of the given kind found in input.
+    """
+    keys_array = ensure_keys_array(input, keys_array)
+    for token_kind, s, e, code in get_tokenizer().tokens(
+            input, support_millisecond_expressions):
+        if token_kind != kind:
+            continue
+        keys_array[s] = code
+        # mark rest pos given match as empty string in keys_array
+        for i in range(s+1, e):
+            keys_array[i] = ''
+    return keys_array
 
 def translate_sleeps(input, keys_array=False):
     """Recognizes sequences of the form '<NUMBER>', 
@@ -263,21 +491,7 @@ def translate_sleeps(input, keys_array=False):
     If you want less than 100 milliseconds, just use leading zero(s),
       e.g. '<050>' for a 50 millisecond sleep.
     """
-
-    keys_array = ensure_keys_array(input, keys_array)
-
-    for match in re.finditer(r'\<(?P<number>\d{3,})\>', input):
-        s = match.start()
-        e = match.end()
-        
-        number_found = match.group('number')
-        if number_found:
-            keys_array[s] = 'sleep:%s' % number_found
-
-            # mark rest pos given match as empty string in keys_array
-            for i in range(s+1, e):
-                 keys_array[i] = ''
-    return keys_array
+    return _mark_tokens(input, keys_array, 'sleep', True)
 
 def ensure_keys_array(input, keys_array=False):
     """Make sure we have list to collect information 
@@ -312,113 +526,12 @@ def translate_meta(input, keys_array=False):
       such as <Win>.  
       (This is significant because 
          e.g. "<Win>t" can differ in intended effect from "<Wint>".)
-    
-    CAVEAT: 
-      There is a limit on how many meta keys you can have 
-        in a single meta key press expression.
-        The limit is MetaKeysInMetaExpression_Max.
-        Why, you may ask?
-        The standard library re module does *not* so easily provide 
-        ordered list of *all* matches 
-        for a named group in a regular expression.  Therefore,
-        instead of using a single group with + suffix for all meta keys,
-        we use each meta key matching group to match one meta key name
-        within the meta expression.
-        This permits us to find and press meta keys in the same order
-        as they occur in the meta keypress expression.
-      If I didn't care about preserving this order,
-        the code could be simpler and avoid this limit.
-      It would surely be possible for me to kludge around 
-        to transcend this limit, but the code would probably become
-        substantially more complicated.
-    
-    POSSIBLE FUTURE CHANGE IDEA:
-      This code (and the regular expression) could be changed
-      to handle non-meta bracketed expressions as a simple case:
-      meta expressions happening to have zero meta keys.
-      However, preserving the older code probably helps to illustrate
-      how convert_2_scancode.py actually works internally
-      when a human is (re)learning this module's inner workings.
-      
-    """
-
-    keys_array = ensure_keys_array(input, keys_array)
-
-    def elective_noise(force_output=False):
-        """When debugging, can be made to print useful debugging info.
-        """
-        if DEBUG or force_output:
-            print ('keys_array:', keys_array)
-
-    metakey_codes = get_metakey_codes()
-    onechar_scancodes = get_one_char_codes()
-    naked_spc_scancodes = get_naked_multi_char_codes()
 
-    def components_to_scancodes_str(components):
-        """Given a list of meta-key keypress components, 
-        such as 'Ctrl', 'Shift', etc...
-        possibly ending in a non-meta key such as 'Return' or 't',
-        returns the corresponding scancodes.
-        e.g. 
-           ['t'] --> "14 94"
-           ['Ctrl', 'Shift' 't'] --> "1d 2a 14 94 aa 9d"
-        """
-        pre, post, center = [], [], []
-        for i, x in enumerate(components):
-            if metakey_codes.get(x, False):
-                 press, release = metakey_codes[x]
-                 pre.append(press)
-                 post.insert(0, release)
-            elif naked_spc_scancodes.get(x, False):
-                 center = [naked_spc_scancodes[x]]
-            elif onechar_scancodes.get(x, False):
-                 center = [onechar_scancodes[x]]
-            if center and (i+1 < len(components)):
-                # Execution has not normally been able to reach this,
-                # because normally a sequence of the form <...>
-                # that doesn't form a valid meta expression
-                # would not be interpreted by translate_meta().
-                # So if the code gets to this point,
-                # it indicates a bug in the code itself, 
-                # which should be exceptional.
-                # 
-                # We have leftover components after reaching 
-                # what should be the final component 
-                # that the other meta keys modify.
-                raise Exception(
-                    "Bad metakey press instruction, or software bug: %s" %
-                    ' '.join(components)
-                )
-        return ' '.join(pre + center + post)
-
-    for match in re.finditer(create_meta_regex(), input):
-        s = match.start()
-        e = match.end()
-        
-        match_groups_deduped = de_duplicate(match.groups())
-
-        if len(match.groups()) >= 100:
-            # Someone changed the source code 
-            # in a way that some Python interpretations won't support!
-            raise Exception(
-                  "Software bug!  Some implementations of python re"
-                  " (regular expressions)"
-                  " library don't support more than 100 groups.")
-
-        # just for cheesy debugging/test.
-        if 0:
-            print (match.groups(), len(match.groups()))
-            print (s, e, match_groups_deduped)
-            print (match.group('meta0'), match.group('meta1'), 
-                   match.group('meta2'), match.group('meta3'), 
-                   match.group('normal'))
-
-        keys_array[s] = \
-           components_to_scancodes_str(match_groups_deduped)
-        # mark rest pos given match as empty string in keys_array
-        for i in range(s+1, e):
-            keys_array[i] = ''
-    return keys_array 
+    Meta keys are pressed in the same order
+      as they occur in the meta keypress expression,
+      and there is no limit on how many of them it may hold.
+    """
+    return _mark_tokens(input, keys_array, 'meta', False)
 
 def translate_chars(input, support_millisecond_expressions=False):
     """Given a string, returns a string of 
@@ -436,57 +549,331 @@ def translate_chars(input, support_millisecond_expressions=False):
         which means to sleep for NUMBER milliseconds.
         This makes sense only to callers written to understand it.
         Only enabled if support_millisecond_expressions is true.
+    The whole string is processed in one pass by get_tokenizer().
     """
+    keys_array = []
+    for kind, s, e, code in get_tokenizer().tokens(
+            input, support_millisecond_expressions):
+        if code is None:
+            _unknown_symbol(input[s])
+        keys_array.append(code)
+    if DEBUG:
+        print ('keys_array:', keys_array)
+    return keys_array
 
-    # see definition of ensure_keys_array()
-    keys_array = ensure_keys_array(input)
+def _unknown_symbol(symbol):
+    sys.stderr.write('Error: Unknown symbol found - %s\n' % repr(symbol))
+    sys.exit(1)
 
-    def elective_noise(force_output=False):
-        """When debugging, can be made to print useful debugging info.
-        """
-        if DEBUG or force_output:
-            print ('keys_array:', keys_array)
-
-    if support_millisecond_expressions:
-        translate_sleeps(input, keys_array)
-
-    translate_meta(input, keys_array)
-
-    # process multi-char codes/marks (special)
-    spc_scancodes = get_multi_char_codes()
-    for spc in spc_scancodes:
-        # find all spc code in input string 
-        # and mark correspondence cells in keys_array
-        for match in re.finditer(spc, input):
-            s = match.start()
-            e = match.end()
-            # mark start pos given match as scancode in keys_array
-            keys_array[s] = spc_scancodes[spc]
-            # mark rest pos given match as empty string in keys_array
-            for i in range(s+1, e):
-                keys_array[i] = ''
-            elective_noise()
-
-    # process single-char codes
-    scancodes = get_one_char_codes()
-    # convert input string to list
-    input = list(input)
-    # check only not assign yet (with value equal -1) cells in keys_array
-    for index, _ in enumerate(keys_array):
-        if keys_array[index] != -1:
-            continue
-        try:
-            keys_array[index] = scancodes[input[index]]
-        except KeyError:
-            sys.stderr.write('Error: Unknown symbol found - %s\n' % repr(input[index]))
-            sys.exit(1)
-        elective_noise()
-
-    # remove any empty strings from keys_array
-    keys_array = [x for x in keys_array if x != '']
-    elective_noise()
+def read_chunks(stream, chunk_size=CHUNK_SIZE):
+    """Yields chunks of text read from the file-like /stream/ until EOF.
+    """
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def translate_chunk_batches(chunks, support_millisecond_expressions=False):
+    """Works like translate_chars() on the concatenation of /chunks/,
+    but yields, for each chunk, the list of scancodes
+    which are already known after reading it.
+    '<...>' expressions split across chunk boundaries are held
+    until they can be translated.
+    """
+    held = ''
+    for chunk in chunks:
+        keys_array, held = _translate_ready(
+            held + chunk, support_millisecond_expressions)
+        yield keys_array
+    yield translate_chars(held, support_millisecond_expressions)
+
+def _translate_ready(text, support_millisecond_expressions):
+    """Translates the beginning of /text/ whose meaning can not change
+    with more input. Returns (keys_array, rest of text).
+    """
+    keys_array = []
+    pos = 0
+    for kind, s, e, code in get_tokenizer().tokens(
+            text, support_millisecond_expressions, final=False):
+        if code is None:
+            _unknown_symbol(text[s])
+        keys_array.append(code)
+        pos = e
+    return keys_array, text[pos:]
+
+def _repeat_keys(keys_array, times):
+    """Compact repeat form of /keys_array/ typed /times/ times:
+    'CODE*N' for a single scancode or pseudocode (e.g. 'wait*5000'),
+    otherwise '(', the scancodes, ')*N'.
+    """
+    if not keys_array or times == 0:
+        return []
+    if times == 1:
+        return keys_array
+    if (len(keys_array) == 1 and ' ' not in keys_array[0]
+            and '*' not in keys_array[0]):
+        return ['%s*%d' % (keys_array[0], times)]
+    return ['('] + keys_array + [')*%d' % times]
+
+def _is_compact_safe(text, what, support_millisecond_expressions=False):
+    """Tells whether a Multiply expression of parsed parts /what/ after
+    /text/ can be given in compact repeat form: /text/ and every run of
+    plain text in /what/ (each is followed by a boundary - the next
+    repetition or what follows the expression) are closed
+    (see KeyTokenizer.is_closed()).
+    """
+    tokenizer = get_tokenizer()
+    if not tokenizer.is_closed(text, support_millisecond_expressions):
+        return False
+    runs = []
+    for part in what:
+        if isinstance(part, tuple):
+            if not _is_compact_safe(''.join(runs), part[0],
+                                    support_millisecond_expressions):
+                return False
+            runs = []
+        else:
+            runs.append(part)
+    return tokenizer.is_closed(''.join(runs), support_millisecond_expressions)
+
+def translate_parts(parts, support_millisecond_expressions=False):
+    """Works like translate_chars() on parsed parts (see parse_multiply()),
+    but every Multiply expression is translated only once and given
+    in compact repeat form (see _repeat_keys()), which callers
+    like send_scancodes.py expand lazily.
+    Plain text between Multiply expressions is translated on its own.
+    A Multiply expression whose boundary would split a key expression
+    (e.g. "<Multiply(<,2)>Enter>") is expanded into the plain text,
+    so the compact form always gives the same keys as the expanded one.
+    """
+    keys_array = []
+    text = []
+    for part in parts:
+        if isinstance(part, tuple):
+            before = ''.join(text)
+            if _is_compact_safe(before, part[0],
+                                support_millisecond_expressions):
+                keys_array.extend(translate_chars(
+                    before, support_millisecond_expressions))
+                text = []
+                keys_array.extend(_repeat_keys(translate_parts(
+                    part[0], support_millisecond_expressions), part[1]))
+                continue
+            part = render_multiply([part])
+        text.append(part)
+    keys_array.extend(translate_chars(
+        ''.join(text), support_millisecond_expressions))
     return keys_array
 
+def translate_part_batches(part_chunks, support_millisecond_expressions=False):
+    """Works like translate_chunk_batches() on lists of parsed parts
+    (see command_part_chunks()), Multiply expressions are given
+    in compact repeat form (see translate_parts()).
+    """
+    held = ''
+    for parts in part_chunks:
+        keys_array = []
+        for part in parts:
+            if isinstance(part, tuple):
+                if _is_compact_safe(held, part[0],
+                                    support_millisecond_expressions):
+                    keys_array.extend(
+                        translate_chars(held, support_millisecond_expressions))
+                    held = ''
+                    keys_array.extend(
+                        translate_parts([part], support_millisecond_expressions))
+                    continue
+                part = render_multiply([part])
+            ready, held = _translate_ready(
+                held + part, support_millisecond_expressions)
+            keys_array.extend(ready)
+        yield keys_array
+    yield translate_chars(held, support_millisecond_expressions)
+
+def translate_iter(stream, support_millisecond_expressions=False,
+                   chunk_size=CHUNK_SIZE):
+    """Generator version of translate_chars() for very large inputs.
+    Reads /stream/ (file-like object) in chunks of /chunk_size/
+    and yields scancodes as soon as they are known,
+    so they can be sent while the input is still being read.
+    """
+    for keys_array in translate_chunk_batches(
+            read_chunks(stream, chunk_size), support_millisecond_expressions):
+        for code in keys_array:
+            yield code
+
+
+def _spacebar(text):
+    # replace white-spaces with <Spacebar>
+    return text.replace(' ', '<Spacebar>')
+
+def translate_command(input, compact=False):
+    """Translates one command the way vbkick types it:
+    expands <Multiply(what,times)>, types white-spaces as <Spacebar>
+    and returns the list of scancodes (see translate_chars()).
+    If /compact/, Multiply expressions are given in compact repeat form
+    (see translate_parts()).
+    """
+    # process multiply
+    parts = _map_text(parse_multiply(input)[0], _spacebar)
+    if compact:
+        return translate_parts(parts)
+    # process keys
+    return translate_chars(render_multiply(parts))
+
+def read_records(data, delimiter='\n', json_lines=False):
+    """Splits /data/ into the list of commands to translate in batch mode.
+    Records are separated by /delimiter/; an empty record after
+    the last delimiter is dropped.
+    If json_lines, every non-empty line is a JSON string holding one record.
+    """
+    if json_lines:
+        import json
+        records = []
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not isinstance(record, type('')):
+                raise ValueError('JSON record is not a string: %s' % line)
+            records.append(record)
+        return records
+    records = data.split(delimiter)
+    if records and records[-1] == '':
+        records.pop()
+    return records
+
+def _rstrip_newline_chunks(chunks):
+    """Yields /chunks/ without the newlines at the very end of the input.
+    """
+    held = ''
+    for chunk in chunks:
+        text = held + chunk
+        stripped = text.rstrip('\n')
+        held = text[len(stripped):]
+        if stripped:
+            yield stripped
+
+def multiply_part_chunks(chunks):
+    """Streaming version of parse_multiply(): yields, for each chunk,
+    the list of parts which are already known after reading it.
+    """
+    held = ''
+    for chunk in chunks:
+        text = held + chunk
+        parts, length = parse_multiply(text, final=False)
+        held = text[length:]
+        yield parts
+    yield parse_multiply(held)[0]
+
+def command_part_chunks(chunks):
+    """Streaming version of the processing translate_command() does
+    before translation: drops newlines at the end of the input,
+    parses <Multiply(what,times)> and types white-spaces as <Spacebar>.
+    Yields lists of parts (see parse_multiply()).
+    """
+    for parts in multiply_part_chunks(_rstrip_newline_chunks(chunks)):
+        yield _map_text(parts, _spacebar)
+
+def command_chunks(chunks):
+    """Like command_part_chunks(), but yields plain text
+    with Multiply expressions expanded.
+    """
+    for parts in command_part_chunks(chunks):
+        text = render_multiply(parts)
+        if text:
+            yield text
+
+def read_fd_chunks(fd, chunk_size=CHUNK_SIZE):
+    """Yields text read from the file descriptor /fd/
+    as soon as it is available (unlike file.read(), which waits
+    for /chunk_size/ characters).
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    while True:
+        data = os.read(fd, chunk_size)
+        text = decoder.decode(data, not data)
+        if text:
+            yield text
+        if not data:
+            return
+
+def translate_batch(records, compact=False):
+    """Yields one line of space-separated scancodes per record,
+    empty records give empty lines.
+    """
+    for record in records:
+        yield ' '.join(translate_command(record, compact))
+
+def plan_key(records, compact=False):
+    """Returns the boot plan cache key for the list of commands /records/:
+    a hash of the commands, the output form and SCANCODE_TABLE_VERSION.
+    """
+    import hashlib
+    digest = hashlib.sha256()
+    digest.update(('%d:%d:' % (SCANCODE_TABLE_VERSION, compact)).encode('ascii'))
+    for record in records:
+        if not isinstance(record, bytes):
+            record = record.encode('utf-8')
+        digest.update(('%d:' % len(record)).encode('ascii') + record)
+    return digest.hexdigest()
+
+def plan_path(cache_dir, records, compact=False):
+    return os.path.join(cache_dir, '%s.plan' % plan_key(records, compact))
+
+def load_plan(cache_dir, records, compact=False):
+    """Returns the scancode lines of the boot plan cached for /records/
+    in /cache_dir/ (see save_plan()), or None when there is no such plan.
+    """
+    import json
+    path = plan_path(cache_dir, records, compact)
+    try:
+        plan_file = open(path)
+    except IOError:
+        return None
+    try:
+        try:
+            plan = json.load(plan_file)
+        except ValueError:
+            return None
+    finally:
+        plan_file.close()
+    # a broken, foreign or colliding plan is ignored (and overwritten later)
+    if (not isinstance(plan, dict)
+            or plan.get('version') != SCANCODE_TABLE_VERSION
+            or plan.get('compact') != bool(compact)
+            or plan.get('commands') != list(records)
+            or not isinstance(plan.get('codes'), list)
+            or len(plan['codes']) != len(records)):
+        return None
+    return plan['codes']
+
+def save_plan(cache_dir, records, lines, compact=False):
+    """Stores the boot plan - the commands and their scancode lines,
+    waits and sleeps included - in /cache_dir/.
+    The plan file is written to a temporary file and renamed,
+    so concurrent builds never see a half written plan.
+    """
+    import json, tempfile
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, tmp_path = tempfile.mkstemp(prefix='.plan-', dir=cache_dir)
+    try:
+        plan_file = os.fdopen(fd, 'w')
+        try:
+            json.dump({'version': SCANCODE_TABLE_VERSION,
+                       'compact': bool(compact),
+                       'commands': list(records),
+                       'codes': list(lines)}, plan_file, indent=1)
+            plan_file.write('\n')
+        finally:
+            plan_file.close()
+        os.rename(tmp_path, plan_path(cache_dir, records, compact))
+    except:
+        os.remove(tmp_path)
+        raise
+
 def test_translate_chars_basic():
     """Tests translate_chars() 
     with argument support_millisecond_expressions=False. 
@@ -510,6 +897,10 @@ def test_translate_chars_basic():
         ['2a 33 b3 aa', '2a 2e ae aa', '14 94', '13 93', '26 a6', 
          '31 b1', '2a 34 b4 aa']),
       ('<Spacebar>', ['39 b9']),
+      ('<CtrlShiftAltWinx>', ['1d 2a 38 e0 5b 2d ad e0 db b8 aa 9d']),
+      ('<CtrlShiftAltRCtrlWinx>',
+        ['1d 2a 38 E0 1D e0 5b 2d ad e0 db E0 9D b8 aa 9d']),
+      ('<VT11><VT1>', ['38 e0 1d 45 b8 e0 9d c5', '38 e0 1d 3b b8 e0 9d bb']),
     ]
 
     failed_tests = []
@@ -565,29 +956,276 @@ def test_translate_chars_with_millisecond_expressions():
         )
 
 
+def test_translate_batch():
+    """Tests read_records() and translate_batch().
+    """
+    test_data = [
+      ('ls\n<Enter>\n', '\n', False, ['26 a6 1f 9f', '1c 9c']),
+      ('a b\0\0<Wait>', '\0', False, ['1e 9e 39 b9 30 b0', '', 'wait']),
+      ('"x\\u0020y"\n\n"<Multiply(1,2)>"\n', '\n', True,
+        ['2d ad 39 b9 15 95', '02 82 02 82']),
+    ]
+
+    failed_tests = []
+    for data, delimiter, json_lines, lines in test_data:
+        translated = list(translate_batch(
+            read_records(data, delimiter, json_lines)))
+        if translated != lines:
+             failed_tests.append([data, translated])
+    if failed_tests:
+        raise Exception(
+                 "translate_batch()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_translate_iter():
+    """Tests that translate_iter() gives the same results
+    as translate_chars() whatever the chunk size is.
+    """
+    test_data = [
+      '<Win><Wait>gedit<333><Enter>',
+      '<CtrlShiftt>ls<Lt>Ctrln>',
+      '<Ctrl>>a<Ctrl<>b<Alt',
+      '<VT1><VT11><12345><Spacebar>',
+    ]
+
+    failed_tests = []
+    for input_ in test_data:
+        for support_millisecond_expressions in (False, True):
+            scancodes = translate_chars(input_, support_millisecond_expressions)
+            for chunk_size in (1, 2, 3, 5, 64):
+                translated = list(translate_iter(io.StringIO(input_),
+                    support_millisecond_expressions, chunk_size))
+                if translated != scancodes:
+                     failed_tests.append([input_, chunk_size, translated])
+    for input_ in ['a <Multiply(b, 3)>\n\n', 'x<Multiply(<Wait>,2)>y<Multi']:
+        expected = translate_command(input_.rstrip('\n'))
+        for chunk_size in (1, 4, 64):
+            translated = []
+            for keys_array in translate_chunk_batches(command_chunks(
+                    read_chunks(io.StringIO(input_), chunk_size))):
+                translated.extend(keys_array)
+            if translated != expected:
+                 failed_tests.append([input_, chunk_size, translated])
+            translated = []
+            for keys_array in translate_part_batches(command_part_chunks(
+                    read_chunks(io.StringIO(input_), chunk_size))):
+                translated.extend(keys_array)
+            if translated != translate_command(input_.rstrip('\n'), True):
+                 failed_tests.append([input_, chunk_size, translated])
+    if failed_tests:
+        raise Exception(
+                 "translate_iter()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_process_multiply():
+    """Tests process_multiply() and compact translation of Multiply.
+    """
+    test_data = [
+      ('<Multiply(<Wait>,4)>', '<Wait><Wait><Wait><Wait>'),
+      ('<Multiply(H, 3)> VM', 'HHH VM'),
+      ('<Multiply(<Multiply(a,2)>b,2)>', 'aabaab'),
+      ('<Multiply(a,0)>b<Multiply(,2)>', 'b<Multiply(,2)>'),
+      ('<Multiply(a\n,2)>', '<Multiply(a\n,2)>'),
+      ('<Multiply(a,2)', '<Multiply(a,2)'),
+    ]
+    test_data_compact = [
+      ('<Multiply(<Wait>,5000)>', ['wait*5000']),
+      ('<Multiply(a b,2)>', ['(', '1e 9e', '39 b9', '30 b0', ')*2']),
+      ('<Multiply(<Multiply(<Wait>,2)><Enter>,3)>',
+        ['(', 'wait*2', '1c 9c', ')*3']),
+      ('x<Multiply(y,1)>', ['2d ad', '15 95']),
+    ]
+
+    failed_tests = []
+    for input_, expanded in test_data:
+        processed = process_multiply(input_)
+        if processed != expanded:
+             failed_tests.append([input_, processed])
+    for input_, scancodes in test_data_compact:
+        translated = translate_command(input_, compact=True)
+        if translated != scancodes:
+             failed_tests.append([input_, translated])
+    if failed_tests:
+        raise Exception(
+                 "process_multiply()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_plan_cache():
+    """Tests save_plan() and load_plan().
+    """
+    import shutil, tempfile
+    failed_tests = []
+    cache_dir = tempfile.mkdtemp()
+    try:
+        records = ['ls', '<Enter><Wait>']
+        lines = list(translate_batch(records, True))
+        if load_plan(cache_dir, records, True) is not None:
+             failed_tests.append(['empty cache', records])
+        save_plan(cache_dir, records, lines, True)
+        for cached_records, compact, expected in [
+              (records, True, lines),
+              (records, False, None),
+              (['ls'], True, None),
+              (['ls', '<Enter>', '<Wait>'], True, None)]:
+            cached = load_plan(cache_dir, cached_records, compact)
+            if cached != expected:
+                 failed_tests.append([cached_records, compact, cached])
+        if plan_key(['a', 'b']) == plan_key(['ab']):
+             failed_tests.append(['plan_key()', ['a', 'b']])
+    finally:
+        shutil.rmtree(cache_dir)
+    if failed_tests:
+        raise Exception(
+                 "load_plan()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def _expand_compact(keys_array):
+    """Expands the compact repeat form of translate_parts() (as
+    send_scancodes.py does) - used by test_translate_compact().
+    """
+    stack = [[]]
+    for code in keys_array:
+        if code == '(':
+            stack.append([])
+        elif code.startswith(')*'):
+            group = stack.pop()
+            stack[-1].extend(group * int(code[2:]))
+        elif '*' in code:
+            code, times = code.rsplit('*', 1)
+            stack[-1].extend([code] * int(times))
+        else:
+            stack[-1].append(code)
+    return stack[0]
+
+def test_translate_compact():
+    """Checks that compact output of translate_command() gives the same
+    keys as the expanded one, also when a key expression straddles
+    a Multiply boundary (those Multiply expressions are expanded).
+    """
+    test_data = [
+      ('<Multiply(<Wait>,3)>', ['wait*3']),
+      ('<Multiply(a<Multiply(<Wait>,2)>,3)>', ['(', '1e 9e', 'wait*2', ')*3']),
+      ('<Multiply(<Enter>,2)>>', ['(', '1c 9c', ')*2', '2a 34 b4 aa']),
+      ('<Multiply(<,2)>Enter>', ['2a 33 b3 aa', '1c 9c']),
+      ('<Multiply(Tab><,3)>', None),
+      ('<Alt><Multiply(>,2)>', ['38 2a 34 b4 aa b8', '2a 34 b4 aa']),
+      ('<Multiply(<Alt>,2)>>', ['38 b8', '38 2a 34 b4 aa b8']),
+      ('<Multiply(<Ctrl,2)>t>', None),
+      ('<<Multiply(Enter>,2)>', None),
+      ('a<Multiply(b<Multiply(<,2)>Tab>,2)>', None),
+    ]
+    failed_tests = []
+    for input, expected in test_data:
+        result = translate_command(input, compact=True)
+        if (_expand_compact(result) != translate_command(input)
+                or expected is not None and result != expected):
+             failed_tests.append([input, result])
+    # the same in the streaming translation, Multiply split across chunks
+    for input, expected in test_data:
+        for size in (1, 2, 5):
+            chunks = [input[i:i+size] for i in range(0, len(input), size)]
+            result = []
+            for keys_array in translate_part_batches(
+                    command_part_chunks(chunks)):
+                result.extend(keys_array)
+            if _expand_compact(result) != translate_command(input):
+                 failed_tests.append([input, size, result])
+    if failed_tests:
+        raise Exception(
+                 "translate_command(compact=True)"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
 def self_test():
     """Tests translate_chars(). 
     To test most of this module's functionality in a version of Python,
     you can start up the appropriate python interpreter,
-    import this module, and run this function.
+    import this module, and run this function
+    (or run the script with --self-test).
     """
     test_translate_chars_basic()
     test_translate_chars_with_millisecond_expressions()
+    test_translate_batch()
+    test_translate_iter()
+    test_process_multiply()
+    test_translate_compact()
+    test_plan_cache()
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] < input',
+        description='Converts text read from stdin to keyboard scancodes.'
+                    ' By default the whole input is one command'
+                    ' and one line of scancodes is written to stdout.')
+    parser.add_option('-b', '--batch', action='store_true', default=False,
+        help='translate many commands in one run: each input record'
+             ' gives one line of scancodes (records are newline-delimited'
+             ' by default)')
+    parser.add_option('-0', '--null', action='store_true', default=False,
+        help='batch records are NUL-delimited')
+    parser.add_option('-j', '--json', action='store_true', default=False,
+        help='batch records are JSON strings, one per line')
+    parser.add_option('-c', '--compact', action='store_true', default=False,
+        help='write <Multiply(what,times)> in compact repeat form:'
+             ' CODE*N or ( CODES )*N - understood by send_scancodes.py,'
+             ' not by VBoxManage')
+    parser.add_option('-p', '--plan-cache', default=None, metavar='DIR',
+        help='batch mode: reuse the boot plan stored in DIR for the same'
+             ' commands instead of translating them, store it otherwise')
+    parser.add_option('--self-test', action='store_true', default=False,
+        help='run self test and exit')
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+    if (options.null or options.json) and not options.batch:
+        parser.error('--null and --json require --batch')
+    if options.null and options.json:
+        parser.error('--null and --json are mutually exclusive')
+    if options.plan_cache and not options.batch:
+        parser.error('--plan-cache requires --batch')
+    return options
+
+def main(argv):
+    options = parse_args(argv)
+    if options.self_test:
+        self_test()
+        return
+    if options.batch:
+        delimiter = options.null and '\0' or '\n'
+        records = read_records(sys.stdin.read(), delimiter, options.json)
+        lines = None
+        if options.plan_cache:
+            lines = load_plan(options.plan_cache, records, options.compact)
+        if lines is None:
+            lines = list(translate_batch(records, options.compact))
+            if options.plan_cache:
+                save_plan(options.plan_cache, records, lines, options.compact)
+        else:
+            sys.stderr.write('[INFO] boot plan %s loaded from %s\n' % (
+                plan_key(records, options.compact)[:12], options.plan_cache))
+        for line in lines:
+            print(line)
+        return
+    # read from stdin and write scancodes to stdout as soon as they are known
+    chunks = read_fd_chunks(sys.stdin.fileno())
+    if options.compact:
+        batches = translate_part_batches(command_part_chunks(chunks))
+    else:
+        batches = translate_chunk_batches(command_chunks(chunks))
+    separator = ''
+    for keys_array in batches:
+        if keys_array:
+            sys.stdout.write(separator + ' '.join(keys_array))
+            sys.stdout.flush()
+            separator = ' '
+    sys.stdout.write('\n')
 
 if __name__ == "__main__":
-    self_test()  # cheap at twice the price.
-    # read from stdin
-    input = sys.stdin.readlines()
-    # convert input list to string
-    input = ''.join(input).rstrip('\n')
-    # process multiply
-    input = process_multiply(input)
-    # replace white-spaces with <Spacebar>
-    input = input.replace(' ', '<Spacebar>')
-    # process keys
-    keys_array = translate_chars(input)
-    # write result to stdout
-    print(' '.join(keys_array))
+    main(sys.argv[1:])
 
 #  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
 # Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
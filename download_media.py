@@ -0,0 +1,638 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python download_media.py --url http://example.com/boot.iso iso/boot.iso
+python download_media.py --checksum-type sha256 iso/boot.iso
+python download_media.py --cache ~/.vbkick/media --url http://example.com/boot.iso iso/boot.iso
+python download_media.py --cache ~/.vbkick/media --cache-list
+
+Note:
+Script works with python 2.6+ and python 3
+Downloads boot media (when FILE doesn't exist yet) and writes the
+--checksum-type digest of FILE to stdout.
+
+The digest is computed while bytes stream in, so a downloaded file
+is never read again. An interrupted download is kept in FILE.part and
+resumed with an HTTP Range request next time.
+Digests are stored in the FILE.digest sidecar together with the file
+size and mtime, later runs only read the file when it has changed.
+
+With --cache DIR media is shared between definitions: files are stored
+once under DIR/<checksum_type>/<digest> and deployed by reflink, hardlink
+or (across filesystems) copy. The least recently used files are removed
+when the cache grows over --cache-max-size.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, sys, json, time, errno, shutil, socket, hashlib, optparse
+import threading
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+    from http.client import HTTPException
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError, URLError
+    from httplib import HTTPException
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_CHECKSUM_TYPE = 'sha256'
+PART_SUFFIX = '.part'
+SIDECAR_SUFFIX = '.digest'
+CACHE_META_SUFFIX = '.meta'
+# linux ioctl to share extents between files (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+class DownloadError(Exception):
+    pass
+
+def sidecar_path(path):
+    return path + SIDECAR_SUFFIX
+
+def _stat_key(path):
+    st = os.stat(path)
+    return st.st_size, int(st.st_mtime)
+
+def load_sidecar(path):
+    """Returns {checksum_type: digest} stored for /path/,
+    empty when there is no sidecar or the file has changed since.
+    """
+    try:
+        sidecar_file = open(sidecar_path(path))
+    except IOError:
+        return {}
+    try:
+        try:
+            sidecar = json.load(sidecar_file)
+        except ValueError:
+            return {}
+    finally:
+        sidecar_file.close()
+    if (not isinstance(sidecar, dict)
+            or (sidecar.get('size'), sidecar.get('mtime')) != _stat_key(path)):
+        return {}
+    return sidecar.get('digests') or {}
+
+def save_sidecar(path, digests):
+    """Stores /digests/ of /path/ with its current size and mtime."""
+    size, mtime = _stat_key(path)
+    sidecar_file = open(sidecar_path(path), 'w')
+    try:
+        json.dump({'size': size, 'mtime': mtime, 'digests': digests},
+                  sidecar_file, indent=1, sort_keys=True)
+        sidecar_file.write('\n')
+    finally:
+        sidecar_file.close()
+
+def hash_file(path, checksum_type, chunk_size=CHUNK_SIZE):
+    digest = hashlib.new(checksum_type)
+    media_file = open(path, 'rb')
+    try:
+        while True:
+            data = media_file.read(chunk_size)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        media_file.close()
+    return digest
+
+def file_digest(path, checksum_type=DEFAULT_CHECKSUM_TYPE):
+    """Returns the hex digest of /path/. The file is read only when
+    the sidecar doesn't hold an up-to-date digest of this type.
+    """
+    digests = load_sidecar(path)
+    if checksum_type not in digests:
+        digests[checksum_type] = hash_file(path, checksum_type).hexdigest()
+        save_sidecar(path, digests)
+    return digests[checksum_type]
+
+def _open_url(url, offset, insecure=False):
+    request = Request(url)
+    if offset:
+        request.add_header('Range', 'bytes=%d-' % offset)
+    kwargs = {}
+    if insecure and url.startswith('https:'):
+        import ssl
+        if hasattr(ssl, '_create_unverified_context'):
+            kwargs['context'] = ssl._create_unverified_context()
+    return urlopen(request, **kwargs)
+
+def download(url, path, checksum_type=DEFAULT_CHECKSUM_TYPE, insecure=False,
+             log=sys.stderr, chunk_size=CHUNK_SIZE):
+    """Downloads /url/ to /path/ computing its digest on the way.
+    Bytes already in path.part are kept and only the rest is requested.
+    Returns the hex digest, which is also stored in the sidecar.
+    """
+    part = path + PART_SUFFIX
+    offset = 0
+    digest = hashlib.new(checksum_type)
+    if os.path.exists(part):
+        offset = os.path.getsize(part)
+        # the kept bytes are read once to resume the digest
+        digest = hash_file(part, checksum_type)
+    try:
+        response = _open_url(url, offset, insecure)
+    except HTTPError as e:
+        if e.code != 416 or not offset:
+            raise DownloadError('%s status code is %d' % (url, e.code))
+        # nothing more to get - path.part is complete
+        response = None
+    except URLError as e:
+        raise DownloadError('%s - %s' % (url, e.reason))
+    start = time.time()
+    received = 0
+    if response is not None:
+        try:
+            status = response.getcode()
+            if status == 200 and offset:
+                # Range not supported - start again
+                log.write('[WARNING] %s does not support resume\n' % url)
+                offset = 0
+                digest = hashlib.new(checksum_type)
+            elif status not in (200, 206):
+                raise DownloadError('%s status code is %d' % (url, status))
+            elif offset:
+                log.write('[INFO] resuming %s at %d bytes\n' % (url, offset))
+            media_file = open(part, offset and 'ab' or 'wb')
+            try:
+                while True:
+                    try:
+                        data = response.read(chunk_size)
+                    except (HTTPException, socket.error) as e:
+                        raise DownloadError('%s - %r after %d bytes,'
+                            ' run again to resume' % (url, e, received))
+                    if not data:
+                        break
+                    media_file.write(data)
+                    digest.update(data)
+                    received += len(data)
+            finally:
+                media_file.close()
+        finally:
+            response.close()
+        length = response.headers.get('Content-Length')
+        if length is not None and received != int(length):
+            raise DownloadError('%s - got %d of %s bytes, run again to resume'
+                                % (url, received, length))
+    os.rename(part, path)
+    seconds = max(time.time() - start, 1e-6)
+    log.write('[INFO] %s: %d bytes downloaded in %.1f sec (%.2f MB/s)\n'
+              % (path, received, seconds, received / seconds / 1e6))
+    hexdigest = digest.hexdigest()
+    save_sidecar(path, {checksum_type: hexdigest})
+    return hexdigest
+
+def _reflink(src, dest):
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflink is not supported')
+    import fcntl
+    src_file = open(src, 'rb')
+    try:
+        dest_file = open(dest, 'wb')
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+        finally:
+            dest_file.close()
+    except (IOError, OSError):
+        if os.path.exists(dest):
+            os.remove(dest)
+        raise
+    finally:
+        src_file.close()
+
+def clone_file(src, dest, hardlink=True):
+    """Creates /dest/ with the content of /src/ without copying bytes when
+    possible. Returns the method used: 'reflink', 'hardlink' or 'copy'.
+    Hardlinks share the inode, so they are not used (/hardlink/ is False)
+    when /dest/ may be written to, e.g. a disk image attached as hdd.
+    """
+    tmp = '%s.%d.tmp' % (dest, os.getpid())
+    try:
+        try:
+            _reflink(src, tmp)
+            method = 'reflink'
+        except (IOError, OSError):
+            method = None
+        if method is None and hardlink:
+            try:
+                os.link(src, tmp)
+                method = 'hardlink'
+            except (AttributeError, OSError):
+                pass
+        if method is None:
+            shutil.copyfile(src, tmp)
+            method = 'copy'
+        os.rename(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return method
+
+def write_json(path, data):
+    """Writes /data/ to the JSON file /path/ atomically - other processes
+    and threads see the old file or the new one, never a part of it.
+    """
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    json_file = open(tmp, 'w')
+    try:
+        json.dump(data, json_file, indent=1, sort_keys=True)
+        json_file.write('\n')
+    finally:
+        json_file.close()
+    os.rename(tmp, path)
+
+class MediaCache(object):
+    """Host-wide, content-addressed store of boot media.
+    A file lives in /path/<checksum_type>/<digest>, next to its digest
+    sidecar (which detects in-place changes) and a .meta file with the
+    source url, original name and last use time (for LRU eviction).
+    """
+
+    def __init__(self, path, max_size=0, clock=time.time):
+        self.path = path
+        # bytes, 0 - no limit
+        self.max_size = max_size
+        self.clock = clock
+
+    def object_path(self, checksum_type, digest):
+        return os.path.join(self.path, checksum_type, digest)
+
+    def _read_meta(self, obj):
+        try:
+            meta_file = open(obj + CACHE_META_SUFFIX)
+        except IOError:
+            return {}
+        try:
+            try:
+                return json.load(meta_file)
+            except ValueError:
+                return {}
+        finally:
+            meta_file.close()
+
+    def entries(self):
+        """Returns cached files as dicts, least recently used first."""
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for checksum_type in sorted(os.listdir(self.path)):
+            type_dir = os.path.join(self.path, checksum_type)
+            if not os.path.isdir(type_dir):
+                continue
+            for name in sorted(os.listdir(type_dir)):
+                if '.' in name:
+                    continue
+                obj = os.path.join(type_dir, name)
+                meta = self._read_meta(obj)
+                st = os.stat(obj)
+                entries.append({
+                    'path': obj, 'checksum_type': checksum_type,
+                    'digest': name, 'size': st.st_size, 'links': st.st_nlink,
+                    'url': meta.get('url'), 'name': meta.get('name'),
+                    'last_used': meta.get('last_used', st.st_mtime),
+                })
+        entries.sort(key=lambda entry: entry['last_used'])
+        return entries
+
+    def remove(self, obj):
+        for path in (obj, sidecar_path(obj), obj + CACHE_META_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _touch(self, obj, url=None, name=None):
+        meta = self._read_meta(obj)
+        if url:
+            meta['url'] = url
+        if name:
+            meta['name'] = name
+        meta['last_used'] = self.clock()
+        write_json(obj + CACHE_META_SUFFIX, meta)
+
+    def lookup(self, checksum_type, digest=None, url=None):
+        """Returns the cached file with /digest/ (or downloaded from /url/
+        when the digest isn't known), None on a miss. A file changed since
+        it was stored is removed from the cache.
+        """
+        if digest is None:
+            for entry in self.entries():
+                if entry['url'] == url and entry['checksum_type'] == checksum_type:
+                    digest = entry['digest']
+            if digest is None:
+                return None
+        obj = self.object_path(checksum_type, digest.lower())
+        if not os.path.exists(obj):
+            return None
+        if load_sidecar(obj).get(checksum_type) != digest.lower():
+            self.remove(obj)
+            return None
+        self._touch(obj, url)
+        return obj
+
+    def store(self, path, checksum_type, digest, url=None, hardlink=True):
+        """Adds /path/ to the cache and evicts old files over max_size."""
+        obj = self.object_path(checksum_type, digest)
+        if not os.path.isdir(os.path.dirname(obj)):
+            os.makedirs(os.path.dirname(obj))
+        if load_sidecar(obj).get(checksum_type) != digest:
+            clone_file(path, obj, hardlink)
+            save_sidecar(obj, {checksum_type: digest})
+        self._touch(obj, url, os.path.basename(path))
+        self.prune(keep=obj)
+        return obj
+
+    def prune(self, keep=None):
+        """Removes the least recently used files until the cache fits in
+        max_size. Returns the removed entries.
+        """
+        entries = self.entries()
+        total = sum(entry['size'] for entry in entries)
+        removed = []
+        for entry in entries:
+            if not self.max_size or total <= self.max_size:
+                break
+            if entry['path'] == keep:
+                continue
+            self.remove(entry['path'])
+            total -= entry['size']
+            removed.append(entry)
+        return removed
+
+def fetch(url, path, checksum_type=DEFAULT_CHECKSUM_TYPE, checksum=None,
+          cache=None, hardlink=True, insecure=False, log=sys.stderr):
+    """Creates /path/ from the cache or by downloading /url/ (the
+    download is then added to the cache). Returns the hex digest.
+    """
+    if cache is not None:
+        obj = cache.lookup(checksum_type, checksum, url)
+        if obj is not None:
+            method = clone_file(obj, path, hardlink)
+            digest = os.path.basename(obj)
+            save_sidecar(path, {checksum_type: digest})
+            log.write('[INFO] %s: %s from media cache %s\n'
+                      % (path, method == 'copy' and 'copied' or method + 'ed', obj))
+            return digest
+    if not url:
+        raise DownloadError('%s does not exist and no --url is given' % path)
+    digest = download(url, path, checksum_type, insecure, log)
+    if cache is not None:
+        cache.store(path, checksum_type, digest, url, hardlink)
+    return digest
+
+def print_cache(cache, out=sys.stdout):
+    entries = cache.entries()
+    total = 0
+    for entry in reversed(entries):
+        total += entry['size']
+        out.write('%10.1f MB  %s  %d link(s)  %s:%s  %s\n' % (
+            entry['size'] / 1e6,
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_used'])),
+            entry['links'], entry['checksum_type'], entry['digest'][:16],
+            entry['url'] or entry['name'] or '-'))
+    limit = cache.max_size and '%.1f MB' % (cache.max_size / 1e6) or 'no limit'
+    out.write('%d file(s), %.1f MB in %s (%s)\n'
+              % (len(entries), total / 1e6, cache.path, limit))
+
+def test_media_cache():
+    """Checks store/lookup by digest and url, deployment, detection of
+    changed files, LRU eviction and fetch() cache hits.
+    """
+    import io, tempfile
+    tmp_dir = tempfile.mkdtemp()
+    failed_tests = []
+    now = [1000.0]
+    try:
+        cache = MediaCache(os.path.join(tmp_dir, 'cache'), 250,
+                           clock=lambda: now[0])
+        paths = []
+        for name, payload in (('a.iso', b'a' * 100), ('b.iso', b'b' * 100)):
+            path = os.path.join(tmp_dir, name)
+            media_file = open(path, 'wb')
+            media_file.write(payload)
+            media_file.close()
+            paths.append(path)
+            cache.store(path, 'sha1', hash_file(path, 'sha1').hexdigest(),
+                        'http://example.com/' + name)
+            now[0] += 1
+        digest_a = hashlib.sha1(b'a' * 100).hexdigest()
+        digest_b = hashlib.sha1(b'b' * 100).hexdigest()
+        if cache.lookup('sha1', digest_a) != cache.object_path('sha1', digest_a):
+            failed_tests.append(['lookup', 'digest'])
+        if cache.lookup('sha1', url='http://example.com/b.iso') is None:
+            failed_tests.append(['lookup', 'url'])
+        if cache.lookup('sha1', url='http://example.com/c.iso') is not None:
+            failed_tests.append(['lookup', 'unknown url'])
+        # a.iso was used before b.iso, so b.iso is evicted first
+        now[0] += 1
+        cache.lookup('sha1', digest_a)
+        media_file = open(os.path.join(tmp_dir, 'c.iso'), 'wb')
+        media_file.write(b'c' * 100)
+        media_file.close()
+        cache.store(os.path.join(tmp_dir, 'c.iso'), 'sha1',
+                    hashlib.sha1(b'c' * 100).hexdigest())
+        if sorted(entry['name'] for entry in cache.entries()) != ['a.iso', 'c.iso']:
+            failed_tests.append(['prune', cache.entries()])
+        # fetch() never touches the url on a hit
+        log = io.StringIO()
+        dest = os.path.join(tmp_dir, 'deployed.iso')
+        digest = fetch('http://127.0.0.1:1/never', dest, 'sha1', digest_a,
+                       cache, hardlink=False, log=log)
+        media_file = open(dest, 'rb')
+        if (digest != digest_a or media_file.read() != b'a' * 100
+                or load_sidecar(dest) != {'sha1': digest_a}):
+            failed_tests.append(['fetch', digest, log.getvalue()])
+        media_file.close()
+        # a cached file changed in place is dropped
+        obj = cache.object_path('sha1', digest_a)
+        media_file = open(obj, 'ab')
+        media_file.write(b'x')
+        media_file.close()
+        os.utime(obj, (0, 0))
+        if cache.lookup('sha1', digest_a) is not None or os.path.exists(obj):
+            failed_tests.append(['lookup', 'changed file'])
+        if cache.lookup('sha1', digest_b) is not None:
+            failed_tests.append(['lookup', 'evicted file'])
+    finally:
+        shutil.rmtree(tmp_dir)
+    if failed_tests:
+        raise Exception(
+                 "MediaCache"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_download():
+    """Downloads from a local HTTP stand-in which breaks the first
+    connection in the middle, and checks resume, digest and sidecar.
+    """
+    import io, tempfile
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    payload = b''.join(bytes(bytearray([i % 251])) for i in range(300000))
+    requests = []
+
+    class StandIn(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.headers.get('Range'))
+            first = 0
+            if self.headers.get('Range'):
+                first = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+                if first >= len(payload):
+                    self.send_response(416)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+            else:
+                self.send_response(200)
+            body = payload[first:]
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if len(requests) == 1:
+                # interrupted download
+                body = body[:len(body) // 2]
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), StandIn)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d/boot.iso' % server.server_address[1]
+    tmp_dir = tempfile.mkdtemp()
+    failed_tests = []
+    try:
+        path = os.path.join(tmp_dir, 'boot.iso')
+        log = io.StringIO()
+        try:
+            download(url, path, 'sha1', log=log, chunk_size=4096)
+            failed_tests.append(['interrupted download', 'no DownloadError'])
+        except DownloadError:
+            pass
+        digest = download(url, path, 'sha1', log=log, chunk_size=4096)
+        media_file = open(path, 'rb')
+        downloaded = media_file.read()
+        media_file.close()
+        if (downloaded != payload or requests != [None, 'bytes=150000-']
+                or digest != hashlib.sha1(payload).hexdigest()):
+            failed_tests.append(['resume', requests, digest])
+        if load_sidecar(path) != {'sha1': digest}:
+            failed_tests.append(['sidecar', load_sidecar(path)])
+        if file_digest(path, 'md5') != hashlib.md5(payload).hexdigest():
+            failed_tests.append(['file_digest', 'md5'])
+        if sorted(load_sidecar(path)) != ['md5', 'sha1']:
+            failed_tests.append(['sidecar', load_sidecar(path)])
+        # a changed file is hashed again
+        media_file = open(path, 'ab')
+        media_file.write(b'x')
+        media_file.close()
+        os.utime(path, (0, 0))
+        if file_digest(path, 'sha1') != hashlib.sha1(payload + b'x').hexdigest():
+            failed_tests.append(['file_digest', 'changed file'])
+        # a complete .part is only renamed (416 on resume)
+        part = os.path.join(tmp_dir, 'done.iso') + PART_SUFFIX
+        part_file = open(part, 'wb')
+        part_file.write(payload)
+        part_file.close()
+        digest = download(url, part[:-len(PART_SUFFIX)], 'sha1', log=log)
+        if digest != hashlib.sha1(payload).hexdigest():
+            failed_tests.append(['complete part', digest])
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp_dir)
+    if failed_tests:
+        raise Exception(
+                 "download()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def self_test():
+    """Tests download(), file_digest() and the sidecar
+    against a local HTTP stand-in, and the media cache.
+    """
+    test_download()
+    test_media_cache()
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] FILE',
+        description='Downloads FILE from --url when it does not exist'
+                    ' and writes its digest to stdout.')
+    parser.add_option('-u', '--url', default=None,
+        help='where to download FILE from when it does not exist')
+    parser.add_option('-t', '--checksum-type', default=DEFAULT_CHECKSUM_TYPE,
+        help='digest to compute (md5, sha1, sha256, ...) [default: %default]')
+    parser.add_option('-c', '--checksum', default=None,
+        help='expected digest of FILE, used to find it in the cache')
+    parser.add_option('-k', '--insecure', action='store_true', default=False,
+        help='do not verify https certificates (like curl -k)')
+    parser.add_option('--cache', default=None, metavar='DIR',
+        help='shared media cache directory')
+    parser.add_option('--cache-max-size', type='int', default=0, metavar='MB',
+        help='evict least recently used media over this size, 0 - no limit'
+             ' [default: %default]')
+    parser.add_option('--no-hardlink', action='store_true', default=False,
+        help='never hardlink FILE and the cache (FILE will be written to)')
+    parser.add_option('--cache-list', action='store_true', default=False,
+        help='list cached media and exit')
+    parser.add_option('--cache-prune', action='store_true', default=False,
+        help='evict media over --cache-max-size and exit')
+    parser.add_option('--self-test', action='store_true', default=False,
+        help='run self test and exit')
+    options, args = parser.parse_args(argv)
+    if options.self_test:
+        return options, None
+    if options.cache_list or options.cache_prune:
+        if not options.cache:
+            parser.error('--cache is required')
+        return options, None
+    if len(args) != 1:
+        parser.error('FILE is required')
+    try:
+        hashlib.new(options.checksum_type)
+    except ValueError:
+        parser.error('unknown checksum type: %s' % options.checksum_type)
+    return options, args[0]
+
+def main(argv):
+    options, path = parse_args(argv)
+    if options.self_test:
+        self_test()
+        return 0
+    cache = None
+    if options.cache:
+        cache = MediaCache(os.path.expanduser(options.cache),
+                           options.cache_max_size * 1000 * 1000)
+    if options.cache_prune:
+        for entry in cache.prune():
+            print('removed %s (%.1f MB) %s' % (entry['digest'][:16],
+                  entry['size'] / 1e6, entry['url'] or entry['name'] or ''))
+    if options.cache_list or options.cache_prune:
+        print_cache(cache)
+        return 0
+    if os.path.exists(path):
+        print(file_digest(path, options.checksum_type))
+        return 0
+    print(fetch(options.url, path, options.checksum_type, options.checksum,
+                cache, not options.no_hardlink, options.insecure))
+    return 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except (DownloadError, IOError, OSError) as e:
+        sys.stderr.write('Error: %s\n' % e)
+        sys.exit(1)
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -5,12 +5,12 @@ set -e -E -u -o pipefail; shopt -s failglob;
 # Given cfengine command
 if [[ ! -f "/var/cfengine/bin/cf-agent" ]]; then
     printf "\e[1;31mcfengine: FAIL\n\e[0m"
-    exit
+    exit 1
 fi
 # When I run "/var/cfengine/bin/cf-promises --version" command
 if ! /var/cfengine/bin/cf-promises --version >/dev/null 2>&1; then
     printf "\e[1;31m/var/cfengine/bin/cf-promises --version: FAIL\n\e[0m"
-    exit
+    exit 1
 fi
 # Then I expect success
 printf "\e[1;32mcfengine: OK\n\e[0m"
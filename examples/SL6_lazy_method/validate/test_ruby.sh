@@ -5,12 +5,12 @@ set -e -E -u -o pipefail; shopt -s failglob;
 # Given ruby command
 if ! command -v ruby >/dev/null 2>&1; then
     printf "\e[1;31mruby: FAIL\n\e[0m"
-    exit
+    exit 1
 fi
 # When I run "ruby --version" command
 if ! ruby --version >/dev/null 2>&1; then
     printf "\e[1;31mruby --version: FAIL\n\e[0m"
-    exit
+    exit 1
 fi
 # Then I expect success
 printf "\e[1;32mruby: OK\n\e[0m"
@@ -5,12 +5,12 @@ set -e -E -u -o pipefail; shopt -s failglob;
 # Given VBoxControl command
 if ! command -v VBoxControl >/dev/null 2>&1; then
     printf "\e[1;31mVBoxControl: FAIL\n\e[0m"
-    exit
+    exit 1
 fi
 # When I run "VBoxControl --version" command
 if ! VBoxControl --version >/dev/null 2>&1; then
     printf "\e[1;31mVBoxControl Version: FAIL\n\e[0m"
-    exit
+    exit 1
 fi
 # Then I expect version is up-to-date
 version=$(VBoxControl --version | cut -f 1 -d"r") # 4.2.12r84980 -> 4.2.12
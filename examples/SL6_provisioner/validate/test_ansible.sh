@@ -5,12 +5,12 @@ set -e -E -u -o pipefail; shopt -s failglob;
 # Given ansible command
 if ! command -v ansible >/dev/null 2>&1; then
     printf "\e[1;31mansible: FAIL\n\e[0m"
-    exit
+    exit 1
 fi
 # When I run "ansible --version" command
 if ! ansible --version >/dev/null 2>&1; then
     printf "\e[1;31mansible --version: FAIL\n\e[0m"
-    exit
+    exit 1
 fi
 # Then I expect success
 printf "\e[1;32mansible: OK\n\e[0m"
@@ -5,12 +5,12 @@ set -e -E -u -o pipefail; shopt -s failglob;
 # Given docker command
 if ! command -v docker >/dev/null 2>&1 && ! command -v lxc-docker >/dev/null 2>&1; then
     printf "\e[1;31mdocker: FAIL\n\e[0m"
-    exit
+    exit 1
 fi
 # When I run "docker version" command
 if ! sudo docker version >/dev/null 2>&1 && ! sudo lxc-docker version >/dev/null 2>&1; then
     printf "\e[1;31mdocker version: FAIL\n\e[0m"
-    exit
+    exit 1
 fi
 # Then I expect success
 printf "\e[1;32mdocker: OK\n\e[0m"
@@ -6,6 +6,6 @@ set -e -E -u -o pipefail; shopt -s failglob;
 # When I grep /etc/sudoers file
 if sudo cat /etc/sudoers | grep -E "Defaults[ ]+requiretty" | grep -vq "^#"; then
     printf "\e[1;31msudo requiretty: FAIL\n\e[0m"
-    exit
+    exit 1
 fi
 printf "\e[1;32msudo requiretty: OK\n\e[0m"
@@ -0,0 +1,417 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python export_box.py --output centos65.box Vagrantfile metadata.json box.ovf box-disk1.vmdk
+python export_box.py --output centos65.box --compress-level 1 --remove-sources export/*
+python export_box.py --output centos65.box --no-compress export/*
+
+Note:
+Script works with python 2.6+ and python 3
+Writes FILEs (by their base names) into a Vagrant box - a tar archive,
+gzip compressed unless --no-compress is given - in one pass.
+
+Compression is parallel: the tar stream is cut into chunks deflated by
+--jobs threads (zlib releases the GIL), each chunk ends with a sync flush
+so the raw deflate streams join into one gzip member, as pigz does.
+The box stays a plain .tar.gz for vagrant, tar and gzip.
+
+With --remove-sources every FILE is removed once it is archived, and
+blocks already read are released on the way (fallocate PUNCH_HOLE on
+linux), so the exported VM and the box don't occupy the disk twice.
+The box is written to BOX.part and renamed when complete.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, sys, time, zlib, struct, tarfile, optparse
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_LEVEL = 6
+# deflate window - a chunk is primed with the end of the previous one
+WINDOW_SIZE = 32 * 1024
+# zlib.compressobj(zdict=) exists since python 3.3
+HAS_ZDICT = sys.version_info >= (3, 3)
+# free the already archived part of a source every PUNCH_STEP bytes
+PUNCH_STEP = 64 * 1024 * 1024
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+MB = 1000 * 1000
+
+def _deflate(data, level, zdict, last):
+    """Raw deflate of one chunk, byte aligned (sync flush) unless /last/."""
+    if zdict:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9,
+                                zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+    if last:
+        return comp.compress(data) + comp.flush(zlib.Z_FINISH)
+    return comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH)
+
+class ParallelGzipWriter(object):
+    """File-like object writing one gzip member to /fileobj/, chunks are
+    deflated by /jobs/ threads and written in order. At most two chunks
+    per thread are held in memory.
+    """
+
+    def __init__(self, fileobj, level=DEFAULT_LEVEL, jobs=None,
+                 chunk_size=CHUNK_SIZE, mtime=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.jobs = jobs or cpu_count()
+        self.chunk_size = chunk_size
+        self.pool = ThreadPool(self.jobs)
+        self.pending = deque()
+        self.buf = []
+        self.buf_len = 0
+        self.dictionary = b''
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        if mtime is None:
+            mtime = time.time()
+        # magic, deflate, no flags, mtime, no extra flags, unknown OS
+        self.fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(mtime))
+                           + b'\x00\xff')
+
+    def write(self, data):
+        if not data:
+            return
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len < self.chunk_size:
+            return
+        data = b''.join(self.buf)
+        start = 0
+        while len(data) - start >= self.chunk_size:
+            self._submit(data[start:start + self.chunk_size], False)
+            start += self.chunk_size
+        self.buf = [data[start:]]
+        self.buf_len = len(data) - start
+
+    def tell(self):
+        return self.size + self.buf_len
+
+    def _submit(self, chunk, last):
+        zdict = HAS_ZDICT and self.dictionary or None
+        self.pending.append(self.pool.apply_async(
+            _deflate, (chunk, self.level, zdict, last)))
+        self.crc = zlib.crc32(chunk, self.crc)
+        self.size += len(chunk)
+        self.dictionary = chunk[-WINDOW_SIZE:]
+        while len(self.pending) > self.jobs * 2:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        """Writes the last chunk and the gzip trailer, /fileobj/ is left open."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(b''.join(self.buf), True)
+            self.buf = []
+            self.buf_len = 0
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+            self.fileobj.write(struct.pack('<II', self.crc & 0xffffffff,
+                                           self.size & 0xffffffff))
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+def _fallocate():
+    """Returns libc fallocate(fd, mode, offset, len) or None."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, 'fallocate64', None) or libc.fallocate
+    except (ImportError, OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    func.restype = ctypes.c_int
+    return func
+
+class ConsumingReader(object):
+    """Reads /path/ for the archive; with /punch/ the blocks already read
+    are released from the disk (the file is removed afterwards anyway).
+    Punching stops quietly where the filesystem doesn't support it.
+    """
+
+    def __init__(self, path, punch=False, step=PUNCH_STEP):
+        self.fallocate = punch and _fallocate() or None
+        self.file = open(path, self.fallocate and 'r+b' or 'rb')
+        self.step = step
+        self.offset = 0
+        self.punched = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.offset += len(data)
+        if self.fallocate and self.offset - self.punched >= self.step:
+            self._punch()
+        return data
+
+    def _punch(self):
+        end = self.offset - self.offset % self.step
+        result = self.fallocate(self.file.fileno(),
+                                FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                                self.punched, end - self.punched)
+        if result != 0:
+            # EOPNOTSUPP, ENOSYS - read the rest as is
+            self.fallocate = None
+            return
+        self.punched = end
+
+    def close(self):
+        self.file.close()
+
+def write_box(output, paths, level=DEFAULT_LEVEL, jobs=None,
+              remove_sources=False, chunk_size=CHUNK_SIZE, log=None):
+    """Archives /paths/ into /output/ - level 0 means plain tar.
+    Returns (bytes archived, bytes written).
+    """
+    part = output + '.part'
+    box_file = open(part, 'wb')
+    archived = 0
+    try:
+        try:
+            if level:
+                stream = ParallelGzipWriter(box_file, level, jobs, chunk_size)
+            else:
+                stream = box_file
+            # GNU format - VMDKs may be bigger than the ustar 8GB limit
+            tar = tarfile.open(fileobj=stream, mode='w|',
+                               format=tarfile.GNU_FORMAT)
+            for path in paths:
+                tarinfo = tar.gettarinfo(path, os.path.basename(path))
+                if log:
+                    log('%s (%.1f MB)' % (tarinfo.name, tarinfo.size / MB))
+                if tarinfo.isreg():
+                    reader = ConsumingReader(path, remove_sources)
+                    try:
+                        tar.addfile(tarinfo, reader)
+                    finally:
+                        reader.close()
+                else:
+                    tar.addfile(tarinfo)
+                archived += tarinfo.size
+                if remove_sources and tarinfo.isreg():
+                    os.remove(path)
+            tar.close()
+            if level:
+                stream.close()
+        finally:
+            box_file.close()
+        os.rename(part, output)
+    except:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    return archived, os.path.getsize(output)
+
+def test_parallel_gzip():
+    import gzip, io, random
+    rand = random.Random(7)
+    text = b''.join(('line %d of the kickstart log\n' % i).encode('ascii')
+                    for i in range(5000))
+    noise = bytes(bytearray(rand.randint(0, 255) for _ in range(50000)))
+    data = text + noise + text
+    failed_tests = []
+    for chunk_size, jobs, level, piece in [(1000, 3, 6, 777), (4096, 1, 1, 10240),
+                                           (65536, 4, 9, 100000), (1000, 2, 6, 0)]:
+        expected = piece and data or b''
+        out = io.BytesIO()
+        writer = ParallelGzipWriter(out, level, jobs, chunk_size, mtime=0)
+        for start in range(0, len(expected), piece or 1):
+            writer.write(expected[start:start + piece])
+        if writer.tell() != len(expected):
+            failed_tests.append(['tell', chunk_size, writer.tell()])
+        writer.close()
+        result = gzip.GzipFile(fileobj=io.BytesIO(out.getvalue())).read()
+        if result != expected:
+            failed_tests.append([chunk_size, jobs, level, len(result)])
+        elif zlib.decompress(out.getvalue(), 16 + zlib.MAX_WBITS) != expected:
+            failed_tests.append(['zlib', chunk_size, jobs, level])
+        if expected and len(out.getvalue()) > len(text) + len(noise):
+            failed_tests.append(['not compressed', chunk_size, len(out.getvalue())])
+    if failed_tests:
+        raise Exception(
+                 "ParallelGzipWriter"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_write_box():
+    import shutil, tempfile
+    directory = tempfile.mkdtemp()
+    failed_tests = []
+    try:
+        contents = {
+            'Vagrantfile': b'Vagrant.configure("2") do |config|\nend\n',
+            'metadata.json': b'{"provider":"virtualbox"}\n',
+            'box-disk1.vmdk': os.urandom(3000) * 100,
+        }
+        for level, mode in [(6, 'r:gz'), (0, 'r:')]:
+            paths = []
+            for name in sorted(contents):
+                path = os.path.join(directory, name)
+                source = open(path, 'wb')
+                source.write(contents[name])
+                source.close()
+                paths.append(path)
+            box = os.path.join(directory, 'test.box')
+            archived, written = write_box(box, paths, level, jobs=2,
+                                          remove_sources=True, chunk_size=4096)
+            if [path for path in paths if os.path.exists(path)]:
+                failed_tests.append(['sources left', level])
+            if archived != sum(len(content) for content in contents.values()):
+                failed_tests.append(['archived', level, archived])
+            box_file = open(box, 'rb')
+            magic = box_file.read(2)
+            box_file.close()
+            if (magic == b'\x1f\x8b') != bool(level):
+                failed_tests.append(['gzip magic', level, magic])
+            tar = tarfile.open(box, mode)
+            for name in sorted(contents):
+                if tar.extractfile(name).read() != contents[name]:
+                    failed_tests.append(['content', level, name])
+            tar.close()
+            if os.path.exists(box + '.part') or written != os.path.getsize(box):
+                failed_tests.append(['output', level, written])
+            os.remove(box)
+        # missing source - no box and no .part left behind
+        try:
+            write_box(box, [os.path.join(directory, 'missing.vmdk')])
+            failed_tests.append(['missing source'])
+        except (IOError, OSError):
+            pass
+        if os.path.exists(box) or os.path.exists(box + '.part'):
+            failed_tests.append(['failed output left'])
+    finally:
+        shutil.rmtree(directory)
+    if failed_tests:
+        raise Exception(
+                 "write_box()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_consuming_reader():
+    import tempfile
+    fd, path = tempfile.mkstemp()
+    data = os.urandom(4096) * 64
+    os.write(fd, data)
+    os.close(fd)
+    failed_tests = []
+    try:
+        reader = ConsumingReader(path, punch=True, step=65536)
+        result = b''
+        while True:
+            chunk = reader.read(10000)
+            if not chunk:
+                break
+            result += chunk
+        reader.close()
+        if result != data:
+            failed_tests.append(['content', len(result)])
+        if reader.punched % 65536 or reader.punched > len(data):
+            failed_tests.append(['punched', reader.punched])
+        # where supported the read part is a hole (reads as zeros)
+        source = open(path, 'rb')
+        head = source.read(reader.punched)
+        source.close()
+        if head.strip(b'\x00'):
+            failed_tests.append(['not punched', reader.punched])
+        if os.path.getsize(path) != len(data):
+            failed_tests.append(['size', os.path.getsize(path)])
+    finally:
+        os.remove(path)
+    if failed_tests:
+        raise Exception(
+                 "ConsumingReader"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def self_test():
+    """Tests gzip compatibility of the parallel writer, box content
+    and release of already archived blocks.
+    """
+    test_parallel_gzip()
+    test_write_box()
+    test_consuming_reader()
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] --output BOX FILE ...',
+        description='Writes FILEs into a Vagrant box (tar.gz) in one pass '
+                    'with parallel gzip compression.')
+    parser.add_option('-o', '--output', default=None, metavar='BOX',
+        help='box to create')
+    parser.add_option('-l', '--compress-level', type='int', default=DEFAULT_LEVEL,
+        help='gzip compression level 1-9 [default: %default]')
+    parser.add_option('--no-compress', action='store_true', default=False,
+        help='write a plain tar archive')
+    parser.add_option('-j', '--jobs', type='int', default=cpu_count(),
+        help='compression threads [default: %default]')
+    parser.add_option('--remove-sources', action='store_true', default=False,
+        help='remove FILEs as they are archived')
+    parser.add_option('--self-test', action='store_true', default=False,
+        help='run self test and exit')
+    options, args = parser.parse_args(argv)
+    if options.self_test:
+        return options, args
+    if not options.output or not args:
+        parser.error('--output BOX and at least one FILE are required')
+    if not 1 <= options.compress_level <= 9:
+        parser.error('--compress-level must be between 1 and 9')
+    if options.jobs < 1:
+        parser.error('--jobs must be positive')
+    if os.path.exists(options.output):
+        parser.error('%s already exists' % options.output)
+    return options, args
+
+def main(argv):
+    options, paths = parse_args(argv)
+    if options.self_test:
+        self_test()
+        return 0
+    level = options.compress_level
+    if options.no_compress:
+        level = 0
+
+    def log(message):
+        print('[INFO] adding %s' % message)
+        sys.stdout.flush()
+
+    start = time.time()
+    try:
+        archived, written = write_box(options.output, paths, level, options.jobs,
+                                      options.remove_sources, log=log)
+    except (IOError, OSError):
+        error = sys.exc_info()[1]
+        print('[ERROR] %s: %s' % (options.output, error), file=sys.stderr)
+        return 1
+    seconds = max(time.time() - start, 1e-6)
+    if level:
+        how = 'gzip level %d, %d thread(s)' % (level, options.jobs)
+    else:
+        how = 'not compressed'
+    print('[INFO] %s: %.1f MB archived into %.1f MB (%d%%) in %.1f sec'
+          ' (%.1f MB/s, %s)' % (options.output, archived / MB, written / MB,
+                                 written * 100 // max(archived, 1), seconds,
+                                 archived / MB / seconds, how))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
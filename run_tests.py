@@ -0,0 +1,335 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python run_tests.py -j 4 -t "cd validate && bash test_sudo.sh" -t "cd validate && bash test_docker.sh" -- ssh -S /tmp/ctl vbkick@127.0.0.1 -T -C
+python run_tests.py --junit centos65.xml --json centos65.json --suite centos65 -t "..." -- ssh ... -C
+
+Note:
+Script works with python 2.6+ and python 3
+Runs independent test commands at once (at most --jobs), each as the
+last argument of the command after -- (e.g. ssh over a shared
+ControlMaster connection, so all tests use one TCP connection to the
+guest). For every test the exit status, duration and output are
+captured; the output of a test is printed as a whole when it ends.
+
+Results are written as JUnit XML (--junit) and JSON (--json), exit
+code is 1 when any test failed.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, re, sys, json, time, shlex, socket, optparse, threading, subprocess
+from xml.sax.saxutils import escape, quoteattr
+
+DEFAULT_JOBS = 4
+DEFAULT_SUITE = 'validate'
+SCRIPT_RE = re.compile(r'\.(sh|bash|py|rb|pl|bats)$')
+# colors of test output and characters not allowed in XML 1.0
+ANSI_RE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+XML_INVALID_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+class TestResult(object):
+
+    def __init__(self, name, command):
+        self.name = name
+        self.command = command
+        self.status = None
+        self.seconds = 0.0
+        self.output = ''
+
+    @property
+    def ok(self):
+        return self.status == 0
+
+    def as_dict(self):
+        return {'name': self.name, 'command': self.command,
+                'status': self.status, 'seconds': round(self.seconds, 3),
+                'output': self.output}
+
+def test_name(command):
+    """Name of the test - the last script of the command
+    ('cd validate && bash test_docker.sh' -> 'test_docker.sh'),
+    the whole command when it doesn't run a script.
+    """
+    try:
+        if sys.version_info[0] < 3:
+            # shlex of python 2 doesn't handle unicode
+            words = [w.decode('utf-8') for w in shlex.split(command.encode('utf-8'))]
+        else:
+            words = shlex.split(command)
+    except ValueError:
+        words = command.split()
+    for word in reversed(words):
+        if SCRIPT_RE.search(word):
+            return os.path.basename(word)
+    return command
+
+def run_test(prefix, result, clock=time.time):
+    start = clock()
+    devnull = open(os.devnull)
+    try:
+        proc = subprocess.Popen(list(prefix) + [result.command],
+                                stdin=devnull, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        result.status = proc.returncode
+        result.output = output.decode('utf-8', 'replace')
+    except OSError as e:
+        result.status = 127
+        result.output = '%s: %s\n' % (prefix[0], e)
+    finally:
+        devnull.close()
+    result.seconds = clock() - start
+    return result
+
+def run_all(commands, prefix, jobs, report=None, clock=time.time):
+    """Runs /commands/, /jobs/ at once. Returns results in the order of
+    /commands/, /report/ is called with each result when it ends.
+    """
+    results = [TestResult(test_name(command), command) for command in commands]
+    pending = list(results)
+    mutex = threading.Lock()
+
+    def worker():
+        while True:
+            with mutex:
+                if not pending:
+                    return
+                result = pending.pop(0)
+            run_test(prefix, result, clock)
+            if report is not None:
+                with mutex:
+                    report(result)
+
+    workers = []
+    for _ in range(min(jobs, len(results))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+    # join with timeout - Ctrl-C is delivered to the main thread
+    while [w for w in workers if w.is_alive()]:
+        for thread in workers:
+            thread.join(0.2)
+    return results
+
+def format_result(result, show_output=True):
+    if result.ok:
+        line = '[ OK ] %s (%.1f sec)' % (result.name, result.seconds)
+    else:
+        line = '[FAIL] %s (exit code %s, %.1f sec)' % (
+            result.name, result.status, result.seconds)
+    if show_output and result.output.strip():
+        output = result.output.rstrip('\n').split('\n')
+        # color reset printed after the last newline
+        if len(output) > 1 and not ANSI_RE.sub('', output[-1]):
+            output[-2] += output.pop()
+        line += '\n' + '\n'.join('       ' + text for text in output)
+    return line
+
+def _xml_text(text):
+    return escape(XML_INVALID_RE.sub('', ANSI_RE.sub('', text)))
+
+def junit_xml(suite, results, seconds, timestamp):
+    failures = len([r for r in results if not r.ok])
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<testsuite name=%s tests="%d" failures="%d" errors="0" skipped="0"'
+             ' time="%.3f" timestamp=%s hostname=%s>'
+             % (quoteattr(suite), len(results), failures, seconds,
+                quoteattr(timestamp), quoteattr(socket.gethostname()))]
+    for result in results:
+        lines.append('  <testcase classname=%s name=%s time="%.3f">'
+                     % (quoteattr(suite), quoteattr(result.name), result.seconds))
+        if not result.ok:
+            lines.append('    <failure message=%s>%s</failure>'
+                         % (quoteattr('exit code %s' % result.status),
+                            _xml_text(result.command)))
+        lines.append('    <system-out>%s</system-out>' % _xml_text(result.output))
+        lines.append('  </testcase>')
+    lines.append('</testsuite>')
+    return '\n'.join(lines) + '\n'
+
+def json_report(suite, results, seconds, timestamp):
+    return json.dumps({
+        'suite': suite,
+        'timestamp': timestamp,
+        'tests': len(results),
+        'failures': len([r for r in results if not r.ok]),
+        'seconds': round(seconds, 3),
+        'results': [result.as_dict() for result in results],
+    }, indent=2, sort_keys=True) + '\n'
+
+def write_file(path, data):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    report = open(path, 'wb')
+    try:
+        report.write(data.encode('utf-8'))
+    finally:
+        report.close()
+
+def test_test_name():
+    failed_tests = []
+    cases = [
+        ('cd validate && bash test_docker.sh', 'test_docker.sh'),
+        ('bash validate/test_sudo.sh --verbose', 'test_sudo.sh'),
+        ("cd validate && bash adm_features.sh 'adm_context.txt'", 'adm_features.sh'),
+        ('sudo docker ps -a', 'sudo docker ps -a'),
+        ('echo "unbalanced', 'echo "unbalanced'),
+    ]
+    for command, expected in cases:
+        result = test_name(command)
+        if result != expected:
+            failed_tests.append([command, result, expected])
+    if failed_tests:
+        raise Exception(
+                 "test_name()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_run_all():
+    failed_tests = []
+    commands = ['sleep 0.4; printf "\\033[1;32msudo: OK\\n\\033[0m"',
+                'sleep 0.4; echo "docker: FAIL <&>"; exit 1',
+                'sleep 0.4; echo one; echo two >&2']
+    reported = []
+    start = time.time()
+    results = run_all(commands, ['sh', '-c'], 3, report=reported.append)
+    seconds = time.time() - start
+    # as long as the slowest test, not the sum of them
+    if seconds > 1.0:
+        failed_tests.append(['seconds', seconds])
+    if [r.status for r in results] != [0, 1, 0]:
+        failed_tests.append(['status', [r.status for r in results]])
+    if results[2].output != 'one\ntwo\n':
+        failed_tests.append(['output', results[2].output])
+    if sorted(r.command for r in reported) != sorted(commands):
+        failed_tests.append(['reported', len(reported)])
+    if min(r.seconds for r in results) < 0.4:
+        failed_tests.append(['durations', [r.seconds for r in results]])
+    # one at a time
+    start = time.time()
+    run_all(commands[:2], ['sh', '-c'], 1)
+    if time.time() - start < 0.8:
+        failed_tests.append(['jobs 1', time.time() - start])
+    result = run_test(['/nonexistent/ssh'], TestResult('x', 'true'))
+    if result.status != 127:
+        failed_tests.append(['missing prefix', result.status])
+    if failed_tests:
+        raise Exception(
+                 "run_all()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_reports():
+    from xml.dom import minidom
+    failed_tests = []
+    ok = TestResult('test_sudo.sh', 'cd validate && bash test_sudo.sh')
+    ok.status, ok.seconds, ok.output = 0, 0.25, '\x1b[1;32msudo: OK\n\x1b[0m'
+    fail = TestResult('test_docker.sh', 'cd validate && bash test_docker.sh')
+    fail.status, fail.seconds, fail.output = 1, 1.5, 'docker: FAIL <&>\x07\n'
+    results = [ok, fail]
+    xml = junit_xml('centos65', results, 1.75, '2014-05-20T09:12:51')
+    suite = minidom.parseString(xml.encode('utf-8')).documentElement
+    cases = suite.getElementsByTagName('testcase')
+    outputs = [c.getElementsByTagName('system-out')[0].firstChild.data for c in cases]
+    if (suite.getAttribute('tests'), suite.getAttribute('failures')) != ('2', '1'):
+        failed_tests.append(['suite', suite.toxml()])
+    if [c.getAttribute('name') for c in cases] != ['test_sudo.sh', 'test_docker.sh']:
+        failed_tests.append(['names', xml])
+    if outputs != ['sudo: OK\n', 'docker: FAIL <&>\n']:
+        failed_tests.append(['outputs', outputs])
+    if [len(c.getElementsByTagName('failure')) for c in cases] != [0, 1]:
+        failed_tests.append(['failures', xml])
+    report = json.loads(json_report('centos65', results, 1.75, '2014-05-20T09:12:51'))
+    if (report['tests'], report['failures'], report['results'][1]['status']) != (2, 1, 1):
+        failed_tests.append(['json', report])
+    if report['results'][0]['output'] != ok.output:
+        failed_tests.append(['json output', report['results'][0]])
+    if failed_tests:
+        raise Exception(
+                 "junit_xml(), json_report()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def self_test():
+    """Tests naming, runs local commands at once and checks
+    the JUnit XML and JSON reports.
+    """
+    test_test_name()
+    test_run_all()
+    test_reports()
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] -t TEST_CMD [-t TEST_CMD ...] -- PREFIX_CMD ...',
+        description='Runs test commands at once, reports JUnit XML and JSON.')
+    parser.disable_interspersed_args()
+    parser.add_option('-t', '--test', action='append', dest='tests', default=[],
+        metavar='TEST_CMD', help='test command, may be repeated')
+    parser.add_option('-j', '--jobs', type='int', default=DEFAULT_JOBS,
+        help='tests running at once [default: %default]')
+    parser.add_option('-s', '--suite', default=DEFAULT_SUITE,
+        help='test suite name in reports [default: %default]')
+    parser.add_option('--junit', default=None, metavar='FILE',
+        help='write results as JUnit XML to FILE')
+    parser.add_option('--json', default=None, metavar='FILE',
+        help='write results as JSON to FILE')
+    parser.add_option('-q', '--quiet', action='store_true', default=False,
+        help='print output of failed tests only')
+    parser.add_option('--self-test', action='store_true', default=False,
+        help='run self test and exit')
+    options, args = parser.parse_args(argv)
+    if options.self_test:
+        return options, None
+    if args and args[0] == '--':
+        args = args[1:]
+    if not options.tests:
+        parser.error('at least one --test is required')
+    if not args:
+        parser.error('PREFIX_CMD is required, e.g. -- ssh user@host -C')
+    if options.jobs < 1:
+        parser.error('--jobs must be positive')
+    return options, args
+
+def main(argv):
+    options, prefix = parse_args(argv)
+    if options.self_test:
+        self_test()
+        return 0
+
+    def report(result):
+        print(format_result(result, not options.quiet or not result.ok))
+        sys.stdout.flush()
+
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    start = time.time()
+    results = run_all(options.tests, prefix, options.jobs, report)
+    seconds = time.time() - start
+    failures = len([r for r in results if not r.ok])
+    print('[INFO] %d tests, %d failed in %.1f sec (slowest %s %.1f sec, %d at once)'
+          % (len(results), failures, seconds,
+             max(results, key=lambda r: r.seconds).name,
+             max(r.seconds for r in results), options.jobs))
+    if options.junit:
+        write_file(options.junit, junit_xml(options.suite, results, seconds, timestamp))
+    if options.json:
+        write_file(options.json, json_report(options.suite, results, seconds, timestamp))
+    if failures:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,755 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+printf 'Hello World!' | convert_2_scancode.py | python send_scancodes.py VM_NAME
+
+Note:
+Script works with python 2.6+ and python 3
+Reads lines of scancodes (convert_2_scancode.py output, one line per
+command in --batch mode) and types them into the VM with as few
+'VBoxManage controlvm VM_NAME keyboardputscancode' calls as possible.
+Typing starts as soon as the first batch is read, not at the end of input.
+
+Pseudocodes understood besides hexadecimal scancodes:
+- 'wait'       - wait --wait-time seconds (1 by default)
+- 'sleep:NNN'  - sleep NNN milliseconds
+Both end the current batch of scancodes.
+
+Pacing (--pacing) decides how long to sleep after each VBoxManage call:
+- 'fixed[:SECONDS]'  - always --batch-delay (or SECONDS, 0 - no sleep)
+- 'confirmed'        - no sleep, the next batch goes as soon as
+                       VBoxManage returned successfully
+- 'rate:KEYS'        - at most KEYS key presses per second
+With --wait-for, waits ('wait', --seq-wait and --boot-wait) end as soon as
+the condition is met, their length is only the upper limit:
+- 'port:[HOST:]PORT' - HOST (127.0.0.1) PORT answers: sends data (e.g. the
+                       ssh banner) or keeps the connection open - VirtualBox
+                       NAT accepts and closes at once when the guest doesn't
+                       listen yet
+- 'screen'           - the VM screen (VBoxManage screenshotpng) has changed
+Compact repeat forms ('wait*5000', '( 1c 9c )*3') written by
+'convert_2_scancode.py --compact' are expanded lazily.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, sys, io, time, socket, hashlib, optparse, subprocess, tempfile
+
+# PS/2 keyboard queue in VirtualBox is small - codes over it may be dropped
+DEFAULT_MAX_CODES = 32
+# a batch may grow this much past --max-codes to end where no key is held
+MAX_CODES_OVERRUN = 16
+# make codes of Shift, Ctrl, Alt and Win keys - they may stay held between batches
+MODIFIER_KEYS = frozenset(['2a', '36', '1d', '38', 'e0 1d', 'e0 38', 'e0 5b', 'e0 5c'])
+DEFAULT_BATCH_DELAY = 0.05
+DEFAULT_WAIT_TIME = 1.0
+# how long one VBoxManage call takes - only used to estimate typing time
+DEFAULT_CALL_TIME = 0.1
+# how often a wait condition is checked
+WAIT_POLL_INTERVAL = 0.2
+# an open port which neither sends nor closes for this long answers
+PORT_ANSWER_TIMEOUT = 1.0
+
+def read_codes(fd, chunk_size=65536):
+    """Yields scancodes read from the file descriptor /fd/
+    as soon as they are complete, and '' at the end of each line.
+    """
+    held = ''
+    while True:
+        data = os.read(fd, chunk_size)
+        if not data:
+            break
+        lines = (held + data.decode('ascii', 'replace')).split('\n')
+        held = lines.pop()
+        for line in lines:
+            for code in line.split():
+                yield code
+            yield ''
+        # the last code may continue in the next chunk
+        codes = held.split()
+        if codes and not held[-1].isspace():
+            held = codes.pop()
+        else:
+            held = ''
+        for code in codes:
+            yield code
+    for code in held.split():
+        yield code
+
+def _read_group(codes):
+    """Reads the rest of a '( ... )*N' group from the /codes/ iterator.
+    Returns (items, times) where items may hold nested groups.
+    """
+    items = []
+    for code in codes:
+        if code == '(':
+            items.append(_read_group(codes))
+        elif code.startswith(')*'):
+            return items, int(code[2:])
+        elif code == '':
+            break
+        else:
+            items.append(code)
+    raise ValueError('unterminated "(" repeat group')
+
+def _replay(items, times):
+    for _ in range(times):
+        for item in items:
+            if isinstance(item, tuple):
+                for code in _replay(*item):
+                    yield code
+            elif '*' in item:
+                code, count = item.rsplit('*', 1)
+                for _ in range(int(count)):
+                    yield code
+            else:
+                yield item
+
+def expand_repeats(codes):
+    """Lazily expands the compact repeat forms written by
+    'convert_2_scancode.py --compact':
+    - 'CODE*N'          - CODE repeated N times (e.g. 'wait*5000')
+    - '(' CODES ')*N'   - CODES (which may hold repeats) repeated N times
+    Only one copy of a repeated group is kept in memory.
+    """
+    codes = iter(codes)
+    for code in codes:
+        if code == '(':
+            group = _read_group(codes)
+        elif '*' in code:
+            group = [code], 1
+        else:
+            yield code
+            continue
+        for code in _replay(*group):
+            yield code
+
+def split_batches(codes, max_codes=DEFAULT_MAX_CODES, wait_time=DEFAULT_WAIT_TIME,
+                  line_wait=0):
+    """Given an iterable of scancodes and pseudocodes,
+    yields ('keys', [scancode, ...]) with at most /max_codes/ scancodes,
+    ('wait', seconds) for every 'wait' pseudocode
+    and ('sleep', seconds) for every 'sleep:NNN' pseudocode.
+    An empty string marks the end of a command (see read_codes()),
+    it ends the batch too and gives ('wait', line_wait).
+    e.g. ['1c', '9c', 'wait', '01', '81'] -->
+         ('keys', ['1c', '9c']), ('wait', 1.0), ('keys', ['01', '81'])
+    A full batch is cut only where no key is held down, so the make and
+    break codes of a key (and an 'e0' prefix and its code) go in one call
+    and the sleep after it can't start typematic repeat in the guest -
+    the batch grows up to MAX_CODES_OVERRUN codes past /max_codes/ for it.
+    When a key stays down longer (e.g. <LeftShiftOn>), the batch is cut
+    at the last point where only modifiers were held.
+    """
+    batch = []
+    held = set()
+    prefix = ''
+    # batch length at the last point where only modifiers were held
+    soft_cut = 0
+    for code in codes:
+        if code == '':
+            kind, seconds = 'wait', line_wait
+        elif code == 'wait':
+            kind, seconds = 'wait', wait_time
+        elif code.startswith('sleep:'):
+            kind, seconds = 'sleep', int(code[len('sleep:'):]) / 1000.0
+        else:
+            value = int(code, 16)  # ValueError when code is not a hex byte
+            batch.append(code)
+            if value in (0xe0, 0xe1):
+                prefix = '%02x ' % value
+                continue
+            key = prefix + '%02x' % (value & 0x7f)
+            prefix = ''
+            if value & 0x80:
+                held.discard(key)
+            else:
+                held.add(key)
+            if held <= MODIFIER_KEYS:
+                soft_cut = len(batch)
+            if len(batch) >= max_codes and not held:
+                yield 'keys', batch
+                batch = []
+                soft_cut = 0
+            elif len(batch) >= max_codes + MAX_CODES_OVERRUN:
+                cut = soft_cut or len(batch)
+                yield 'keys', batch[:cut]
+                batch = batch[cut:]
+                soft_cut = 0
+            continue
+        if batch:
+            yield 'keys', batch
+            batch = []
+        yield kind, seconds
+    if batch:
+        yield 'keys', batch
+
+def count_keys(codes):
+    """Number of key presses (make codes) in the list of scancodes."""
+    return len([c for c in codes if int(c, 16) < 0x80])
+
+class FixedPacer(object):
+    """'fixed[:SECONDS]' - sleeps the same /delay/ after every call."""
+
+    def __init__(self, delay=DEFAULT_BATCH_DELAY):
+        self.delay = delay
+
+    def delay_after(self, keys, elapsed):
+        """Seconds to sleep after a VBoxManage call which typed /keys/
+        key presses and took /elapsed/ seconds.
+        """
+        return self.delay
+
+class ConfirmedPacer(object):
+    """'confirmed' - types the next batch as soon as VBoxManage returned.
+    A successful return means the whole batch was put in the keyboard
+    queue (a failed call stops the sender), so no extra sleep is needed.
+    """
+
+    def delay_after(self, keys, elapsed):
+        return 0.0
+
+class RatePacer(object):
+    """'rate:KEYS' - key-rate budget, sleeps just enough after each call
+    to type at most /keys_per_sec/ key presses per second.
+    """
+
+    def __init__(self, keys_per_sec):
+        self.keys_per_sec = keys_per_sec
+
+    def delay_after(self, keys, elapsed):
+        return max(0.0, keys / self.keys_per_sec - elapsed)
+
+def make_pacer(spec, batch_delay=DEFAULT_BATCH_DELAY):
+    """Returns the pacer for the --pacing /spec/,
+    e.g. 'fixed', 'fixed:0.1', 'confirmed', 'rate:20'.
+    """
+    name, _, arg = spec.partition(':')
+    if name == 'fixed':
+        # 'fixed:0' - no pause between calls
+        delay = float(arg) if arg else batch_delay
+        if delay < 0:
+            raise ValueError('negative delay in pacing policy: %s' % spec)
+        return FixedPacer(delay)
+    if name == 'confirmed' and not arg:
+        return ConfirmedPacer()
+    if name == 'rate' and arg and float(arg) > 0:
+        return RatePacer(float(arg))
+    raise ValueError('unknown pacing policy: %s' % spec)
+
+class PortCondition(object):
+    """'port:[HOST:]PORT' - met when HOST:PORT answers, see
+    wait_vm.probe_port() - an accepted connection alone means nothing
+    behind VirtualBox NAT.
+    """
+
+    def __init__(self, port, host='127.0.0.1', answer_timeout=PORT_ANSWER_TIMEOUT):
+        self.port = port
+        self.host = host
+        self.answer_timeout = answer_timeout
+
+    def start(self):
+        pass
+
+    def ready(self):
+        from wait_vm import probe_port
+        return probe_port(self.port, self.host, WAIT_POLL_INTERVAL,
+                          self.answer_timeout)[1]
+
+class ScreenCondition(object):
+    """'screen' - met when the VM screen differs from the one
+    seen when the wait started.
+    """
+
+    def __init__(self, vm_name, vboxmanage='VBoxManage'):
+        self.vm_name = vm_name
+        self.vboxmanage = vboxmanage
+        self.initial = None
+
+    def screen_hash(self):
+        """Hash of the current VM screenshot, None when it can't be taken."""
+        fd, path = tempfile.mkstemp(suffix='.png')
+        os.close(fd)
+        devnull = open(os.devnull, 'w')
+        try:
+            cmd = [self.vboxmanage, 'controlvm', self.vm_name,
+                   'screenshotpng', path]
+            if subprocess.call(cmd, stdout=devnull, stderr=devnull) != 0:
+                return None
+            png_file = open(path, 'rb')
+            try:
+                return hashlib.sha1(png_file.read()).hexdigest()
+            finally:
+                png_file.close()
+        finally:
+            devnull.close()
+            os.remove(path)
+
+    def start(self):
+        self.initial = self.screen_hash()
+
+    def ready(self):
+        if self.initial is None:
+            return False
+        current = self.screen_hash()
+        return current is not None and current != self.initial
+
+def make_wait_condition(spec, vm_name, vboxmanage='VBoxManage'):
+    """Returns the wait condition for the --wait-for /spec/,
+    e.g. 'port:2222', 'port:10.0.0.1:80', 'screen'.
+    """
+    name, _, arg = spec.partition(':')
+    if name == 'screen' and not arg:
+        return ScreenCondition(vm_name, vboxmanage)
+    if name == 'port' and arg:
+        host, _, port = arg.rpartition(':')
+        return PortCondition(int(port), host or '127.0.0.1')
+    raise ValueError('unknown wait condition: %s' % spec)
+
+class ScancodeSender(object):
+    """Sends scancodes to the VM in batches and keeps statistics
+    about keys sent, VBoxManage calls made, time spent
+    and time saved by pacing and wait conditions (against fixed pacing
+    with /batch_delay/ and full waits).
+    """
+
+    def __init__(self, vm_name, vboxmanage='VBoxManage',
+                 max_codes=DEFAULT_MAX_CODES, batch_delay=DEFAULT_BATCH_DELAY,
+                 wait_time=DEFAULT_WAIT_TIME, line_wait=0, sleep=time.sleep,
+                 pacer=None, wait_condition=None, clock=time.time):
+        self.vm_name = vm_name
+        self.vboxmanage = vboxmanage
+        self.max_codes = max_codes
+        self.batch_delay = batch_delay
+        self.wait_time = wait_time
+        self.line_wait = line_wait
+        self.sleep = sleep
+        self.pacer = pacer or FixedPacer(batch_delay)
+        self.wait_condition = wait_condition
+        self.clock = clock
+        self.keys = 0
+        self.calls = 0
+        self.seconds = 0.0
+        self.saved = 0.0
+
+    def put_scancodes(self, batch):
+        """Types one batch of scancodes with a single VBoxManage call."""
+        cmd = [self.vboxmanage, 'controlvm', self.vm_name,
+               'keyboardputscancode'] + batch
+        if subprocess.call(cmd) != 0:
+            raise RuntimeError('%s failed' % ' '.join(cmd[:4]))
+        self.calls += 1
+        self.keys += count_keys(batch)
+
+    def wait(self, seconds):
+        """Waits /seconds/, or less when the wait condition is met earlier.
+        """
+        if self.wait_condition is None or not seconds:
+            self.sleep(seconds)
+            return
+        start = self.clock()
+        self.wait_condition.start()
+        while not self.wait_condition.ready():
+            left = start + seconds - self.clock()
+            if left <= 0:
+                break
+            self.sleep(min(WAIT_POLL_INTERVAL, left))
+        self.saved += seconds - (self.clock() - start)
+
+    def send(self, codes, boot_wait=0):
+        """Sends scancodes and pseudocodes to the VM,
+        after waiting /boot_wait/ seconds for the VM to boot.
+        /codes/ may be a generator - batches are sent as soon as they are full.
+        """
+        start = self.clock()
+        if boot_wait:
+            self.wait(boot_wait)
+        for kind, value in split_batches(expand_repeats(codes), self.max_codes,
+                                         self.wait_time, self.line_wait):
+            if kind == 'keys':
+                call_start = self.clock()
+                self.put_scancodes(value)
+                delay = self.pacer.delay_after(count_keys(value),
+                                               self.clock() - call_start)
+                self.saved += self.batch_delay - delay
+                self.sleep(delay)
+            elif kind == 'wait':
+                self.wait(value)
+            else:
+                self.sleep(value)
+        self.seconds += self.clock() - start
+
+    def keys_per_sec(self):
+        if not self.seconds:
+            return 0.0
+        return self.keys / self.seconds
+
+    def report(self):
+        return ('%d keys sent with %d VBoxManage calls in %.2f sec (%.1f keys/sec),'
+                ' %.2f sec saved by pacing'
+                % (self.keys, self.calls, self.seconds, self.keys_per_sec(),
+                   self.saved))
+
+class DryRunSender(ScancodeSender):
+    """Works like ScancodeSender, but writes the batches and sleeps
+    to /out/ instead of typing them, and adds up the estimated typing time
+    (each VBoxManage call is assumed to take /call_time/ seconds).
+    """
+
+    def __init__(self, vm_name, out=sys.stdout, call_time=DEFAULT_CALL_TIME,
+                 **kwargs):
+        ScancodeSender.__init__(self, vm_name, **kwargs)
+        self.out = out
+        self.call_time = call_time
+
+    def put_scancodes(self, batch):
+        self.out.write('keys  %s\n' % ' '.join(batch))
+        self.calls += 1
+        keys = count_keys(batch)
+        self.keys += keys
+        self.seconds += self.call_time + self.pacer.delay_after(
+            keys, self.call_time)
+
+    def send(self, codes, boot_wait=0):
+        """Waits are counted in full - wait conditions can only shorten them.
+        """
+        if boot_wait:
+            self.out.write('wait  %.3f\n' % boot_wait)
+            self.seconds += boot_wait
+        for kind, value in split_batches(expand_repeats(codes), self.max_codes,
+                                         self.wait_time, self.line_wait):
+            if kind == 'keys':
+                self.put_scancodes(value)
+            elif value:
+                self.out.write('%-5s %.3f\n' % (kind, value))
+                self.seconds += value
+
+    def report(self):
+        return ('%d keys in %d VBoxManage calls, estimated typing time %.2f sec'
+                % (self.keys, self.calls, self.seconds))
+
+def test_split_batches():
+    """Tests split_batches().
+    """
+    test_data = [
+      ([], 3, []),
+      (['1c', '9c'], 3, [('keys', ['1c', '9c'])]),
+      (['02', '82', '03', '83', '04', '84'], 3,
+        [('keys', ['02', '82', '03', '83']), ('keys', ['04', '84'])]),
+      # 'e0 1c' (keypad Enter) is not split from its prefix or break code
+      (['e0', '1c', 'e0', '9c', '02', '82'], 3,
+        [('keys', ['e0', '1c', 'e0', '9c']), ('keys', ['02', '82'])]),
+      # the 33rd code releases the key pressed by the 32nd
+      (['1e', '9e'] * 15 + ['2a', '1f', '9f', 'aa', '1e', '9e'], 32,
+        [('keys', ['1e', '9e'] * 15 + ['2a', '1f', '9f', 'aa']),
+         ('keys', ['1e', '9e'])]),
+      # Shift held for long - cut where only Shift is down
+      (['2a'] + ['1e', '9e'] * 30 + ['aa'], 32,
+        [('keys', ['2a'] + ['1e', '9e'] * 23), ('keys', ['1e', '9e'] * 7 + ['aa'])]),
+      (['1c', '9c', 'wait', 'sleep:250', '01', '81'], 3,
+        [('keys', ['1c', '9c']), ('wait', 1.0), ('sleep', 0.25),
+         ('keys', ['01', '81'])]),
+      (['02', '82', '', '03', '83', ''], 3,
+        [('keys', ['02', '82']), ('wait', 2), ('keys', ['03', '83']),
+         ('wait', 2)]),
+    ]
+
+    failed_tests = []
+    for codes, max_codes, batches in test_data:
+        split = list(split_batches(codes, max_codes, 1.0, 2))
+        if split != batches:
+             failed_tests.append([codes, split])
+    if failed_tests:
+        raise Exception(
+                 "split_batches()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_send_with_stub_vboxmanage():
+    """Sends scancodes through a stub VBoxManage script
+    which logs its argv with a timestamp.
+    """
+    import tempfile, shutil
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        log = os.path.join(tmp_dir, 'argv.log')
+        stub = os.path.join(tmp_dir, 'VBoxManage')
+        stub_file = open(stub, 'w')
+        stub_file.write('#!/bin/sh\nprintf "%%s %%s\\n" "$(date +%%s)" "$*" >> "%s"\n' % log)
+        stub_file.close()
+        os.chmod(stub, 0o755)
+        slept = []
+        sender = ScancodeSender('vm', stub, max_codes=4, batch_delay=0,
+                                sleep=slept.append)
+        sender.send('2a 23 a3 aa 12 92 wait 1c 9c sleep:100'.split())
+        log_file = open(log)
+        calls = [line.split(' ', 1)[1].rstrip('\n') for line in log_file]
+        log_file.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+    expected = ['controlvm vm keyboardputscancode 2a 23 a3 aa',
+                'controlvm vm keyboardputscancode 12 92',
+                'controlvm vm keyboardputscancode 1c 9c']
+    if (calls != expected or sender.keys != 4 or sender.calls != 3
+            or slept != [0, 0, 1.0, 0, 0.1]):
+        raise Exception(
+                 "ScancodeSender.send()"
+                 " gave bad results: %s" % repr([calls, sender.keys, slept])
+        )
+
+def test_expand_repeats():
+    """Tests expand_repeats().
+    """
+    test_data = [
+      (['1c', '9c'], ['1c', '9c']),
+      (['wait*3', ''], ['wait', 'wait', 'wait', '']),
+      (['(', '1e', '9e', '(', 'wait*2', '01', ')*2', ')*2', '1c'],
+        ['1e', '9e', 'wait', 'wait', '01', 'wait', 'wait', '01',
+         '1e', '9e', 'wait', 'wait', '01', 'wait', 'wait', '01', '1c']),
+      (['(', '1e', ')*0', 'sleep:100*2'], ['sleep:100', 'sleep:100']),
+    ]
+
+    failed_tests = []
+    for codes, expanded in test_data:
+        result = list(expand_repeats(codes))
+        if result != expanded:
+             failed_tests.append([codes, result])
+    if failed_tests:
+        raise Exception(
+                 "expand_repeats()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_read_codes():
+    """Tests read_codes() with scancodes split across reads.
+    """
+    failed_tests = []
+    data = b'2a 23 a3 aa\n\nwait 1c 9c\n01 81'
+    for chunk_size in (1, 2, 3, 64):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, data)
+        os.close(write_fd)
+        codes = list(read_codes(read_fd, chunk_size))
+        os.close(read_fd)
+        if codes != ['2a', '23', 'a3', 'aa', '', '', 'wait', '1c', '9c', '',
+                     '01', '81']:
+             failed_tests.append([chunk_size, codes])
+    if failed_tests:
+        raise Exception(
+                 "read_codes()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_dry_run():
+    """Tests DryRunSender output and typing time estimate.
+    """
+    out = io.StringIO()
+    sender = DryRunSender('vm', out, call_time=0.5, max_codes=2,
+                          batch_delay=0.25, line_wait=2)
+    sender.send(['1c', '9c', '01', 'wait', ''])
+    expected = 'keys  1c 9c\nkeys  01\nwait  1.000\nwait  2.000\n'
+    if (out.getvalue() != expected or sender.keys != 2 or sender.calls != 2
+            or sender.seconds != 4.5):
+        raise Exception(
+                 "DryRunSender.send()"
+                 " gave bad results: %s" % repr([out.getvalue(), sender.seconds])
+        )
+
+class FakeClock(object):
+    """time.time() and time.sleep() stand-in, sleep() only moves the time.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+class FakeCondition(object):
+    """Wait condition met after /ready_after/ seconds of waiting."""
+
+    def __init__(self, clock, ready_after):
+        self.clock = clock
+        self.ready_after = ready_after
+
+    def start(self):
+        self.started = self.clock.time()
+
+    def ready(self):
+        return self.clock.time() - self.started >= self.ready_after
+
+def test_port_condition():
+    """Tests PortCondition against a local socket - accepting and closing
+    at once (VirtualBox NAT with nothing listening in the guest) is not
+    an answer, a banner is.
+    """
+    import threading
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(2)
+    port = server.getsockname()[1]
+    replies = [b'', b'SSH-2.0-OpenSSH_6.6\r\n']
+
+    def serve():
+        for reply in replies:
+            conn = server.accept()[0]
+            conn.sendall(reply)
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    failed_tests = []
+    condition = PortCondition(port, answer_timeout=0.5)
+    try:
+        condition.start()
+        for expected in [False, True]:
+            if condition.ready() != expected:
+                failed_tests.append([len(failed_tests), expected])
+        thread.join(5)
+    finally:
+        server.close()
+    if condition.ready():
+        failed_tests.append(['closed port', True])
+    if failed_tests:
+        raise Exception(
+                 "PortCondition.ready()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_pacing():
+    """Tests pacers, wait conditions and the time saved by them.
+    """
+    failed_tests = []
+    for spec, keys, elapsed, delay in [
+          ('fixed', 10, 0.1, 0.05), ('fixed:0.5', 10, 0.1, 0.5),
+          ('fixed:0', 10, 0.1, 0), ('fixed:0.0', 10, 0.1, 0),
+          ('confirmed', 10, 0.1, 0), ('rate:20', 10, 0.1, 0.4),
+          ('rate:20', 10, 0.9, 0)]:
+        result = make_pacer(spec, 0.05).delay_after(keys, elapsed)
+        if abs(result - delay) > 1e-9:
+             failed_tests.append([spec, result])
+    for spec in ['fast', 'rate', 'rate:0', 'confirmed:1', 'fixed:-1', 'fixed:x']:
+        try:
+            make_pacer(spec)
+            failed_tests.append([spec, 'no ValueError'])
+        except ValueError:
+            pass
+    condition = make_wait_condition('port:10.0.0.1:2222', 'vm')
+    if (condition.host, condition.port) != ('10.0.0.1', 2222):
+         failed_tests.append(['port:10.0.0.1:2222', condition.__dict__])
+
+    clock = FakeClock()
+    sender = ScancodeSender('vm', 'true', max_codes=2, batch_delay=0.05,
+                            line_wait=2, sleep=clock.sleep,
+                            pacer=ConfirmedPacer(),
+                            wait_condition=FakeCondition(clock, 0.5),
+                            clock=clock.time)
+    sender.send(['1c', '9c', '01', 'wait', 'sleep:100', ''], boot_wait=10)
+    if (clock.slept != [0.2, 0.2, 0.2, 0.0, 0.0, 0.2, 0.2, 0.2, 0.1,
+                        0.2, 0.2, 0.2]
+            or abs(sender.saved - (9.4 + 0.1 + 0.4 + 1.4)) > 1e-9
+            or abs(sender.seconds - 1.9) > 1e-9):
+         failed_tests.append(['ScancodeSender', clock.slept, sender.saved])
+    if failed_tests:
+        raise Exception(
+                 "pacing"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def self_test():
+    """Tests split_batches(), expand_repeats(), read_codes(), DryRunSender,
+    pacing, the port wait condition and ScancodeSender with a stub
+    VBoxManage.
+    """
+    test_split_batches()
+    test_expand_repeats()
+    test_read_codes()
+    test_dry_run()
+    test_pacing()
+    test_port_condition()
+    test_send_with_stub_vboxmanage()
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] VM_NAME < scancodes',
+        description='Types scancodes read from stdin into the VM.'
+                    ' Each input line is one command.')
+    parser.add_option('-m', '--max-codes', type='int', default=DEFAULT_MAX_CODES,
+        help='max number of scancodes per VBoxManage call, exceeded a little'
+             ' to not split a key press [default: %default]')
+    parser.add_option('-d', '--batch-delay', type='float', default=DEFAULT_BATCH_DELAY,
+        help='seconds to sleep after each VBoxManage call [default: %default]')
+    parser.add_option('-p', '--pacing', default='fixed',
+        help='pacing policy: fixed[:SECONDS], confirmed or rate:KEYS_PER_SEC'
+             ' [default: %default]')
+    parser.add_option('-w', '--wait-time', type='float', default=DEFAULT_WAIT_TIME,
+        help='seconds to wait for each wait pseudocode [default: %default]')
+    parser.add_option('-s', '--seq-wait', type='float', default=0,
+        help='seconds to wait after each input line [default: %default]')
+    parser.add_option('-b', '--boot-wait', type='float', default=0,
+        help='seconds to wait before typing [default: %default]')
+    parser.add_option('-f', '--wait-for', default=None, metavar='CONDITION',
+        help='end waits as soon as CONDITION is met:'
+             ' port:[HOST:]PORT or screen')
+    parser.add_option('--vboxmanage', default=os.environ.get('VBOXMANAGE', 'VBoxManage'),
+        help='VBoxManage command to use [default: %default]')
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+        help='only print the batches and sleeps and estimate typing time')
+    parser.add_option('--call-time', type='float', default=DEFAULT_CALL_TIME,
+        help='estimated seconds per VBoxManage call for --dry-run'
+             ' [default: %default]')
+    parser.add_option('-q', '--quiet', action='store_true', default=False,
+        help='do not report keys/sec')
+    parser.add_option('--self-test', action='store_true', default=False,
+        help='run self test and exit')
+    options, args = parser.parse_args(argv)
+    if options.self_test:
+        return options, None
+    if len(args) != 1:
+        parser.error('VM_NAME is required')
+    if options.max_codes < 1:
+        parser.error('--max-codes must be at least 1')
+    return options, args[0]
+
+def main(argv):
+    options, vm_name = parse_args(argv)
+    if options.self_test:
+        self_test()
+        return 0
+    settings = dict(max_codes=options.max_codes,
+                    batch_delay=options.batch_delay,
+                    wait_time=options.wait_time, line_wait=options.seq_wait,
+                    pacer=make_pacer(options.pacing, options.batch_delay))
+    if options.dry_run:
+        sender = DryRunSender(vm_name, call_time=options.call_time, **settings)
+    else:
+        if options.wait_for:
+            settings['wait_condition'] = make_wait_condition(
+                options.wait_for, vm_name, options.vboxmanage)
+        sender = ScancodeSender(vm_name, options.vboxmanage, **settings)
+    # start typing while scancodes are still being read
+    sender.send(read_codes(sys.stdin.fileno()), options.boot_wait)
+    if not options.quiet:
+        print('[INFO] %s' % sender.report())
+    return 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except (RuntimeError, ValueError) as e:
+        sys.stderr.write('Error: %s\n' % e)
+        sys.exit(1)
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
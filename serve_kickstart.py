@@ -0,0 +1,1089 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python serve_kickstart.py --port 7122
+python serve_kickstart.py --port 7122 --proxy-cache ~/.vbkick/proxy --proxy-cache-max-size 10000
+
+Note:
+Script works with python 2.6+ and python 3
+Serves files from the current directory (kickstart files, local repo
+mirrors) to VMs, like 'python -m http.server', but:
+- every connection is handled in its own thread,
+- connections are kept alive (HTTP/1.1) between requests,
+- single 'Range: bytes=...' requests are answered with 206 Partial Content,
+- file bodies are sent with os.sendfile() where available (zero-copy),
+- with --ready-fd the port is written to the given file descriptor
+  as soon as the server listens, so callers don't need to sleep,
+- every request is logged with its time and duration when it's finished,
+  so it's easy to see when the guest really pulled its kickstart.
+
+With --proxy-cache DIR the server is also a caching HTTP proxy for the
+guest (e.g. proxy=http://10.0.2.2:7122 boot option of the installer,
+http_proxy in postinstall scripts): requests with an absolute url are
+fetched from upstream and 200 responses are stored in DIR by url,
+with their validators (ETag, Last-Modified). Packages and checksum
+named repo metadata never change, so repeat fetches are served from
+DIR without asking upstream; other urls are revalidated with a
+conditional request (served from DIR on 304, or when upstream is not
+reachable). The least recently used responses are removed when DIR
+grows over --proxy-cache-max-size. CONNECT (https) is tunnelled, not
+cached. Hits and misses are in the access log and the final report.
+The server listens on 127.0.0.1 by default and the proxy answers only
+local clients (guests behind VirtualBox NAT), it's never an open proxy.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, re, sys, json, time, errno, signal, socket, select, hashlib
+import optparse, tempfile, threading
+
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from http.client import HTTPConnection, HTTPException
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from httplib import HTTPConnection, HTTPException
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit
+
+DEFAULT_PORT = 7122
+COPY_CHUNK_SIZE = 65536
+# max bytes per os.sendfile() call
+SENDFILE_CHUNK_SIZE = 1024 * 1024
+
+# seconds to wait for upstream servers
+PROXY_TIMEOUT = 60
+PROXY_META_SUFFIX = '.meta'
+PROXY_TEMP_PREFIX = '.tmp-'
+# unfinished downloads older than this are left by a killed server
+PROXY_TEMP_MAX_AGE = 3600
+# headers of one connection, not forwarded by the proxy
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'proxy-connection', 'te', 'trailers', 'transfer-encoding', 'upgrade',
+])
+# response headers stored with a cached body
+CACHED_HEADERS = ('content-type', 'etag', 'last-modified')
+# packages and checksum named repo metadata (repodata/<sha256>-primary.sqlite.bz2)
+# never change - served from the cache without revalidation
+IMMUTABLE_URL_RE = re.compile(
+    r'(\.(rpm|drpm|deb|udeb|gem|whl|egg|jar|iso|img)|/[0-9a-f]{32,}-[^/]+)$',
+    re.IGNORECASE)
+
+def parse_range(header, size):
+    """Parses the 'Range' header of a request for a /size/ bytes file.
+    Returns (first, last) byte positions (inclusive) of a single range,
+    None when the header is missing, malformed or asks for many ranges
+    (the whole file is sent then).
+    Raises ValueError when the range can not be satisfied.
+    e.g. 'bytes=0-99', 'bytes=100-', 'bytes=-100' (the last 100 bytes)
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, sep, last = header[len('bytes='):].strip().partition('-')
+    if not sep or not (first + last).isdigit():
+        return None
+    if not first:
+        # suffix range
+        if int(last) == 0 or size == 0:
+            raise ValueError('unsatisfiable range %s' % header)
+        return max(0, size - int(last)), size - 1
+    first = int(first)
+    last = last and min(int(last), size - 1) or size - 1
+    if first >= size or first > last:
+        raise ValueError('unsatisfiable range %s' % header)
+    return first, last
+
+def is_immutable_url(url):
+    return IMMUTABLE_URL_RE.search(urlsplit(url).path) is not None
+
+def is_cacheable(url, status, headers):
+    """Tells whether a response may be stored by the proxy: 200, not
+    private/no-store and either immutable or with a validator to
+    revalidate it later. /headers/ has lower case names.
+    """
+    cache_control = headers.get('cache-control', '').lower()
+    if status != 200 or 'no-store' in cache_control or 'private' in cache_control:
+        return False
+    return (is_immutable_url(url) or 'etag' in headers
+            or 'last-modified' in headers)
+
+def is_loopback(address):
+    """Tells whether a client address is the host itself - guests behind
+    VirtualBox NAT connect from 127.0.0.1 too.
+    """
+    if address.startswith('::ffff:'):
+        address = address[len('::ffff:'):]
+    return address.startswith('127.') or address == '::1'
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        e = sys.exc_info()[1]
+        if e.errno != errno.ENOENT:
+            raise
+
+class ProxyCache(object):
+    """Responses fetched by the proxy, kept on disk across builds.
+    A response body lives in /path/<sha1 of url>, next to a .meta file
+    with the url, status and stored headers (validators). The mtime of
+    the body is its last use time; the least recently used responses
+    are removed when the cache grows over max_size.
+    """
+
+    def __init__(self, path, max_size=0, clock=time.time):
+        self.path = path
+        # bytes, 0 - no limit
+        self.max_size = max_size
+        self.clock = clock
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.scan()
+
+    def scan(self):
+        """Reads sizes and last use times of the cached bodies - other
+        servers may share the directory.
+        """
+        # key -> [size, last_used]
+        index = {}
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if not name.startswith(PROXY_TEMP_PREFIX) and '.' in name:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                # removed by other server meanwhile
+                continue
+            if name.startswith(PROXY_TEMP_PREFIX):
+                if st.st_mtime < self.clock() - PROXY_TEMP_MAX_AGE:
+                    _remove(path)
+                continue
+            index[name] = [st.st_size, st.st_mtime]
+        self.lock.acquire()
+        try:
+            self.index = index
+            self.size = sum(entry[0] for entry in index.values())
+        finally:
+            self.lock.release()
+
+    def key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def lookup(self, url):
+        """Returns (open body file, meta) of the cached response for
+        /url/, None on a miss.
+        """
+        body_path = os.path.join(self.path, self.key(url))
+        try:
+            meta_file = open(body_path + PROXY_META_SUFFIX)
+            try:
+                meta = json.load(meta_file)
+            finally:
+                meta_file.close()
+            body = open(body_path, 'rb')
+        except (IOError, ValueError):
+            return None
+        if meta.get('url') != url:
+            body.close()
+            return None
+        return body, meta
+
+    def touch(self, url):
+        """Marks the response for /url/ as just used."""
+        key = self.key(url)
+        now = self.clock()
+        try:
+            os.utime(os.path.join(self.path, key), (now, now))
+        except OSError:
+            return
+        self.lock.acquire()
+        try:
+            if key in self.index:
+                self.index[key][1] = now
+        finally:
+            self.lock.release()
+
+    def temp_file(self):
+        """Returns (open file, path) for a response being downloaded."""
+        fd, path = tempfile.mkstemp(prefix=PROXY_TEMP_PREFIX, dir=self.path)
+        return os.fdopen(fd, 'wb'), path
+
+    def store(self, url, temp_path, headers):
+        """Moves the downloaded body /temp_path/ into the cache and
+        removes the least recently used responses over max_size.
+        """
+        key = self.key(url)
+        body_path = os.path.join(self.path, key)
+        size = os.stat(temp_path).st_size
+        now = self.clock()
+        from download_media import write_json
+        stored = dict((name, headers[name]) for name in CACHED_HEADERS
+                      if name in headers)
+        write_json(body_path + PROXY_META_SUFFIX, {
+            'url': url, 'status': 200, 'headers': stored, 'size': size,
+            'stored': now,
+        })
+        os.rename(temp_path, body_path)
+        os.utime(body_path, (now, now))
+        self.lock.acquire()
+        try:
+            self.size += size - self.index.get(key, [0])[0]
+            self.index[key] = [size, now]
+        finally:
+            self.lock.release()
+        self.prune(keep=key)
+
+    def remove(self, key):
+        body_path = os.path.join(self.path, key)
+        _remove(body_path)
+        _remove(body_path + PROXY_META_SUFFIX)
+
+    def prune(self, keep=None):
+        """Removes the least recently used responses until the cache fits
+        in max_size. Returns the number of removed responses.
+        """
+        if not self.max_size or self.size <= self.max_size:
+            return 0
+        self.scan()
+        removed = 0
+        self.lock.acquire()
+        try:
+            for key in sorted(self.index, key=lambda key: self.index[key][1]):
+                if self.size <= self.max_size:
+                    break
+                if key == keep:
+                    continue
+                self.remove(key)
+                self.size -= self.index.pop(key)[0]
+                removed += 1
+        finally:
+            self.lock.release()
+        return removed
+
+class KickstartRequestHandler(SimpleHTTPRequestHandler):
+    """Serves files with Range, keep-alive and sendfile support,
+    directories are handled by SimpleHTTPRequestHandler.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'vbkick/0.7'
+
+    def handle_one_request(self):
+        self.started = time.time()
+        self.logged_code = None
+        self.sent_bytes = 0
+        # proxy requests - hit, revalidated, stale, miss, pass, tunnel or error
+        self.cache_status = None
+        self.upstream_bytes = 0
+        SimpleHTTPRequestHandler.handle_one_request(self)
+        if self.logged_code is not None:
+            self.server.log_access(self)
+
+    def log_request(self, code='-', size='-'):
+        # written when the response is finished, see handle_one_request()
+        self.logged_code = code
+
+    def log_error(self, format, *args):
+        # the status code is in the access log already
+        pass
+
+    def log_message(self, format, *args):
+        sys.stderr.write('[WARNING] %s - %s\n'
+                         % (self.client_address[0], format % args))
+
+    def do_GET(self):
+        if self.is_proxy_request():
+            self.proxy(True)
+        else:
+            self.serve(True)
+
+    def do_HEAD(self):
+        if self.is_proxy_request():
+            self.proxy(False)
+        else:
+            self.serve(False)
+
+    def do_CONNECT(self):
+        """Tunnels https to upstream - the proxy can't cache it."""
+        if self.server.proxy_cache is None:
+            self.send_error(501, 'Unsupported method (CONNECT)')
+            return
+        if self.deny_remote_client():
+            return
+        self.cache_status = 'tunnel'
+        host, sep, port = self.path.rpartition(':')
+        try:
+            upstream = socket.create_connection((host, int(port)), PROXY_TIMEOUT)
+        except (socket.error, ValueError):
+            self.cache_status = 'error'
+            self.send_error(502, 'can not connect to %s' % self.path)
+            return
+        self.close_connection = True
+        try:
+            self.send_response(200, 'Connection established')
+            self.end_headers()
+            self.wfile.flush()
+            sockets = [self.connection, upstream]
+            while True:
+                readable = select.select(sockets, [], [], PROXY_TIMEOUT)[0]
+                if not readable:
+                    return
+                for sock in readable:
+                    data = sock.recv(COPY_CHUNK_SIZE)
+                    if not data:
+                        return
+                    if sock is upstream:
+                        self.connection.sendall(data)
+                        self.sent_bytes += len(data)
+                        self.upstream_bytes += len(data)
+                    else:
+                        upstream.sendall(data)
+        finally:
+            upstream.close()
+
+    def deny_remote_client(self):
+        """Answers 403 to proxy requests which don't come from the host,
+        so the proxy is never open to the network. True when denied.
+        """
+        if is_loopback(self.client_address[0]):
+            return False
+        self.cache_status = 'error'
+        self.send_error(403, 'Proxy is for local clients only')
+        return True
+
+    def is_proxy_request(self):
+        return (self.server.proxy_cache is not None
+                and self.path.startswith('http://'))
+
+    def proxy(self, send_body):
+        """Answers a proxy request from the cache or upstream."""
+        url = self.path
+        cache = self.server.proxy_cache
+        if self.deny_remote_client():
+            return
+        if not urlsplit(url).hostname:
+            self.cache_status = 'error'
+            self.send_error(400, 'Bad proxy request %s' % url)
+            return
+        # partial and authorized responses are not shared
+        cacheable = 'Range' not in self.headers and 'Authorization' not in self.headers
+        cached = cacheable and cache.lookup(url) or None
+        try:
+            if cached is not None and is_immutable_url(url):
+                self.cache_status = 'hit'
+                self.send_cached(url, cached, send_body)
+                return
+            try:
+                conn, response = self.fetch(url, cacheable, cached)
+            except (socket.error, HTTPException):
+                if cached is not None:
+                    # upstream is not reachable - the last copy is better than nothing
+                    self.cache_status = 'stale'
+                    self.send_cached(url, cached, send_body)
+                    return
+                self.cache_status = 'error'
+                self.send_error(502, 'can not fetch %s: %s' % (url, sys.exc_info()[1]))
+                return
+            try:
+                if cached is not None and response.status == 304:
+                    response.read()
+                    self.cache_status = 'revalidated'
+                    self.send_cached(url, cached, send_body)
+                    return
+                headers = dict((name.lower(), value)
+                               for name, value in response.getheaders())
+                store = (cacheable and self.command == 'GET'
+                         and is_cacheable(url, response.status, headers))
+                self.cache_status = store and 'miss' or 'pass'
+                self.relay(url, response, headers, store)
+            finally:
+                conn.close()
+        finally:
+            if cached is not None:
+                cached[0].close()
+
+    def fetch(self, url, cacheable, cached):
+        """Sends the request to upstream - conditional when the response
+        is cached. Returns (connection, response).
+        """
+        headers = {}
+        for name, value in self.headers.items():
+            if name.lower() in HOP_BY_HOP_HEADERS or name.lower() == 'host':
+                continue
+            # a stored body is always plain, whoever asks for it next
+            if cacheable and name.lower() == 'accept-encoding':
+                continue
+            if cached is not None and name.lower() in ('if-none-match', 'if-modified-since'):
+                continue
+            headers[name] = value
+        if cached is not None:
+            stored = cached[1].get('headers', {})
+            if 'etag' in stored:
+                headers['If-None-Match'] = stored['etag']
+            if 'last-modified' in stored:
+                headers['If-Modified-Since'] = stored['last-modified']
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        conn = HTTPConnection(parts.hostname, parts.port or 80, timeout=PROXY_TIMEOUT)
+        try:
+            conn.request(self.command, path, headers=headers)
+            return conn, conn.getresponse()
+        except (socket.error, HTTPException):
+            conn.close()
+            raise
+
+    def relay(self, url, response, headers, store):
+        """Sends the upstream response to the guest, the body is stored
+        in the cache too when /store/ is set.
+        """
+        self.send_response(response.status, response.reason)
+        for name, value in response.getheaders():
+            if name.lower() not in HOP_BY_HOP_HEADERS:
+                self.send_header(name, value)
+        length = headers.get('content-length')
+        has_body = (self.command != 'HEAD' and response.status >= 200
+                    and response.status not in (204, 304))
+        if has_body and length is None:
+            # the end of the body is the end of the connection
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        if not has_body:
+            response.read()
+            return
+        out = None
+        if store:
+            out, temp_path = self.server.proxy_cache.temp_file()
+        complete = False
+        try:
+            while True:
+                data = response.read(COPY_CHUNK_SIZE)
+                if not data:
+                    break
+                self.upstream_bytes += len(data)
+                if out is not None:
+                    out.write(data)
+                self.wfile.write(data)
+                self.sent_bytes += len(data)
+            complete = length is None or self.upstream_bytes == int(length)
+        finally:
+            if out is not None:
+                out.close()
+                if complete:
+                    self.server.proxy_cache.store(url, temp_path, headers)
+                else:
+                    _remove(temp_path)
+
+    def send_cached(self, url, cached, send_body):
+        """Sends the cached response, the body with sendfile."""
+        body, meta = cached
+        size = os.fstat(body.fileno()).st_size
+        self.send_response(200)
+        for name, value in sorted(meta.get('headers', {}).items()):
+            self.send_header(name, value)
+        if self.cache_status == 'stale':
+            self.send_header('Warning', '110 - "Response is Stale"')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        if send_body:
+            self.send_file(body, 0, size)
+        self.server.proxy_cache.touch(url)
+
+    def serve(self, send_body):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or not os.path.isfile(path):
+            # index.html, directory listing or 404
+            body = self.send_head()
+            if body is not None:
+                try:
+                    if send_body:
+                        self.copyfile(body, self.wfile)
+                finally:
+                    body.close()
+            return
+        try:
+            body = open(path, 'rb')
+        except IOError:
+            self.send_error(404, 'File not found')
+            return
+        try:
+            size = os.fstat(body.fileno()).st_size
+            try:
+                byte_range = parse_range(self.headers.get('Range'), size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range is None:
+                first, last = 0, size - 1
+                self.send_response(200)
+            else:
+                first, last = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (first, last, size))
+            self.send_header('Content-Type', self.guess_type(path))
+            self.send_header('Content-Length', str(last - first + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Last-Modified',
+                self.date_time_string(os.fstat(body.fileno()).st_mtime))
+            self.end_headers()
+            if send_body:
+                self.send_file(body, first, last - first + 1)
+        finally:
+            body.close()
+
+    def send_file(self, body, offset, count):
+        """Sends /count/ bytes of the open file /body/ from /offset/,
+        with os.sendfile() when available.
+        """
+        self.wfile.flush()
+        if hasattr(os, 'sendfile'):
+            out_fd = self.connection.fileno()
+            while count > 0:
+                sent = os.sendfile(out_fd, body.fileno(), offset,
+                                   min(count, SENDFILE_CHUNK_SIZE))
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+                self.sent_bytes += sent
+            return
+        body.seek(offset)
+        while count > 0:
+            data = body.read(min(count, COPY_CHUNK_SIZE))
+            if not data:
+                break
+            self.wfile.write(data)
+            count -= len(data)
+            self.sent_bytes += len(data)
+
+    def copyfile(self, source, outputfile):
+        while True:
+            data = source.read(COPY_CHUNK_SIZE)
+            if not data:
+                break
+            outputfile.write(data)
+            self.sent_bytes += len(data)
+
+class KickstartServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server which keeps per-request access timing.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler=KickstartRequestHandler,
+                 log=sys.stdout, access_log=None, proxy_cache=None):
+        HTTPServer.__init__(self, address, handler)
+        self.log = log
+        self.access_log = access_log
+        self.proxy_cache = proxy_cache
+        self.requests = 0
+        self.sent_bytes = 0
+        # proxy requests by cache status, bytes sent from the cache and fetched from upstream
+        self.proxy_stats = {}
+        self.cache_bytes = 0
+        self.upstream_bytes = 0
+        self.lock = threading.Lock()
+
+    def log_access(self, handler):
+        """Logs a finished request: when it started, how long it took,
+        status code and bytes sent.
+        """
+        seconds = time.time() - handler.started
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                  time.localtime(handler.started)),
+            'client': handler.client_address[0],
+            'request': handler.requestline,
+            'status': int(handler.logged_code),
+            'bytes': handler.sent_bytes,
+            'seconds': round(seconds, 6),
+        }
+        cache_info = ''
+        if handler.cache_status is not None:
+            entry['cache'] = handler.cache_status
+            cache_info = ' cache %s' % handler.cache_status
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            self.sent_bytes += handler.sent_bytes
+            if handler.cache_status is not None:
+                self.proxy_stats[handler.cache_status] = (
+                    self.proxy_stats.get(handler.cache_status, 0) + 1)
+                self.upstream_bytes += handler.upstream_bytes
+                if handler.cache_status in ('hit', 'revalidated', 'stale'):
+                    self.cache_bytes += handler.sent_bytes
+            self.log.write('[INFO] %(time)s %(client)s "%(request)s"'
+                           ' %(status)d %(bytes)d bytes' % entry
+                           + ' %.1f ms%s\n' % (seconds * 1000, cache_info))
+            self.log.flush()
+            if self.access_log is not None:
+                self.access_log.write(json.dumps(entry, sort_keys=True) + '\n')
+                self.access_log.flush()
+        finally:
+            self.lock.release()
+
+    def report(self):
+        report = '%d requests served, %d bytes sent' % (self.requests,
+                                                       self.sent_bytes)
+        if self.proxy_cache is not None:
+            report += ', proxy: %s' % self.proxy_report()
+        return report
+
+    def hit_rate(self):
+        """Share of cacheable proxy requests answered from the cache."""
+        stats = self.proxy_stats
+        hits = stats.get('hit', 0) + stats.get('revalidated', 0) + stats.get('stale', 0)
+        lookups = hits + stats.get('miss', 0)
+        return lookups and hits / lookups or 0.0
+
+    def proxy_report(self):
+        stats = self.proxy_stats
+        return ('%d hits (%d revalidated, %d stale), %d misses, %d not cacheable,'
+                ' %d tunnels, %d errors, hit rate %.0f%%, %d bytes from cache,'
+                ' %d bytes from upstream, cache %.1f MB' % (
+                    stats.get('hit', 0) + stats.get('revalidated', 0) + stats.get('stale', 0),
+                    stats.get('revalidated', 0), stats.get('stale', 0),
+                    stats.get('miss', 0), stats.get('pass', 0),
+                    stats.get('tunnel', 0), stats.get('error', 0),
+                    self.hit_rate() * 100, self.cache_bytes, self.upstream_bytes,
+                    self.proxy_cache.size / 1e6))
+
+def signal_ready(fd, port):
+    """Writes the port number to the file descriptor /fd/ and closes it."""
+    os.write(fd, ('%d\n' % port).encode('ascii'))
+    os.close(fd)
+
+def test_parse_range():
+    """Tests parse_range().
+    """
+    test_data = [
+      (None, 100, None),
+      ('bytes=0-9', 100, (0, 9)),
+      ('bytes=90-', 100, (90, 99)),
+      ('bytes=-10', 100, (90, 99)),
+      ('bytes=-500', 100, (0, 99)),
+      ('bytes=50-500', 100, (50, 99)),
+      ('bytes=0-1,5-6', 100, None),
+      ('items=0-9', 100, None),
+      ('bytes=a-b', 100, None),
+      ('bytes=100-', 100, ValueError),
+      ('bytes=9-1', 100, ValueError),
+      ('bytes=-0', 100, ValueError),
+    ]
+
+    failed_tests = []
+    for header, size, expected in test_data:
+        try:
+            result = parse_range(header, size)
+        except ValueError:
+            result = ValueError
+        if result != expected:
+             failed_tests.append([header, size, result])
+    if failed_tests:
+        raise Exception(
+                 "parse_range()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_serve():
+    """Serves a temporary directory on a free port and checks
+    readiness signal, keep-alive, Range and access log.
+    """
+    import io, shutil, tempfile
+    try:
+        from http.client import HTTPConnection
+    except ImportError:
+        from httplib import HTTPConnection
+    tmp_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    log = io.StringIO()
+    failed_tests = []
+    try:
+        ks_file = open(os.path.join(tmp_dir, 'ks.cfg'), 'wb')
+        ks_file.write(b'0123456789' * 1000)
+        ks_file.close()
+        os.chdir(tmp_dir)
+        server = KickstartServer(('127.0.0.1', 0), log=log)
+        read_fd, write_fd = os.pipe()
+        signal_ready(write_fd, server.server_address[1])
+        port = int(os.read(read_fd, 64))
+        os.close(read_fd)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            conn = HTTPConnection('127.0.0.1', port)
+            results = []
+            for headers in [{}, {'Range': 'bytes=10-14'},
+                            {'Range': 'bytes=-3'}, {'Range': 'bytes=20000-'}]:
+                conn.request('GET', '/ks.cfg', headers=headers)
+                response = conn.getresponse()
+                results.append((response.status, len(response.read()),
+                                response.getheader('Content-Range')))
+            conn.request('GET', '/missing')
+            response = conn.getresponse()
+            response.read()
+            results.append((response.status,))
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+    expected = [(200, 10000, None), (206, 5, 'bytes 10-14/10000'),
+                (206, 3, 'bytes 9997-9999/10000'), (416, 0, 'bytes */10000'),
+                (404,)]
+    if port != server.server_address[1] or results != expected:
+         failed_tests.append(['responses', results])
+    lines = log.getvalue().splitlines()
+    if (len(lines) != 5 or '"GET /ks.cfg HTTP/1.1" 200 10000 bytes' not in lines[0]
+            or server.sent_bytes != 10008):
+         failed_tests.append(['access log', lines, server.sent_bytes])
+    if failed_tests:
+        raise Exception(
+                 "KickstartServer"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_proxy_cache():
+    """Checks ProxyCache store/lookup, is_cacheable() and LRU eviction.
+    """
+    import shutil
+    tmp_dir = tempfile.mkdtemp()
+    failed_tests = []
+    now = [1000.0]
+    try:
+        cache = ProxyCache(tmp_dir, max_size=250, clock=lambda: now[0])
+        urls = ['http://mirror/os/Packages/%s.rpm' % name for name in 'abc']
+        for url in urls:
+            now[0] += 1
+            out, temp_path = cache.temp_file()
+            out.write(b'x' * 100)
+            out.close()
+            cache.store(url, temp_path, {'content-type': 'application/x-rpm',
+                                         'content-length': '100'})
+            if url == urls[1]:
+                # a is used again - b is the least recently used
+                now[0] += 1
+                cache.touch(urls[0])
+        found = []
+        for url in urls + ['http://mirror/other']:
+            cached = cache.lookup(url)
+            found.append(cached is not None)
+            if cached is not None:
+                cached[0].close()
+                if cached[1]['headers'] != {'content-type': 'application/x-rpm'}:
+                    failed_tests.append(['meta', cached[1]])
+        if found != [True, False, True, False] or cache.size != 200:
+            failed_tests.append(['lru', found, cache.size])
+        # a new server finds the same responses
+        leftovers = [name for name in os.listdir(tmp_dir)
+                     if name.startswith(PROXY_TEMP_PREFIX) or name.endswith('.tmp')]
+        if ProxyCache(tmp_dir).size != 200 or leftovers:
+            failed_tests.append(['scan', sorted(os.listdir(tmp_dir))])
+    finally:
+        shutil.rmtree(tmp_dir)
+    test_data = [
+      ('http://m/Packages/a.rpm', 200, {}, True),
+      ('http://m/Packages/a.rpm', 404, {}, False),
+      ('http://m/Packages/a.rpm', 200, {'cache-control': 'private'}, False),
+      ('http://m/repodata/repomd.xml', 200, {}, False),
+      ('http://m/repodata/repomd.xml', 200, {'etag': '"1"'}, True),
+      ('http://m/repodata/repomd.xml', 200, {'cache-control': 'no-store', 'etag': '"1"'}, False),
+      ('http://m/repodata/0123456789abcdef0123456789abcdef-primary.sqlite.bz2', 200, {}, True),
+      ('http://m/mirrorlist?release=6&arch=x86_64', 200, {}, False),
+      ('http://m/a.rpm?arch=x86_64', 200, {}, True),
+    ]
+    for url, status, headers, expected in test_data:
+        result = is_cacheable(url, status, headers)
+        if result != expected:
+             failed_tests.append([url, status, headers, result])
+    if failed_tests:
+        raise Exception(
+                 "ProxyCache"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+class _UpstreamHandler(SimpleHTTPRequestHandler):
+    """Upstream stand-in for test_proxy(): a package, repo metadata with
+    ETag and an uncacheable mirrorlist. Counts requests by path.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    bodies = {
+        '/os/Packages/bash.rpm': b'rpm' * 10000,
+        '/os/repodata/repomd.xml': b'<repomd/>',
+        '/mirrorlist': b'http://127.0.0.1/os/',
+    }
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.seen.append((self.path, self.headers.get('If-None-Match'),
+                                 self.headers.get('Accept-Encoding')))
+        body = self.bodies.get(self.path)
+        if body is None:
+            self.send_error(404, 'File not found')
+            return
+        if self.path.endswith('.xml'):
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        if self.path.endswith('.xml'):
+            self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+def test_proxy():
+    """Runs KickstartServer with a proxy cache in front of a local
+    upstream stand-in: misses, hits without upstream requests, 304
+    revalidation, stale copies when upstream is down, pass-through of
+    uncacheable responses and the stats.
+    """
+    import io, shutil
+    tmp_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    log = io.StringIO()
+    failed_tests = []
+    try:
+        os.chdir(tmp_dir)
+        upstream = HTTPServer(('127.0.0.1', 0), _UpstreamHandler)
+        upstream.seen = []
+        up_thread = threading.Thread(target=upstream.serve_forever)
+        up_thread.daemon = True
+        up_thread.start()
+        up_url = 'http://127.0.0.1:%d' % upstream.server_address[1]
+        server = KickstartServer(('127.0.0.1', 0), log=log,
+                                 proxy_cache=ProxyCache(os.path.join(tmp_dir, 'cache')))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            conn = HTTPConnection('127.0.0.1', server.server_address[1])
+            results = []
+            def get(path, method='GET'):
+                conn.request(method, up_url + path, headers={'Accept-Encoding': 'gzip'})
+                response = conn.getresponse()
+                body = response.read()
+                results.append((path, response.status, len(body)))
+                return body
+            get('/os/Packages/bash.rpm')
+            if get('/os/Packages/bash.rpm') != _UpstreamHandler.bodies['/os/Packages/bash.rpm']:
+                failed_tests.append(['hit body'])
+            get('/os/Packages/bash.rpm', 'HEAD')
+            get('/os/repodata/repomd.xml')
+            get('/os/repodata/repomd.xml')
+            get('/mirrorlist')
+            get('/mirrorlist')
+            get('/missing.rpm')
+            upstream.shutdown()
+            upstream.server_close()
+            get('/os/repodata/repomd.xml')
+            get('/mirrorlist')
+            conn.close()
+            # requests are counted just after their response is sent
+            deadline = time.time() + 5
+            while server.requests < len(results) and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+    expected = [('/os/Packages/bash.rpm', 200, 30000), ('/os/Packages/bash.rpm', 200, 30000),
+                ('/os/Packages/bash.rpm', 200, 0), ('/os/repodata/repomd.xml', 200, 9),
+                ('/os/repodata/repomd.xml', 200, 9), ('/mirrorlist', 200, 20),
+                ('/mirrorlist', 200, 20), ('/missing.rpm', 404),
+                ('/os/repodata/repomd.xml', 200, 9), ('/mirrorlist', 502)]
+    # error pages differ between python versions
+    if [result[:len(wanted)] for result, wanted in zip(results, expected)] != expected:
+         failed_tests.append(['responses', results])
+    # the package once, repomd.xml revalidated, mirrorlist every time, no gzip asked for stored bodies
+    seen = [(path, etag) for path, etag, encoding in upstream.seen]
+    if seen != [('/os/Packages/bash.rpm', None), ('/os/repodata/repomd.xml', None),
+                ('/os/repodata/repomd.xml', '"v1"'), ('/mirrorlist', None),
+                ('/mirrorlist', None), ('/missing.rpm', None)]:
+         failed_tests.append(['upstream requests', upstream.seen])
+    if [encoding for path, etag, encoding in upstream.seen if encoding != 'identity']:
+         failed_tests.append(['accept-encoding', upstream.seen])
+    stats = server.proxy_stats
+    if (stats != {'hit': 2, 'miss': 2, 'revalidated': 1, 'stale': 1, 'pass': 3, 'error': 1}
+            or server.hit_rate() != 4 / 6 or server.cache_bytes != 30018
+            or server.upstream_bytes != 30000 + 9 + 40 + results[7][2]):
+         failed_tests.append(['stats', stats, server.cache_bytes, server.upstream_bytes])
+    if 'cache hit' not in log.getvalue() or 'hit rate 67%' not in server.report():
+         failed_tests.append(['report', server.report()])
+    if failed_tests:
+        raise Exception(
+                 "KickstartServer proxy"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+class _RemoteClientHandler(KickstartRequestHandler):
+    """Sees every client as a remote host, see test_proxy_clients()."""
+
+    def setup(self):
+        self.client_address = ('192.0.2.1', self.client_address[1])
+        KickstartRequestHandler.setup(self)
+
+def test_proxy_clients():
+    """Checks is_loopback() and that the proxy (GET and CONNECT) refuses
+    clients which are not the host, while files are still served.
+    """
+    import io, shutil
+    failed_tests = []
+    test_data = [
+      ('127.0.0.1', True),
+      ('127.1.2.3', True),
+      ('::1', True),
+      ('::ffff:127.0.0.1', True),
+      ('10.0.2.15', False),
+      ('192.168.1.7', False),
+      ('::ffff:192.168.1.7', False),
+      ('fe80::1', False),
+    ]
+    for address, expected in test_data:
+        result = is_loopback(address)
+        if result != expected:
+             failed_tests.append([address, result])
+    tmp_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmp_dir)
+        open('ks.cfg', 'w').close()
+        server = KickstartServer(('127.0.0.1', 0), _RemoteClientHandler, log=io.StringIO(),
+                                 proxy_cache=ProxyCache(os.path.join(tmp_dir, 'cache')))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            results = []
+            for method, path in [('GET', '/ks.cfg'),
+                                 ('GET', 'http://127.0.0.1:%d/ks.cfg' % server.server_address[1]),
+                                 ('CONNECT', '127.0.0.1:%d' % server.server_address[1])]:
+                conn = HTTPConnection('127.0.0.1', server.server_address[1])
+                conn.request(method, path)
+                response = conn.getresponse()
+                response.read()
+                results.append(response.status)
+                conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+    if results != [200, 403, 403]:
+         failed_tests.append(['responses', results])
+    if failed_tests:
+        raise Exception(
+                 "KickstartServer proxy clients"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def self_test():
+    """Tests parse_range(), ProxyCache and KickstartServer (also as
+    a caching proxy) on free local ports.
+    """
+    test_parse_range()
+    test_serve()
+    test_proxy_cache()
+    test_proxy()
+    test_proxy_clients()
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Serves files from the current directory to VMs.')
+    parser.add_option('-p', '--port', type='int', default=DEFAULT_PORT,
+        help='port to listen on, 0 - any free port [default: %default]')
+    parser.add_option('-b', '--bind', default='127.0.0.1',
+        help='address to listen on, guests behind VirtualBox NAT reach'
+             ' 127.0.0.1 as 10.0.2.2 [default: %default]')
+    parser.add_option('-d', '--directory', default='.',
+        help='directory to serve [default: %default]')
+    parser.add_option('-r', '--ready-fd', type='int', default=None,
+        help='write the port to this file descriptor when ready')
+    parser.add_option('-a', '--access-log', default=None, metavar='FILE',
+        help='append JSON access log entries to FILE')
+    parser.add_option('--proxy-cache', default=None, metavar='DIR',
+        help='act as a caching HTTP proxy too, responses are kept in DIR')
+    parser.add_option('--proxy-cache-max-size', type='int', default=0, metavar='MB',
+        help='evict least recently used responses over this size, 0 - no limit'
+             ' [default: %default]')
+    parser.add_option('--self-test', action='store_true', default=False,
+        help='run self test and exit')
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+    return options
+
+def _terminate(signum, frame):
+    sys.exit(0)
+
+def main(argv):
+    options = parse_args(argv)
+    if options.self_test:
+        self_test()
+        return 0
+    proxy_cache = None
+    if options.proxy_cache:
+        proxy_cache = ProxyCache(os.path.abspath(options.proxy_cache),
+                                 options.proxy_cache_max_size * 1000 * 1000)
+    os.chdir(options.directory)
+    access_log = None
+    if options.access_log:
+        access_log = open(options.access_log, 'a')
+    server = KickstartServer((options.bind, options.port), access_log=access_log,
+                             proxy_cache=proxy_cache)
+    port = server.server_address[1]
+    print('[INFO] serving %s on port %d' % (os.getcwd(), port))
+    if proxy_cache is not None:
+        print('[INFO] caching proxy on port %d, cache %s (%.1f MB)'
+              % (port, proxy_cache.path, proxy_cache.size / 1e6))
+    sys.stdout.flush()
+    if options.ready_fd is not None:
+        signal_ready(options.ready_fd, port)
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('[INFO] %s' % server.report())
+        if access_log is not None:
+            access_log.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,465 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python vm_state.py centos65
+VBoxManage showvminfo --machinereadable centos65 | python vm_state.py -
+python vm_state.py --list --state running 'centos*'
+python vm_state.py --list --snapshot vbkick-build-1493251130-4021
+
+Note:
+Script works with python 2.6+ and python 3
+Runs 'VBoxManage showvminfo --machinereadable' once and prints the facts
+vbkick checks about a VM, one per line:
+
+state=running
+forwarding=vbkickSSH,tcp,,2222,,22
+sharedfolder=vbkick
+medium=SATA Controller-1-0
+disk=/home/vbkick/VirtualBox VMs/centos65/centos65-2.vdi
+macaddress1=0800272E6A8C
+snapshot=base
+
+vbkick keeps this output for the whole action and tests it with shell
+pattern matching, instead of forking showvminfo for every check.
+forwarding lines are NAT rules of the first network adapter (natpf1).
+medium lines are storage controller slots with something attached
+(including an empty dvd drive), disk lines are paths of attached hard
+disk images (the current differencing image when the VM has
+snapshots). snapshot lines are names of all
+snapshots of the VM.
+
+With --list the states of all VMs are read with one
+'VBoxManage list -l vms' call and printed as "vm name:state";
+--snapshot NAME lists only VMs which have that snapshot.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import re, sys, json, fnmatch, optparse, subprocess
+
+# "key"="value" or key="value" or key=number
+LINE_RE = re.compile(r'^("(?:[^"\\]|\\.)*"|[^=]+)=(.*)$')
+# storage controller slot, e.g. "SATA Controller-1-0", not "SATA Controller-ImageUUID-1-0"
+MEDIUM_KEY_RE = re.compile(r'^(?!.*-ImageUUID-).+-\d+-\d+$')
+# hard disk images, not dvd/floppy images
+DISK_RE = re.compile(r'\.(vdi|vmdk|vhd|hdd)$', re.IGNORECASE)
+
+# 'list -l vms' - "State:           powered off (since 2014-05-21T18:02:11.000000000)"
+LIST_STATE_RE = re.compile(r'^State:\s+(.*?)\s*(?:\(since (.*)\))?\s*$')
+# a VM record starts with Name: followed by Groups: (4.2+) or Guest OS:, or
+# with Name: after a blank line (inaccessible VMs) - other sections, e.g.
+# USB device filters, have their own Name: lines
+LIST_RECORD_RE = re.compile(r'^(Groups|Guest OS):')
+# shared folder lines also start with Name: - "Name: 'vbkick', Host path: ..."
+LIST_SHARED_FOLDER_RE = re.compile(r"^Name:\s+'.*', Host path: ")
+# snapshots are indented by depth - "   Name: base (UUID: 5c2b8b8e-...) *"
+LIST_SNAPSHOT_RE = re.compile(r'^\s+Name:\s+(.*) \(UUID: [0-9a-fA-F-]+\)( \*)?\s*$')
+# SnapshotName, SnapshotName-1, SnapshotName-1-1 - one key per snapshot in the tree
+SNAPSHOT_KEY_RE = re.compile(r'^SnapshotName(-\d+)*$')
+INACCESSIBLE_NAME = '<inaccessible!>'
+
+class VMStateError(Exception):
+    pass
+
+def _unquote(text):
+    if len(text) >= 2 and text[0] == '"' and text[-1] == '"':
+        return re.sub(r'\\(.)', r'\1', text[1:-1])
+    return text
+
+def _is_closed(value):
+    """Whether a quoted value ends on this line - "abc" but not "abc\\" """
+    if not value.startswith('"'):
+        return True
+    # the closing quote is not escaped by an odd number of backslashes
+    return re.search(r'(^|[^\\])(\\\\)*"$', value[1:]) is not None
+
+def parse_machinereadable(text):
+    """Returns (key, value) pairs from 'showvminfo --machinereadable'
+    output, in order. Keys may repeat (e.g. Forwarding(0) for each NAT
+    adapter), quoted values may span lines (description).
+    """
+    pairs = []
+    lines = iter(text.splitlines())
+    for line in lines:
+        match = LINE_RE.match(line)
+        if not match:
+            continue
+        key, value = match.group(1), match.group(2)
+        while value.startswith('"') and not _is_closed(value):
+            try:
+                value += '\n' + next(lines)
+            except StopIteration:
+                break
+        pairs.append((_unquote(key), _unquote(value)))
+    return pairs
+
+class VMState(object):
+    """Facts about a VM which vbkick checks, from parsed showvminfo."""
+
+    def __init__(self, pairs):
+        self.state = None
+        self.forwardings = []
+        self.shared_folders = []
+        self.media = []
+        self.disks = []
+        self.mac_addresses = []
+        self.snapshots = []
+        # NAT rules follow the natnetN key of their adapter
+        nic = None
+        for key, value in pairs:
+            if key == 'VMState':
+                self.state = value
+            elif key.startswith('natnet'):
+                nic = key[len('natnet'):]
+            elif key.startswith('Forwarding(') and nic == '1':
+                self.forwardings.append(value)
+            elif key.startswith('SharedFolderName'):
+                self.shared_folders.append(value)
+            elif key.startswith('macaddress'):
+                self.mac_addresses.append((key, value))
+            elif MEDIUM_KEY_RE.match(key) and value != 'none':
+                self.media.append(key)
+                if DISK_RE.search(value):
+                    self.disks.append(value)
+            elif SNAPSHOT_KEY_RE.match(key):
+                self.snapshots.append(value)
+
+    def lines(self):
+        lines = ['state=%s' % (self.state or '')]
+        lines.extend('forwarding=%s' % rule for rule in self.forwardings)
+        lines.extend('sharedfolder=%s' % name for name in self.shared_folders)
+        lines.extend('medium=%s' % slot for slot in self.media)
+        lines.extend('disk=%s' % path for path in self.disks)
+        lines.extend('%s=%s' % pair for pair in self.mac_addresses)
+        lines.extend('snapshot=%s' % name for name in self.snapshots)
+        return lines
+
+    def as_dict(self):
+        return {
+            'state': self.state, 'forwardings': self.forwardings,
+            'shared_folders': self.shared_folders, 'media': self.media,
+            'disks': self.disks,
+            'mac_addresses': dict(self.mac_addresses),
+            'snapshots': self.snapshots,
+        }
+
+def parse_list_long(text):
+    """Returns [{name, uuid, state, since, snapshots}] from 'VBoxManage
+    list -l vms' output - all VMs in one pass. Inaccessible VMs have
+    'inaccessible' state.
+    """
+    vms = []
+    vm = None
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        if (line.startswith('Name:') and not LIST_SHARED_FOLDER_RE.match(line)
+                and (i == 0 or not lines[i - 1].strip()
+                     or LIST_RECORD_RE.match(i + 1 < len(lines) and lines[i + 1] or ''))):
+            name = line[len('Name:'):].strip()
+            vm = {'name': name, 'uuid': None, 'state': None, 'since': None,
+                  'snapshots': []}
+            if name == INACCESSIBLE_NAME:
+                vm['state'] = 'inaccessible'
+            vms.append(vm)
+        elif vm is None:
+            continue
+        elif line.startswith('UUID:') and vm['uuid'] is None:
+            vm['uuid'] = line[len('UUID:'):].strip()
+        elif line.startswith('State:') and vm['state'] is None:
+            match = LIST_STATE_RE.match(line)
+            vm['state'], vm['since'] = match.group(1), match.group(2)
+        elif LIST_SNAPSHOT_RE.match(line):
+            vm['snapshots'].append(LIST_SNAPSHOT_RE.match(line).group(1))
+    return vms
+
+def _state_key(state):
+    # "powered off", "PoweredOff" and "poweroff" are the same state
+    return re.sub(r'[\s_-]', '', (state or '').lower()).replace('powered', 'power')
+
+def filter_vms(vms, states=None, patterns=None, snapshot=None):
+    """Keeps VMs in one of /states/ whose name matches one of the
+    shell /patterns/ and which have /snapshot/; None or empty - no filtering.
+    """
+    if states:
+        wanted = set(_state_key(state) for state in states)
+        vms = [vm for vm in vms if _state_key(vm['state']) in wanted]
+    if patterns:
+        vms = [vm for vm in vms
+               if [p for p in patterns if fnmatch.fnmatchcase(vm['name'], p)]]
+    if snapshot:
+        vms = [vm for vm in vms if snapshot in vm['snapshots']]
+    return vms
+
+def _vboxmanage(vboxmanage, args):
+    proc = subprocess.Popen([vboxmanage] + args,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise VMStateError('%s %s failed: %s' % (vboxmanage, ' '.join(args),
+                           err.decode('utf-8', 'replace').strip()))
+    return out.decode('utf-8', 'replace')
+
+def showvminfo(vm, vboxmanage='VBoxManage'):
+    return _vboxmanage(vboxmanage, ['showvminfo', '--machinereadable', vm])
+
+def list_vms(vboxmanage='VBoxManage'):
+    return parse_list_long(_vboxmanage(vboxmanage, ['list', '-l', 'vms']))
+
+# recorded 'VBoxManage showvminfo --machinereadable' output (VirtualBox 4.3)
+FIXTURE_RUNNING = '''name="centos65"
+groups="/"
+ostype="Red Hat (64 bit)"
+UUID="4bd1fb7e-0a33-4f58-b5ce-14cfb1b0c0a1"
+CfgFile="/home/vbkick/VirtualBox VMs/centos65/centos65.vbox"
+memory=512
+VMState="running"
+VMStateChangeTime="2014-05-20T09:12:51.184000000"
+description="kickstarted by vbkick
+second line with \\"quotes\\""
+storagecontrollername0="SATA Controller"
+storagecontrollertype0="IntelAhci"
+storagecontrollerportcount0="3"
+"SATA Controller-0-0"="/home/vbkick/VirtualBox VMs/centos65/centos65_0.vdi"
+"SATA Controller-ImageUUID-0-0"="b5a1c9d2-6f0e-4c55-9a6a-3f3d2b6c1e10"
+"SATA Controller-1-0"="emptydrive"
+"SATA Controller-IsEjected"="off"
+"SATA Controller-2-0"="none"
+natnet1="nat"
+macaddress1="0800272E6A8C"
+cableconnected1="on"
+nic1="nat"
+nictype1="82540EM"
+Forwarding(0)="vbkickSSH,tcp,,2222,,22"
+Forwarding(1)="http,tcp,,8080,,80"
+nic2="none"
+SharedFolderNameMachineMapping1="vbkick"
+SharedFolderPathMachineMapping1="/home/vbkick/centos"
+GuestAdditionsVersion="4.3.10 r93012"
+SnapshotName="base"
+SnapshotUUID="5c2b8b8e-2b79-4d89-9e39-3c5b8b1d7a11"
+SnapshotName-1="vbkick-build-1493251130-4021"
+SnapshotUUID-1="6d3c9c9f-3c8a-4e9a-8f4a-4d6c9c2e8b22"
+CurrentSnapshotName="vbkick-build-1493251130-4021"
+CurrentSnapshotUUID="6d3c9c9f-3c8a-4e9a-8f4a-4d6c9c2e8b22"
+CurrentSnapshotNode="SnapshotName-1"
+'''
+
+FIXTURE_POWEROFF = '''name="debian"
+VMState="poweroff"
+VMStateChangeTime="2014-05-21T18:02:11.000000000"
+storagecontrollername0="IDE Controller"
+"IDE Controller-0-0"="/home/vbkick/VirtualBox VMs/debian/debian_0.vdi"
+"IDE Controller-0-1"="none"
+"IDE Controller-1-0"="none"
+natnet1="nat"
+macaddress1="080027D1A3B2"
+nic1="nat"
+natnet2="nat"
+macaddress2="080027D1A3B3"
+nic2="nat"
+Forwarding(0)="vbkickSSH,tcp,,2223,,22"
+'''
+
+# recorded 'VBoxManage list -l vms' output (VirtualBox 4.3), shortened
+FIXTURE_LIST = '''Name:            centos65
+Groups:          /
+Guest OS:        Red Hat (64 bit)
+UUID:            4bd1fb7e-0a33-4f58-b5ce-14cfb1b0c0a1
+Config file:     /home/vbkick/VirtualBox VMs/centos65/centos65.vbox
+Hardware UUID:   4bd1fb7e-0a33-4f58-b5ce-14cfb1b0c0a1
+Memory size:     512MB
+State:           running (since 2014-05-20T09:12:51.184000000)
+NIC 1 Rule(0):   name = vbkickSSH, protocol = tcp, host ip = , host port = 2222, guest ip = , guest port = 22
+USB:             enabled
+
+USB Device Filters:
+
+Index:                       0
+Active:                      yes
+Name:                        usb stick
+VendorId:                    0781
+ProductId:                   5567
+Remote:                      0
+
+Index:                       1
+Active:                      no
+Name:                        webcam
+VendorId:                    046d
+ProductId:                   0825
+Remote:                      0
+
+Shared folders:  
+
+Name: 'vbkick', Host path: '/home/vbkick/centos' (machine mapping), writable
+
+Snapshots:
+
+   Name: base (UUID: 5c2b8b8e-2b79-4d89-9e39-3c5b8b1d7a11)
+      Name: vbkick-build-1493251130-4021 (UUID: 6d3c9c9f-3c8a-4e9a-8f4a-4d6c9c2e8b22) *
+
+Name:            web 01
+Groups:          /
+Guest OS:        Debian (64 bit)
+UUID:            7a0c2f7e-1d3b-4a4e-8c3e-2a1b9f4d5c6e
+State:           powered off (since 2014-05-21T18:02:11.000000000)
+
+Name:            <inaccessible!>
+UUID:            0d2f3a4b-5c6d-4e7f-8a9b-0c1d2e3f4a5b
+Config file:     /home/vbkick/VirtualBox VMs/old/old.vbox
+Access error details:
+Result Code:     NS_ERROR_FAILURE (0x80004005)
+
+Name:            saved-vm
+UUID:            9e8d7c6b-5a4f-4e3d-2c1b-0a9f8e7d6c5b
+State:           saved (since 2014-05-22T07:00:00.000000000)
+'''
+
+def test_list():
+    failed_tests = []
+    vms = parse_list_long(FIXTURE_LIST)
+    states = [(vm['name'], vm['state']) for vm in vms]
+    expected = [('centos65', 'running'), ('web 01', 'powered off'),
+                ('<inaccessible!>', 'inaccessible'), ('saved-vm', 'saved')]
+    if states != expected:
+        failed_tests.append([states, expected])
+    if (vms[0]['uuid'] != '4bd1fb7e-0a33-4f58-b5ce-14cfb1b0c0a1'
+            or vms[0]['since'] != '2014-05-20T09:12:51.184000000'):
+        failed_tests.append(['uuid/since', vms[0]])
+    for states, patterns, names in (
+            (['poweroff'], None, ['web 01']),
+            (['Powered Off', 'saved'], None, ['web 01', 'saved-vm']),
+            (None, ['*65', 'saved*'], ['centos65', 'saved-vm']),
+            (['running'], ['web*'], []),
+            (None, None, ['centos65', 'web 01', '<inaccessible!>', 'saved-vm'])):
+        got = [vm['name'] for vm in filter_vms(vms, states, patterns)]
+        if got != names:
+            failed_tests.append([states, patterns, got, names])
+    if vms[0]['snapshots'] != ['base', 'vbkick-build-1493251130-4021'] or vms[1]['snapshots']:
+        failed_tests.append(['snapshots', vms[0]['snapshots'], vms[1]['snapshots']])
+    for snapshot, names in (('vbkick-build-1493251130-4021', ['centos65']),
+                            ('vbkick-build-0-0', [])):
+        got = [vm['name'] for vm in filter_vms(vms, snapshot=snapshot)]
+        if got != names:
+            failed_tests.append([snapshot, got, names])
+    if failed_tests:
+        raise Exception(
+                 "parse_list_long()/filter_vms()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_parse():
+    failed_tests = []
+    pairs = parse_machinereadable(FIXTURE_RUNNING)
+    if dict(pairs).get('description') != 'kickstarted by vbkick\nsecond line with "quotes"':
+        failed_tests.append(['description', dict(pairs).get('description')])
+    if dict(pairs).get('memory') != '512':
+        failed_tests.append(['memory', dict(pairs).get('memory')])
+    running = VMState(pairs).lines()
+    expected = [
+        'state=running',
+        'forwarding=vbkickSSH,tcp,,2222,,22',
+        'forwarding=http,tcp,,8080,,80',
+        'sharedfolder=vbkick',
+        'medium=SATA Controller-0-0',
+        'medium=SATA Controller-1-0',
+        'disk=/home/vbkick/VirtualBox VMs/centos65/centos65_0.vdi',
+        'macaddress1=0800272E6A8C',
+        'snapshot=base',
+        'snapshot=vbkick-build-1493251130-4021',
+    ]
+    if running != expected:
+        failed_tests.append([running, expected])
+    # the rule of the second adapter is not natpf1
+    poweroff = VMState(parse_machinereadable(FIXTURE_POWEROFF)).lines()
+    expected = [
+        'state=poweroff',
+        'medium=IDE Controller-0-0',
+        'disk=/home/vbkick/VirtualBox VMs/debian/debian_0.vdi',
+        'macaddress1=080027D1A3B2',
+        'macaddress2=080027D1A3B3',
+    ]
+    if poweroff != expected:
+        failed_tests.append([poweroff, expected])
+    if VMState([]).lines() != ['state=']:
+        failed_tests.append(['empty', VMState([]).lines()])
+    if failed_tests:
+        raise Exception(
+                 "VMState"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def self_test():
+    """Tests parsing of recorded showvminfo and list -l vms output."""
+    test_parse()
+    test_list()
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] VM_NAME|-\n       %prog --list [options] [NAME_PATTERN ...]',
+        description='Prints the state of VM_NAME, read once with'
+                    ' VBoxManage showvminfo --machinereadable'
+                    ' (- reads that output from stdin).'
+                    ' With --list prints "vm name:state" of all VMs.')
+    parser.add_option('--vboxmanage', default='VBoxManage',
+        help='VBoxManage command [default: %default]')
+    parser.add_option('-j', '--json', action='store_true', default=False,
+        help='print the state as JSON')
+    parser.add_option('-l', '--list', action='store_true', default=False,
+        help='list all VMs (one VBoxManage list -l vms call)')
+    parser.add_option('-s', '--state', action='append', default=None,
+        help='with --list: only VMs in this state, e.g. running,'
+             ' "powered off" (may be repeated)')
+    parser.add_option('--snapshot', default=None, metavar='NAME',
+        help='with --list: only VMs which have snapshot NAME')
+    parser.add_option('--self-test', action='store_true', default=False,
+        help='run self test and exit')
+    options, args = parser.parse_args(argv)
+    if options.self_test:
+        return options, None
+    if options.list:
+        return options, args
+    if options.state or options.snapshot:
+        parser.error('--state and --snapshot require --list')
+    if len(args) != 1:
+        parser.error('VM_NAME is required')
+    return options, args[0]
+
+def main(argv):
+    options, vm = parse_args(argv)
+    if options.self_test:
+        self_test()
+        return 0
+    if options.list:
+        vms = filter_vms(list_vms(options.vboxmanage), options.state, vm,
+                         options.snapshot)
+        if options.json:
+            print(json.dumps(vms, indent=1, sort_keys=True))
+        else:
+            for listed in vms:
+                print('%s:%s' % (listed['name'], listed['state']))
+        return 0
+    if vm == '-':
+        text = sys.stdin.read()
+    else:
+        text = showvminfo(vm, options.vboxmanage)
+    state = VMState(parse_machinereadable(text))
+    if options.json:
+        print(json.dumps(state.as_dict(), indent=1, sort_keys=True))
+    else:
+        print('\n'.join(state.lines()))
+    return 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except (VMStateError, OSError) as e:
+        sys.stderr.write('Error: %s\n' % e)
+        sys.exit(1)
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
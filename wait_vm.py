@@ -0,0 +1,493 @@
+#!/usr/bin/python
+
+"""The MIT License - https://github.com/wilas/vbkick/blob/master/LICENSE
+
+Example usage:
+python wait_vm.py ready --port 2222 --timeout 7200 --vm centos65 -- ssh -p 2222 vbkick@127.0.0.1 echo
+python wait_vm.py down --timeout 20 centos65
+
+Note:
+Script works with python 2.6+ and python 3
+Waits until a VM is ready (ssh login works) or down (powered off and
+unlocked), probing cheaply first and backing off between probes:
+
+ready - TCP connect to the forwarded ssh port and read the SSH banner
+(VirtualBox NAT accepts connections before the guest listens, so only
+the banner means sshd is up); the login command after -- is run only
+once the banner was seen.
+down - 'VBoxManage guestproperty wait' blocks until a guest property
+changes or the VM stops, between cheap state checks.
+
+Delays between probes grow with decorrelated jitter, so many VMs
+started at once do not probe in lockstep. Time-to-ready and time-to-down
+are printed and appended as JSON lines to --metrics FILE.
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import os, sys, json, time, random, socket, optparse, subprocess
+
+DEFAULT_HOST = '127.0.0.1'
+BACKOFF_INITIAL = 0.25
+BACKOFF_MAX = 5.0
+CONNECT_TIMEOUT = 1.0
+BANNER_TIMEOUT = 2.0
+# down: no session means the VM is fully stopped
+DOWN_STATES = ('poweroff', 'aborted', 'saved')
+
+class Backoff(object):
+    """Decorrelated jitter - each delay is random between /initial/ and
+    three times the previous one, capped at /maximum/.
+    """
+
+    def __init__(self, initial=BACKOFF_INITIAL, maximum=BACKOFF_MAX,
+                 rand=random.uniform):
+        self.initial = initial
+        self.maximum = maximum
+        self.rand = rand
+        self.delay = initial
+
+    def next(self):
+        self.delay = min(self.maximum, self.rand(self.initial, self.delay * 3))
+        return self.delay
+
+    def reset(self):
+        self.delay = self.initial
+
+def probe_port(port, host=DEFAULT_HOST, connect_timeout=CONNECT_TIMEOUT,
+               banner_timeout=BANNER_TIMEOUT):
+    """Returns (connected, answered, line) - answered is True when the
+    server sent data or kept the connection open for /banner_timeout/
+    seconds (VirtualBox NAT accepts and closes at once when nothing in the
+    guest listens), line is the first line it sent.
+    """
+    try:
+        sock = socket.create_connection((host, port), connect_timeout)
+    except (socket.error, socket.timeout):
+        return False, False, ''
+    answered = False
+    try:
+        sock.settimeout(banner_timeout)
+        data = b''
+        try:
+            while b'\n' not in data and len(data) < 256:
+                chunk = sock.recv(256)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.timeout:
+            # still open - the server waits for the client to talk first
+            answered = True
+        except socket.error:
+            pass
+    finally:
+        sock.close()
+    line = data.split(b'\n')[0].strip().decode('ascii', 'replace')
+    return True, answered or bool(data), line
+
+def read_banner(port, host=DEFAULT_HOST, connect_timeout=CONNECT_TIMEOUT,
+                banner_timeout=BANNER_TIMEOUT):
+    """Returns (connected, banner) - banner is the first line sent by the
+    server when it starts with 'SSH-', None otherwise.
+    """
+    connected, answered, line = probe_port(port, host, connect_timeout,
+                                           banner_timeout)
+    if line.startswith('SSH-'):
+        return connected, line
+    return connected, None
+
+class ReadyWait(object):
+    """Waits for sshd in the VM: port, then banner, then a real login."""
+
+    def __init__(self, port, login_cmd=None, host=DEFAULT_HOST,
+                 probe=read_banner, run=subprocess.call, clock=time.time,
+                 sleep=time.sleep, backoff=None, progress=None):
+        self.port = port
+        self.login_cmd = login_cmd
+        self.host = host
+        self.probe = probe
+        self.run = run
+        self.clock = clock
+        self.sleep = sleep
+        self.backoff = backoff or Backoff()
+        self.progress = progress
+        self.metrics = {}
+
+    def wait(self, timeout):
+        """Returns True when ready before /timeout/ seconds, the phases
+        reached are in self.metrics (seconds since start).
+        """
+        start = self.clock()
+        self.metrics = {'probes': 0, 'logins': 0}
+        phase = 'port'
+        while True:
+            elapsed = self.clock() - start
+            if phase != 'login':
+                self.metrics['probes'] += 1
+                connected, banner = self.probe(self.port, self.host)
+                if connected and 'port' not in self.metrics:
+                    self.metrics['port'] = elapsed
+                if banner:
+                    self.metrics['banner'] = self.clock() - start
+                    self.metrics['server'] = banner
+                    phase = 'login'
+                    # the guest is up - login attempts start fast again
+                    self.backoff.reset()
+                    continue
+            elif not self.login_cmd:
+                break
+            else:
+                self.metrics['logins'] += 1
+                if self.run(self.login_cmd) == 0:
+                    break
+            if self.clock() - start >= timeout:
+                self.metrics['seconds'] = self.clock() - start
+                return False
+            if self.progress:
+                self.progress()
+            self.sleep(min(self.backoff.next(),
+                           max(0, timeout - (self.clock() - start))))
+        self.metrics['seconds'] = self.clock() - start
+        return True
+
+def vm_state(vm, vboxmanage='VBoxManage'):
+    """Returns (VMState, SessionState) of /vm/ from one showvminfo call;
+    SessionState is None on VirtualBox versions which don't report it.
+    (None, None) when showvminfo fails, e.g. the VM is locked for a moment.
+    """
+    import vm_state as vm_state_module
+    try:
+        pairs = dict(vm_state_module.parse_machinereadable(
+            vm_state_module.showvminfo(vm, vboxmanage)))
+    except vm_state_module.VMStateError:
+        return None, None
+    return pairs.get('VMState'), pairs.get('SessionState')
+
+def guestproperty_wait(vm, seconds, vboxmanage='VBoxManage'):
+    """Blocks until a guest property of /vm/ changes, the VM stops
+    or /seconds/ pass.
+    """
+    devnull = open(os.devnull, 'w')
+    try:
+        return subprocess.call(
+            [vboxmanage, 'guestproperty', 'wait', vm, '*',
+             '--timeout', str(max(1, int(seconds * 1000)))],
+            stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
+
+class DownWait(object):
+    """Waits until the VM is powered off (or saved/aborted) and its
+    session is unlocked, so the next VBoxManage call can lock it.
+    """
+
+    def __init__(self, vm, state=vm_state, event_wait=guestproperty_wait,
+                 clock=time.time, sleep=time.sleep, backoff=None,
+                 progress=None):
+        self.vm = vm
+        self.state = state
+        self.event_wait = event_wait
+        self.clock = clock
+        self.sleep = sleep
+        self.backoff = backoff or Backoff()
+        self.progress = progress
+        self.metrics = {}
+
+    def is_down(self):
+        state, session = self.state(self.vm)
+        return state in DOWN_STATES and session in (None, 'Unlocked')
+
+    def wait(self, timeout):
+        start = self.clock()
+        self.metrics = {'probes': 0}
+        while True:
+            self.metrics['probes'] += 1
+            if self.is_down():
+                self.metrics['seconds'] = self.clock() - start
+                return True
+            left = timeout - (self.clock() - start)
+            if left <= 0:
+                self.metrics['seconds'] = self.clock() - start
+                return False
+            if self.progress:
+                self.progress()
+            delay = min(self.backoff.next(), left)
+            before = self.clock()
+            self.event_wait(self.vm, delay)
+            # the VM has no running session to wait on (stopping) - back off
+            rest = delay - (self.clock() - before)
+            if rest > 0.05 and self.clock() - before < 0.1:
+                self.sleep(rest)
+
+def record(path, vm, event, ok, metrics, clock=time.time):
+    """Appends one JSON line with the wait result to /path/."""
+    entry = dict(metrics)
+    entry.update({'vm': vm, 'event': event, 'ok': ok, 'time': clock()})
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    metrics_file = open(path, 'a')
+    try:
+        metrics_file.write(json.dumps(entry, sort_keys=True) + '\n')
+    finally:
+        metrics_file.close()
+
+def summary(vm, event, ok, metrics):
+    if not ok:
+        return '[WARNING] %s not %s after %.1f sec' % (vm, event, metrics['seconds'])
+    details = []
+    for phase in ('port', 'banner'):
+        if phase in metrics:
+            details.append('%s %.1f sec' % (phase, metrics[phase]))
+    if metrics.get('logins'):
+        details.append('%d login(s)' % metrics['logins'])
+    details.append('%d probe(s)' % metrics['probes'])
+    return '[INFO] %s %s in %.1f sec (%s)' % (vm, event, metrics['seconds'],
+                                             ', '.join(details))
+
+def test_backoff():
+    failed_tests = []
+    backoff = Backoff(0.25, 5.0, rand=lambda low, high: high)
+    delays = [backoff.next() for _ in range(6)]
+    if delays != [0.75, 2.25, 5.0, 5.0, 5.0, 5.0]:
+        failed_tests.append(['max', delays])
+    backoff.reset()
+    backoff.rand = lambda low, high: low
+    if [backoff.next() for _ in range(3)] != [0.25, 0.25, 0.25]:
+        failed_tests.append(['min', backoff.delay])
+    backoff = Backoff()
+    for _ in range(100):
+        delay = backoff.next()
+        if not BACKOFF_INITIAL <= delay <= BACKOFF_MAX:
+            failed_tests.append(['range', delay])
+    if failed_tests:
+        raise Exception(
+                 "Backoff"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_ready_wait():
+    """Port accepted at 3 sec, banner at 10 sec, second login works."""
+    from send_scancodes import FakeClock
+    failed_tests = []
+    clock = FakeClock()
+    logins = []
+
+    def probe(port, host):
+        if clock.now >= 10:
+            return True, 'SSH-2.0-OpenSSH_5.3'
+        return clock.now >= 3, None
+
+    def run(cmd):
+        logins.append(clock.now)
+        clock.now += 0.5
+        return len(logins) < 2 and 255 or 0
+
+    backoff = Backoff(1, 4, rand=lambda low, high: high)
+    waiter = ReadyWait(2222, ['ssh', 'echo'], probe=probe, run=run,
+                       clock=clock.time, sleep=clock.sleep, backoff=backoff)
+    if not waiter.wait(60):
+        failed_tests.append(['not ready', waiter.metrics])
+    metrics = waiter.metrics
+    # probes at 0, 3, 7, 11 - no login before the banner
+    if (metrics.get('port') != 3 or metrics.get('banner') != 11
+            or metrics.get('logins') != 2 or logins[0] < 11
+            or metrics.get('server') != 'SSH-2.0-OpenSSH_5.3'):
+        failed_tests.append(['metrics', metrics, logins])
+    # timeout - never more than timeout of waiting
+    clock = FakeClock()
+    waiter = ReadyWait(2222, ['ssh'], probe=lambda port, host: (True, None),
+                       clock=clock.time, sleep=clock.sleep)
+    if waiter.wait(20) or clock.now != 20 or waiter.metrics.get('logins'):
+        failed_tests.append(['timeout', clock.now, waiter.metrics])
+    # no login command - banner is enough
+    clock = FakeClock()
+    waiter = ReadyWait(2222, None, probe=lambda port, host: (True, 'SSH-2.0-x'),
+                       clock=clock.time, sleep=clock.sleep)
+    if not waiter.wait(5) or clock.slept:
+        failed_tests.append(['banner only', clock.slept])
+    if failed_tests:
+        raise Exception(
+                 "ReadyWait"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_down_wait():
+    """VM powers off at 4 sec, session is unlocked at 5 sec."""
+    from send_scancodes import FakeClock
+    failed_tests = []
+    clock = FakeClock()
+
+    def state(vm):
+        if clock.now < 4:
+            return 'running', 'Locked'
+        return 'poweroff', clock.now < 5 and 'Unlocking' or 'Unlocked'
+
+    events = []
+
+    def event_wait(vm, seconds):
+        # guestproperty wait returns at once when the VM is stopping
+        events.append(seconds)
+        if clock.now < 4:
+            clock.now = min(clock.now + seconds, 4)
+
+    backoff = Backoff(1, 4, rand=lambda low, high: high)
+    waiter = DownWait('vm', state=state, event_wait=event_wait,
+                      clock=clock.time, sleep=clock.sleep, backoff=backoff)
+    if not waiter.wait(20) or waiter.metrics['seconds'] < 5:
+        failed_tests.append(['down', clock.now, waiter.metrics, events])
+    if clock.now > 8:
+        failed_tests.append(['too late', clock.now, events, clock.slept])
+    clock = FakeClock()
+    waiter = DownWait('vm', state=lambda vm: ('running', 'Locked'),
+                      event_wait=lambda vm, seconds: clock.sleep(seconds),
+                      clock=clock.time, sleep=clock.sleep)
+    if waiter.wait(10) or clock.now != 10:
+        failed_tests.append(['timeout', clock.now])
+    # old VirtualBox - no SessionState
+    waiter = DownWait('vm', state=lambda vm: ('poweroff', None))
+    if not waiter.wait(0):
+        failed_tests.append(['no SessionState'])
+    if failed_tests:
+        raise Exception(
+                 "DownWait"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def test_read_banner():
+    import threading
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(2)
+    port = server.getsockname()[1]
+    # None - keep the connection open without sending anything
+    replies = [b'SSH-2.0-OpenSSH_6.6\r\n', b'', b'', None]
+
+    def serve():
+        for reply in replies:
+            conn = server.accept()[0]
+            if reply is None:
+                conn.recv(1)
+            else:
+                conn.sendall(reply)
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    failed_tests = []
+    try:
+        result = read_banner(port)
+        if result != (True, 'SSH-2.0-OpenSSH_6.6'):
+            failed_tests.append(['banner', result])
+        # NAT forwarding accepts and closes when the guest doesn't listen
+        result = read_banner(port)
+        if result != (True, None):
+            failed_tests.append(['no banner', result])
+        result = probe_port(port, banner_timeout=0.5)
+        if result != (True, False, ''):
+            failed_tests.append(['closed at once', result])
+        result = probe_port(port, banner_timeout=0.2)
+        if result != (True, True, ''):
+            failed_tests.append(['kept open', result])
+        thread.join(5)
+    finally:
+        server.close()
+    result = read_banner(port)
+    if result != (False, None):
+        failed_tests.append(['closed port', result])
+    if failed_tests:
+        raise Exception(
+                 "read_banner()/probe_port()"
+                 " gave bad results: %s" % repr(failed_tests)
+        )
+
+def self_test():
+    """Tests backoff, ready and down waits with a fake clock
+    and the banner probe against a local socket.
+    """
+    test_backoff()
+    test_ready_wait()
+    test_down_wait()
+    test_read_banner()
+
+def parse_args(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] ready --port PORT [-- LOGIN_CMD ...]\n'
+              '       %prog [options] down VM_NAME',
+        description='Waits until a VM is ready (ssh works) or down.')
+    parser.disable_interspersed_args()
+    parser.add_option('-t', '--timeout', type='float', default=60,
+        help='give up after this many seconds [default: %default]')
+    parser.add_option('-p', '--port', type='int', default=None,
+        help='ready: forwarded ssh port')
+    parser.add_option('--host', default=DEFAULT_HOST,
+        help='ready: host of the ssh port [default: %default]')
+    parser.add_option('--vm', default=None,
+        help='ready: VM name used in the report and metrics')
+    parser.add_option('-m', '--metrics', default=None, metavar='FILE',
+        help='append wait results as JSON lines to FILE')
+    parser.add_option('--vboxmanage', default='VBoxManage',
+        help='down: VBoxManage command [default: %default]')
+    parser.add_option('-q', '--quiet', action='store_true', default=False,
+        help='do not print progress dots')
+    parser.add_option('--self-test', action='store_true', default=False,
+        help='run self test and exit')
+    options, args = parser.parse_args(argv)
+    if options.self_test:
+        return options, None, None
+    if not args or args[0] not in ('ready', 'down'):
+        parser.error('ready or down is required')
+    event, args = args[0], args[1:]
+    if args and args[0] == '--':
+        args = args[1:]
+    if event == 'ready':
+        if options.port is None:
+            parser.error('ready requires --port')
+        return options, event, args
+    if len(args) != 1:
+        parser.error('down requires VM_NAME')
+    options.vm = args[0]
+    return options, event, None
+
+def main(argv):
+    options, event, login_cmd = parse_args(argv)
+    if options.self_test:
+        self_test()
+        return 0
+    progress = None
+    if not options.quiet:
+        def progress():
+            sys.stdout.write('.')
+            sys.stdout.flush()
+    if event == 'ready':
+        waiter = ReadyWait(options.port, login_cmd or None, options.host,
+                           progress=progress)
+        vm = options.vm or '%s:%d' % (options.host, options.port)
+    else:
+        waiter = DownWait(options.vm, progress=progress,
+                          state=lambda vm: vm_state(vm, options.vboxmanage),
+                          event_wait=lambda vm, seconds: guestproperty_wait(
+                              vm, seconds, options.vboxmanage))
+        vm = options.vm
+    ok = waiter.wait(options.timeout)
+    if progress and waiter.metrics['probes'] > 1:
+        sys.stdout.write('\n')
+    print(summary(vm, event, ok, waiter.metrics))
+    if options.metrics:
+        record(options.metrics, vm, event, ok, waiter.metrics)
+    if not ok:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+#  As per: http://vimdoc.sourceforge.net/htmldoc/options.html#'tabstop'
+# Set 'tabstop' and 'shiftwidth' to whatever you prefer and use 'expandtab'.
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4